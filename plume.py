@@ -1,17 +1,233 @@
 # Built-in dependencies
+import asyncio
+from collections import deque, namedtuple, OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import functools
+import hashlib
+import itertools
 import json
+import math
 import operator
+import queue
 import sqlite3
+import threading
+import time
 
 
 ASCENDING = 'ASC'
 DESCENDING = 'DESC'
 
+DEFAULT_BATCH_SIZE = 100
+DEFAULT_CHUNK_SIZE = 10000
+DEFAULT_MAX_PENDING = 64
+# Seconds a read waits for a pooled connection before giving up.
+DEFAULT_POOL_TIMEOUT = 30.0
+# A group commit writer flushes its operations after this many seconds,
+# or as soon as it queued this many operations.
+DEFAULT_GROUP_DELAY = 0.005
+DEFAULT_GROUP_SIZE = 1000
+# Default maximum number of parameters of a SQLite statement.
+MAX_VARIABLES = 999
+
+# Pragmas applied on connect, in the order they must be set: the page size
+# only applies before the journal is switched to WAL.
+PRAGMAS = (
+    'page_size', 'journal_mode', 'synchronous', 'cache_size', 'mmap_size',
+    'temp_store',
+)
+PROFILES = {
+    'default': {},
+    'throughput': {
+        'journal_mode': 'wal',
+        'synchronous': 'normal',
+        'cache_size': -64000,
+        'mmap_size': 268435456,
+        'temp_store': 'memory',
+    },
+    'durable': {
+        'journal_mode': 'wal',
+        'synchronous': 'full',
+    },
+}
+# The -> operator extracts JSON values without turning booleans into
+# integers, so that projected documents are rebuilt by json_object().
+_JSON_ARROW = sqlite3.sqlite_version_info >= (3, 38, 0)
+_PRAGMA_CHOICES = {
+    'journal_mode': ('delete', 'truncate', 'persist', 'memory', 'wal', 'off'),
+    'synchronous': ('off', 'normal', 'full', 'extra'),
+    'temp_store': ('default', 'file', 'memory'),
+}
+
 
 class BadProjection(ValueError):
     pass
 
 
+class BadQuery(ValueError):
+    pass
+
+
+class BadSetting(ValueError):
+    pass
+
+
+class DuplicateKey(ValueError):
+    pass
+
+
+class InvalidOperation(RuntimeError):
+    pass
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class _LRUCache:
+    """A bounded mapping that evicts its least recently used entries."""
+    __slots__ = ('_entries', '_hits', '_lock', '_maxsize', '_misses')
+
+    def __init__(self, maxsize: int) -> None:
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._maxsize = maxsize
+        self._hits = 0
+        self._misses = 0
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._entries[key]
+            except KeyError:
+                self._misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self._hits += 1
+            return value
+
+    def set(self, key, value) -> None:
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def info(self) -> CacheInfo:
+        return CacheInfo(
+            self._hits, self._misses, self._maxsize, len(self._entries)
+        )
+
+
+PoolInfo = namedtuple(
+    'PoolInfo', ['size', 'available', 'checkouts', 'waits', 'wait_time']
+)
+
+
+class _ConnectionPool:
+    """
+        A fixed set of connections checked out by one thread at a time.
+
+        A thread already holding a connection, like one iterating over a
+        lazy cursor, is handed the same connection again instead of
+        waiting for another one.
+    """
+    __slots__ = (
+        '_checkouts', '_connections', '_held', '_lock', '_size', '_timeout',
+        '_wait_time', '_waits',
+    )
+
+    def __init__(self, connections: list,
+                 timeout: float=DEFAULT_POOL_TIMEOUT) -> None:
+        self._connections = queue.LifoQueue()
+        for connection in connections:
+            self._connections.put(connection)
+        self._lock = threading.Lock()
+        self._size = len(connections)
+        self._timeout = timeout
+        # Maps a thread identifier to its connection and checkout count.
+        self._held = {}
+        self._checkouts = 0
+        self._waits = 0
+        self._wait_time = 0.0
+
+    def acquire(self):
+        thread = threading.get_ident()
+        with self._lock:
+            held = self._held.get(thread)
+            if held is not None:
+                held[1] += 1
+                self._checkouts += 1
+                return held[0]
+        try:
+            connection = self._connections.get_nowait()
+            waited = None
+        except queue.Empty:
+            started = time.monotonic()
+            try:
+                connection = self._connections.get(timeout=self._timeout)
+            except queue.Empty:
+                raise InvalidOperation(
+                    'No pooled connection was released within {} '
+                    'seconds'.format(self._timeout)
+                ) from None
+            waited = time.monotonic() - started
+        with self._lock:
+            self._held[thread] = [connection, 1]
+            self._checkouts += 1
+            if waited is not None:
+                self._waits += 1
+                self._wait_time += waited
+        return connection
+
+    def release(self, connection) -> None:
+        with self._lock:
+            # An asynchronous cursor may be closed by another thread than
+            # the one which checked out its connection.
+            thread = next(
+                thread for thread, held in self._held.items()
+                if held[0] is connection
+            )
+            held = self._held[thread]
+            held[1] -= 1
+            if held[1]:
+                return
+            del self._held[thread]
+        self._connections.put(connection)
+
+    def close(self) -> None:
+        """Closes the connections, once they all have been released."""
+        while True:
+            try:
+                self._connections.get_nowait().close()
+            except queue.Empty:
+                return
+
+    def info(self) -> PoolInfo:
+        with self._lock:
+            return PoolInfo(
+                self._size, self._connections.qsize(), self._checkouts,
+                self._waits, self._wait_time,
+            )
+
+
+# Documents are stored without the whitespaces json.dumps() adds by default.
+_encode_document = json.JSONEncoder(separators=(',', ':')).encode
+
+
+def _path_get(document: dict, path: list):
+    """Same as _nested_get() with a field already split on its dots."""
+    value = document
+    try:
+        for field in path:
+            value = value[field]
+        return value
+    except KeyError:
+        return None
+
+
 def _nested_get(document: dict, field: str):
     nested_fields = field.split('.')
     value = document
@@ -45,135 +261,407 @@ def _nested_set(document, field, value):
         return None
 
 
-class Selector:
+def _json_path(field: str) -> str:
+    """
+        Returns the JSON path of a (nested) field as a SQL string, or None
+        if the field name can't be expressed as a JSON path.
+    """
+    if '"' in field:
+        return None
+    path = ''.join('."' + key + '"' for key in field.split('.'))
+    return "'$" + path.replace("'", "''") + "'"
 
-    def get_selector(self, key: str, expression):
-        if key[0] != '$':
-            if not isinstance(expression, dict):
-                return Equal(key, expression)
-            elif len(expression) == 1:
-                operator, value = expression.popitem()
-                return self.get_field_selector(key, operator, value)
-            else:
-                return ImplicitAnd(key, expression)
-        elif key == '$and':
-            return And(expression)
+
+def _json_extract(field: str) -> str:
+    """
+        Returns a JSON1 expression that extracts a (nested) field
+        from the document stored in the _data column.
+
+        Returns None if the field name can't be expressed as a JSON path.
+    """
+    path = _json_path(field)
+    if path is not None:
+        return 'json_extract(_data, ' + path + ')'
+
+
+def _json_projection(include_fields: set, exclude_fields: set) -> str:
+    """
+        Returns a JSON1 expression that applies a projection on the
+        document stored in the _data column, so that only projected fields
+        are decoded in Python.
+
+        Returns None if the projection can only be applied in Python.
+    """
+    if exclude_fields:
+        paths = [
+            _json_path(field) for field in sorted(exclude_fields)
+            if field != '_id'
+        ]
+        if None in paths:
+            return None
+        return 'json_remove(' + ', '.join(['_data'] + paths) + ')'
+
+    fields = sorted(include_fields - {'_id'})
+    if any(
+        other.startswith(field + '.') for field in fields for other in fields
+    ):
+        return None
+
+    # Nested fields are gathered in nested objects, as in Python.
+    tree = {}
+    for field in fields:
+        *parent_fields, last_field = field.split('.')
+        node = tree
+        for parent_field in parent_fields:
+            node = node.setdefault(parent_field, {})
+        node[last_field] = _json_path(field)
+        if node[last_field] is None:
+            return None
+
+    def json_object(node: dict) -> str:
+        return 'json_object(' + ', '.join(
+            _sql_literal(key) + ', ' + (
+                json_object(value) if isinstance(value, dict)
+                else '_data -> ' + value
+            )
+            for key, value in node.items()
+        ) + ')'
+
+    return json_object(tree)
+
+
+def _sql_column(field: str, indexed_fields: set, pushdown) -> str:
+    """
+        Returns the SQL expression holding the value of a field, or None if
+        the field can only be read from the decoded document in Python.
+
+        `pushdown` tells whether non-indexed fields are read with
+        json_extract(), or is the set of the fields that are. It is only
+        False when SQLite does not provide the JSON1 extension.
+    """
+    if field == '_id':
+        return 'id'
+    elif field in indexed_fields:
+        return '"' + field + '"'
+    elif pushdown is True or (pushdown and field in pushdown):
+        return _json_extract(field)
+
+
+_SQL_SCALARS = (str, int, float)
+_SQL_LISTS = (list, tuple, set, frozenset)
+
+_LOGICAL_OPERATORS = ('$and', '$or')
+_MEMBERSHIP_OPERATORS = ('$in', '$nin')
+
+
+def _value_kind(value) -> str:
+    """Returns how a query value can be compiled in a SQL clause."""
+    if value is None:
+        return 'null'
+    elif isinstance(value, str):
+        return 'text'
+    elif isinstance(value, _SQL_SCALARS):
+        return 'number'
+    elif isinstance(value, _SQL_LISTS) and all(
+        isinstance(item, _SQL_SCALARS) for item in value
+    ):
+        return 'list'
+    return 'document'
+
+
+# The types a value is compared with, as JSON types or SQLite types.
+_JSON_TYPES = {
+    'number': "('integer', 'real', 'true', 'false')",
+    'text': "('text')",
+}
+_SQL_TYPES = {
+    'number': "('integer', 'real')",
+    'text': "('text')",
+}
+
+
+def _json_type(field: str, column: str) -> str:
+    """
+        Returns the SQL expression of the JSON type of a field read with
+        json_extract(), or None if it is read from a column.
+    """
+    if column.startswith('json_extract('):
+        return 'json_type(_data, ' + _json_path(field) + ')'
+
+
+def _bind(values: list, slots: list) -> list:
+    """
+        Returns the parameters of a SQL statement from the query values.
+
+        Lists are bound as JSON arrays, to be read with json_each().
+    """
+    params = [values[slot] for slot in slots]
+    for index, param in enumerate(params):
+        if isinstance(param, _SQL_LISTS):
+            params[index] = json.dumps(list(param))
+    return params
+
+
+def _sql_literal(value) -> str:
+    """Renders a scalar value in a SQL statement that can not be bound."""
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    elif isinstance(value, float) and not math.isfinite(value):
+        raise BadQuery('Value can not be written in SQL: {}'.format(value))
+    return repr(int(value) if isinstance(value, bool) else value)
+
+
+def _is_field_expression(expression) -> bool:
+    return (
+        isinstance(expression, dict) and len(expression) > 0 and
+        all(key[0] == '$' for key in expression)
+    )
+
+
+def _parse_query(query: dict, values: list) -> tuple:
+    """
+        Returns the shape of a query, made of its fields and operators
+        but not of its values, and collects its values in the order
+        they are bound to a selector tree.
+    """
+    shape = []
+    for key, expression in query.items():
+        if key in _LOGICAL_OPERATORS:
+            shape.append((key, tuple(
+                _parse_query(sub_query, values) for sub_query in expression
+            )))
+        elif key[0] == '$':
+            raise BadQuery('Unknown logical operator: {}'.format(key))
+        elif _is_field_expression(expression):
+            field_shape = []
+            for operator_name, value in expression.items():
+                if operator_name in _LOGICAL_OPERATORS:
+                    field_shape.append((operator_name, tuple(
+                        _parse_query(sub_query, values) for sub_query in value
+                    )))
+                else:
+                    kind = _value_kind(value)
+                    if operator_name in _MEMBERSHIP_OPERATORS and (
+                        kind == 'list'
+                    ):
+                        # Membership is checked in Python with a set.
+                        value = frozenset(value)
+                    values.append(value)
+                    field_shape.append((operator_name, kind))
+            shape.append((key, tuple(field_shape)))
+        else:
+            values.append(expression)
+            shape.append((key, (('$eq', _value_kind(expression)),)))
+    return tuple(shape)
+
+
+def _shape_fields(shape: tuple):
+    """Yields the fields a query shape applies on."""
+    for key, expression in shape:
+        if key in _LOGICAL_OPERATORS:
+            for sub_shape in expression:
+                yield from _shape_fields(sub_shape)
+            continue
+
+        yield key
+        for operator_name, kind in expression:
+            if operator_name in _LOGICAL_OPERATORS:
+                for sub_shape in kind:
+                    yield from _shape_fields(sub_shape)
+
+
+def _build_selector(shape: tuple, slots) -> 'And':
+    """
+        Builds the selector tree of a query shape.
+
+        Each comparison selector is given the slot of its value in the
+        list of values collected by _parse_query().
+    """
+    selectors = []
+    for key, expression in shape:
+        if key == '$and':
+            selectors.append(And(
+                [_build_selector(sub_shape, slots) for sub_shape in expression]
+            ))
         elif key == '$or':
-            return Or(expression)
-
-    def get_field_selector(self, field: str, operator: str, value):
-        if operator == '$eq':
-            return Equal(field, value)
-        elif operator == '$gt':
-            return GreaterThan(field, value)
-        elif operator == '$gte':
-            return GreaterThanOrEqual(field, value)
-        elif operator == '$lt':
-            return LowerThan(field, value)
-        elif operator == '$lte':
-            return LowerThanOrEqual(field, value)
-        elif operator == '$ne':
-            return NotEqual(field, value)
+            selectors.append(Or(
+                [_build_selector(sub_shape, slots) for sub_shape in expression]
+            ))
+        else:
+            field_selectors = []
+            for operator_name, kind in expression:
+                if operator_name == '$and':
+                    selector = And([
+                        _build_selector(sub_shape, slots) for sub_shape in kind
+                    ])
+                elif operator_name == '$or':
+                    selector = Or([
+                        _build_selector(sub_shape, slots) for sub_shape in kind
+                    ])
+                else:
+                    try:
+                        selector_class = FIELD_SELECTORS[operator_name]
+                    except KeyError:
+                        msg = 'Unknown field operator: {}'
+                        raise BadQuery(msg.format(operator_name))
+                    selector = selector_class(key, next(slots), kind)
+                field_selectors.append(selector)
+
+            if len(field_selectors) == 1:
+                selectors.append(field_selectors[0])
+            else:
+                selectors.append(And(field_selectors))
+    return And(selectors)
+
+
+class Selector:
+    __slots__ = ()
+
+    def match(self, document: dict, values: list) -> bool:
+        raise NotImplementedError
+
+    def sql(self, indexed_fields: set, pushdown: bool=False) -> tuple:
+        """
+            Returns a SQL clause and the slots of the values bound to its
+            parameters, or None if the selector must be matched in Python.
+        """
+        raise NotImplementedError
 
 
 class And(Selector):
     __slots__ = ('_selectors',)
 
-    def __init__(self, expressions: list) -> None:
-        self._selectors = []
-        for expression in expressions:
-            key, value = expression.popitem()
-            selector = self.get_selector(key, value)
-            self._selectors.append(selector)
+    def __init__(self, selectors: list) -> None:
+        self._selectors = selectors
 
     def is_empty(self) -> bool:
         return False if self._selectors else True
 
-    def match(self, document: dict) -> bool:
+    def match(self, document: dict, values: list) -> bool:
         for selector in self._selectors:
-            if not selector.match(document):
+            if not selector.match(document, values):
                 return False
         return True
 
-    def sql(self, indexed_fields: set) -> str:
-        index_clauses = []
-        non_index_selectors = []
+    def sql(self, indexed_fields: set, pushdown: bool=False) -> tuple:
+        """
+            Returns a SQL clause and its parameter slots only if every
+            selector can be applied by SQLite, without altering the tree.
+        """
+        clauses = []
+        slots = []
         for selector in self._selectors:
-            clause = selector.sql(indexed_fields)
-            if clause:
-                index_clauses.append(clause)
-            else:
-                non_index_selectors.append(selector)
-
-        if index_clauses:
-            self._selectors = non_index_selectors
-            return ' AND '.join(index_clauses)
-
+            compiled = selector.sql(indexed_fields, pushdown)
+            if compiled is None:
+                return None
+            clauses.append(compiled[0])
+            slots += compiled[1]
 
-class ImplicitAnd(And):
-    __slots__ = ('_selectors',)
+        if clauses:
+            return ' AND '.join(clauses), slots
 
-    def __init__(self, field: str, expression: dict) -> None:
-        self._selectors = []
-        for operator, value in expression.items():
-            if operator == '$and':
-                selector = And(value)
-            elif operator == '$or':
-                selector = Or(value)
+    def split_sql(self, indexed_fields: set, pushdown: bool=False) -> tuple:
+        """
+            Returns the SQL clause and parameter slots of the selectors that
+            can be applied by SQLite and only keeps the remaining ones to be
+            matched in Python.
+        """
+        clauses = []
+        slots = []
+        remaining_selectors = []
+        for selector in self._selectors:
+            if isinstance(selector, And):
+                compiled = selector.split_sql(indexed_fields, pushdown)
+                if not selector.is_empty():
+                    remaining_selectors.append(selector)
             else:
-                selector = self.get_field_selector(field, operator, value)
-            self._selectors.append(selector)
+                compiled = selector.sql(indexed_fields, pushdown)
+                if compiled is None:
+                    remaining_selectors.append(selector)
+            if compiled is not None:
+                clauses.append(compiled[0])
+                slots += compiled[1]
+
+        self._selectors = remaining_selectors
+        if clauses:
+            return ' AND '.join(clauses), slots
 
 
 class Or(Selector):
     __slots__ = ('_selectors',)
 
-    def __init__(self, expressions: list) -> None:
-        self._selectors = []
-        for expression in expressions:
-            key, value = expression.popitem()
-            selector = self.get_selector(key, value)
-            self._selectors.append(selector)
+    def __init__(self, selectors: list) -> None:
+        self._selectors = selectors
 
-    def match(self, document: dict) -> bool:
+    def match(self, document: dict, values: list) -> bool:
         for selector in self._selectors:
-            if selector.match(document):
+            if selector.match(document, values):
                 return True
         return False
 
-    def sql(self, indexed_fields: set) -> str:
-        index_clauses = []
+    def sql(self, indexed_fields: set, pushdown: bool=False) -> tuple:
+        clauses = []
+        slots = []
         for selector in self._selectors:
-            clause = selector.sql(indexed_fields)
-            if clause:
-                index_clauses.append(clause)
-
-        if len(index_clauses) != len(self._selectors):
-            return None
+            compiled = selector.sql(indexed_fields, pushdown)
+            if compiled is None:
+                return None
+            clauses.append(compiled[0])
+            slots += compiled[1]
 
-        or_clause = ' OR '.join('(' + clause + ')' for clause in index_clauses)
-        self._selectors = []
-        return '(' + or_clause + ')'
+        or_clause = ' OR '.join('(' + clause + ')' for clause in clauses)
+        return '(' + or_clause + ')', slots
 
 
 class ComparisonSelector(Selector):
-    __slots__ = ('_field', '_value')
+    __slots__ = ('_field', '_kind', '_slot')
+    # Whether values are ordered, which Python only does for values of
+    # the same type, when SQLite orders values of any type.
+    _ordered = False
 
-    def __init__(self, field: str, value) -> None:
+    def __init__(self, field: str, slot: int, kind: str) -> None:
         self._field = field
-        self._value = value
+        self._slot = slot
+        self._kind = kind
 
-    def match(self, document: dict) -> bool:
-        return self._operator(
-            _nested_get(document, self._field),
-            self._value
-        )
+    def match(self, document: dict, values: list) -> bool:
+        try:
+            return self._operator(
+                _nested_get(document, self._field),
+                values[self._slot]
+            )
+        except TypeError:
+            # Values of different types never match.
+            return False
+
+    def sql(self, indexed_fields: set, pushdown: bool=False) -> tuple:
+        if self._kind not in ('number', 'text'):
+            return None
 
-    def sql(self, indexed_fields: set) -> bool:
-        if self._field in indexed_fields:
-            return ' '.join([
-                '"' + self._field + '"', self._sql_operator, str(self._value)
-            ])
+        column = _sql_column(self._field, indexed_fields, pushdown)
+        if column is None:
+            return None
+
+        clause = column + ' ' + self._sql_operator + ' ?'
+        guard = self._sql_guard(column)
+        if guard is not None:
+            clause += ' AND ' + guard
+        return clause, [self._slot]
+
+    def _sql_guard(self, column: str) -> str:
+        """
+            Returns the SQL clause restricting a comparison to the values
+            Python compares the same way, or None.
+        """
+        json_type = _json_type(self._field, column)
+        if self._ordered:
+            if json_type is not None:
+                return json_type + ' IN ' + _JSON_TYPES[self._kind]
+            elif column != 'id' or self._kind != 'number':
+                return 'typeof(' + column + ') IN ' + _SQL_TYPES[self._kind]
+        elif json_type is not None and self._kind == 'text':
+            # Arrays and objects are extracted as JSON texts.
+            return json_type + " NOT IN ('array', 'object')"
 
 
 class Equal(ComparisonSelector):
@@ -181,57 +669,129 @@ class Equal(ComparisonSelector):
     _sql_operator = '='
     _operator = operator.__eq__
 
-    def sql(self, indexed_fields: set) -> str:
-        if self._field not in indexed_fields:
-            return None
+    def sql(self, indexed_fields: set, pushdown: bool=False) -> tuple:
+        if self._kind != 'null':
+            return super().sql(indexed_fields, pushdown)
 
-        if isinstance(self._value, str):
-            value = '"' + self._value + '"'
-        else:
-            value = self._value
-        return ' '.join([
-            '"' + self._field + '"', self._sql_operator, str(value)
-        ])
+        column = _sql_column(self._field, indexed_fields, pushdown)
+        if column is not None:
+            return column + ' IS NULL', []
 
 
 class GreaterThan(ComparisonSelector):
     __slots__ = ()
+    _ordered = True
     _sql_operator = '>'
     _operator = operator.__gt__
 
 
 class GreaterThanOrEqual(ComparisonSelector):
     __slots__ = ()
+    _ordered = True
     _sql_operator = '>='
     _operator = operator.__ge__
 
 
 class LowerThan(ComparisonSelector):
     __slots__ = ()
+    _ordered = True
     _sql_operator = '<'
     _operator = operator.__lt__
 
 
 class LowerThanOrEqual(ComparisonSelector):
     __slots__ = ()
+    _ordered = True
     _sql_operator = '<='
     _operator = operator.__le__
 
 
 class NotEqual(ComparisonSelector):
     __slots__ = ()
-    _sql_operator = '!='
+    # A missing field does not equal any value, as it does in Python.
+    _sql_operator = 'IS NOT'
     _operator = operator.__ne__
 
-    def sql(self, indexed_fields: set) -> str:
-        if self._field in indexed_fields:
-            if isinstance(self._value, str):
-                value = '"' + self._value + '"'
-            else:
-                value = self._value
-            return ' '.join([
-                '"' + self._field + '"', self._sql_operator, str(value)
-            ])
+    def sql(self, indexed_fields: set, pushdown: bool=False) -> tuple:
+        column = _sql_column(self._field, indexed_fields, pushdown)
+        if self._kind == 'null':
+            if column is not None:
+                return column + ' IS NOT NULL', []
+            return None
+
+        compiled = super().sql(indexed_fields, pushdown)
+        if compiled is None:
+            return None
+        json_type = _json_type(self._field, column)
+        if json_type is not None and self._kind == 'text':
+            # Arrays and objects differ from any text, even their own.
+            return '({} OR {} IN (\'array\', \'object\'))'.format(
+                compiled[0], json_type
+            ), compiled[1]
+        return compiled
+
+    def _sql_guard(self, column: str) -> str:
+        return None
+
+
+class In(ComparisonSelector):
+    __slots__ = ()
+
+    def match(self, document: dict, values: list) -> bool:
+        try:
+            return _nested_get(document, self._field) in values[self._slot]
+        except TypeError:
+            # Lists and documents are never in a set of scalar values.
+            return False
+
+    def sql(self, indexed_fields: set, pushdown: bool=False) -> tuple:
+        # The list of values is bound as a single JSON array, so that
+        # lists of any length share the same SQL statement, as long as
+        # SQLite provides json_each().
+        if self._kind != 'list' or pushdown is False:
+            return None
+
+        column = _sql_column(self._field, indexed_fields, pushdown)
+        if column is None:
+            return None
+
+        return (
+            self._sql_clause(column, _json_type(self._field, column)),
+            [self._slot]
+        )
+
+    def _sql_clause(self, column: str, json_type: str) -> str:
+        clause = column + ' IN (SELECT value FROM json_each(?))'
+        if json_type is not None:
+            # Arrays and objects are extracted as JSON texts.
+            clause += ' AND ' + json_type + " NOT IN ('array', 'object')"
+        return clause
+
+
+class NotIn(In):
+    __slots__ = ()
+
+    def match(self, document: dict, values: list) -> bool:
+        return not super().match(document, values)
+
+    def _sql_clause(self, column: str, json_type: str) -> str:
+        # A missing field is not in any list, as it is in Python.
+        clause = '{0} IS NULL OR {0} NOT IN (SELECT value FROM json_each(?))'
+        if json_type is not None:
+            clause += ' OR ' + json_type + " IN ('array', 'object')"
+        return '(' + clause.format(column) + ')'
+
+
+FIELD_SELECTORS = {
+    '$eq': Equal,
+    '$gt': GreaterThan,
+    '$gte': GreaterThanOrEqual,
+    '$in': In,
+    '$lt': LowerThan,
+    '$lte': LowerThanOrEqual,
+    '$ne': NotEqual,
+    '$nin': NotIn,
+}
 
 
 class Transaction:
@@ -240,215 +800,1298 @@ class Transaction:
 
         Within a Transation a RESERVED lock is acquired immediately,
         meaning that only concurrent reading operations are allowed during
-        this time.
+        this time, unless another locking `mode` is given.
+        A Transaction opened within another one is a savepoint, whose
+        changes are rolled back alone on error.
     """
-    __slots__ = ('_connection')
+    __slots__ = ('_connection', '_mode', '_savepoint')
+
+    MODES = ('DEFERRED', 'IMMEDIATE', 'EXCLUSIVE')
 
-    def __init__(self, connection):
+    def __init__(self, connection, mode: str='IMMEDIATE'):
+        if mode.upper() not in self.MODES:
+            raise BadSetting('Unknown transaction mode {!r}'.format(mode))
         self._connection = connection
+        self._mode = mode.upper()
+        self._savepoint = False
 
     def __enter__(self):
-        self._connection.execute('BEGIN IMMEDIATE')
+        # Savepoints of the same name are stacked, the innermost one being
+        # released or rolled back first.
+        self._savepoint = self._connection.in_transaction
+        if self._savepoint:
+            self._connection.execute('SAVEPOINT plume_savepoint')
+        else:
+            self._connection.execute('BEGIN ' + self._mode)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        if exc_type:
+        if self._savepoint:
+            if exc_type:
+                self._connection.execute('ROLLBACK TO plume_savepoint')
+            self._connection.execute('RELEASE plume_savepoint')
+        elif exc_type:
             self._connection.execute('ROLLBACK')
         else:
             self._connection.execute('COMMIT')
 
 
+class _DatabaseTransaction(Transaction):
+    """
+        A transaction on the writer connection of a database, which other
+        threads wait for before writing.
+    """
+    __slots__ = ('_db', '_previous_writer')
+
+    def __init__(self, db, mode: str='IMMEDIATE'):
+        super().__init__(db._connection, mode)
+        self._db = db
+        self._previous_writer = None
+
+    def __enter__(self):
+        self._db._write_lock.acquire()
+        try:
+            super().__enter__()
+        except BaseException:
+            self._db._write_lock.release()
+            raise
+        self._previous_writer = self._db._writer
+        self._db._writer = threading.get_ident()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            super().__exit__(exc_type, exc_val, exc_tb)
+            if exc_type is not None:
+                # Collections and indexes created within the transaction
+                # are rolled back along with their tables.
+                self._db._load_collections()
+        finally:
+            self._db._writer = self._previous_writer
+            self._db._write_lock.release()
+
+
 def transactional(fun):
-    """Decorator that wrap an operation into a transaction."""
-    def transactional_wrapper(*args, **kwargs):
-        connection = args[0]._db._connection
-        if connection.in_transaction:
-            return fun(*args, **kwargs)
+    """
+        Decorator that wrap an operation into a transaction.
 
-        with Transaction(connection):
+        Operations are serialized on the writer connection of the database,
+        whose owning thread keeps reading from it until the transaction ends.
+        Within another transaction, an operation runs in a savepoint, so
+        that it is still all or nothing.
+    """
+    def transactional_wrapper(*args, **kwargs):
+        with _DatabaseTransaction(args[0]._db):
             return fun(*args, **kwargs)
 
     return transactional_wrapper
 
 
+def _iter_rows(cursor, batch_size: int):
+    """Yields the rows of a sqlite3 cursor, fetched one batch at a time."""
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield from rows
+    finally:
+        cursor.close()
+
+
+def _merge_id(document: dict, _id: int) -> dict:
+    document['_id'] = _id
+    return document
+
+
+def _parse_projection(projection: dict) -> tuple:
+    """Returns the sets of fields to include and to exclude."""
+    include_fields = set()
+    exclude_fields = set()
+    if projection is None:
+        return include_fields, exclude_fields
+
+    for field, presence in projection.items():
+        if presence == 1:
+            include_fields.add(field)
+        elif presence == 0:
+            exclude_fields.add(field)
+
+    if include_fields and exclude_fields:
+        msg = 'A projection can only include or exclude fields:\n {}'
+        raise BadProjection(msg.format(projection))
+
+    return include_fields, exclude_fields
+
+
+def _project(document: dict, include_fields: set,
+             exclude_fields: set) -> dict:
+    if include_fields:
+        new_document = {}
+        for field in include_fields:
+            value = _nested_get(document, field)
+            _nested_set(new_document, field, value)
+        return new_document
+    elif exclude_fields:
+        for field in exclude_fields:
+            _nested_pop(document, field)
+        return document
+    else:
+        return document
+
+
+def _parse_sort(sort) -> tuple:
+    """Returns the (field, direction) pairs of a sort specification."""
+    if sort is None:
+        return ()
+    # Allows the user to sort on a single field by providing a tuple.
+    if isinstance(sort, tuple):
+        sort = [sort]
+    sort = tuple(tuple(key) for key in sort)
+    for key in sort:
+        if len(key) != 2 or key[1] not in (ASCENDING, DESCENDING):
+            raise BadQuery('Invalid sort key: {}'.format(key))
+    return sort
+
+
+def _python_sort(sort: tuple, indexed_fields: set, pushdown) -> tuple:
+    """Returns the sort keys if SQLite can not order documents by all."""
+    if any(
+        _sql_column(field, indexed_fields, pushdown) is None
+        for field, direction in sort
+    ):
+        return sort
+    return ()
+
+
+def _sort_key(value) -> tuple:
+    """Orders values of any type as SQLite does: nulls, numbers, texts."""
+    if value is None:
+        return (0, 0)
+    elif isinstance(value, (int, float)):
+        return (1, value)
+    elif isinstance(value, str):
+        return (2, value)
+    return (3, _encode_document(value))
+
+
+def _sort_documents(documents, sort: tuple) -> list:
+    """Sorts documents in Python, one stable sort per key."""
+    documents = list(documents)
+    for field, direction in reversed(sort):
+        documents.sort(
+            key=lambda document: _sort_key(_nested_get(document, field)),
+            reverse=direction == DESCENDING
+        )
+    return documents
+
+
+_EQUALITY_SELECTORS = (Equal, In)
+_RANGE_SELECTORS = (
+    GreaterThan, GreaterThanOrEqual, LowerThan, LowerThanOrEqual,
+)
+
+
+def _index_constraints(query_tree: And, indexed_fields: set,
+                       pushdown: bool) -> dict:
+    """
+        Maps the fields of the top-level selectors applied by SQLite to the
+        way an index can search them: by 'equality' or by 'range'.
+    """
+    constraints = {}
+    for selector in query_tree._selectors:
+        if isinstance(selector, And):
+            for field, constraint in _index_constraints(
+                selector, indexed_fields, pushdown
+            ).items():
+                if constraints.get(field) != 'equality':
+                    constraints[field] = constraint
+            continue
+
+        if type(selector) in _EQUALITY_SELECTORS:
+            constraint = 'equality'
+        elif type(selector) in _RANGE_SELECTORS:
+            constraint = 'range'
+        else:
+            continue
+        if selector.sql(indexed_fields, pushdown) is None:
+            continue
+        if constraints.get(selector._field) != 'equality':
+            constraints[selector._field] = constraint
+    return constraints
+
+
+def _selector_fields(selector: Selector):
+    """Yields the fields a selector tree applies on."""
+    if isinstance(selector, (And, Or)):
+        for sub_selector in selector._selectors:
+            yield from _selector_fields(sub_selector)
+    else:
+        yield selector._field
+
+
+def _serves_sort(keys: list, sort: tuple) -> bool:
+    """Whether index keys are read in the sort order, forward or back."""
+    if not sort or len(keys) < len(sort):
+        return False
+    same = reverse = True
+    for (field, _type, order), (sort_field, direction) in zip(keys, sort):
+        if field != sort_field:
+            return False
+        same = same and order == direction
+        reverse = reverse and order != direction
+    return same or reverse
+
+
+def _choose_index(indexes: list, constraints: dict,
+                  sort: tuple=()) -> tuple:
+    """
+        Returns the name of the index that best serves the constraints of a
+        query, and the number of indexes that could serve it.
+
+        An index serves a query with the leftmost prefix of its keys: first
+        the keys searched by equality, then a single key searched by range,
+        the following keys saving a sort step if they match the sort order.
+        The longest prefix wins, ties going to the smallest index.
+    """
+    if constraints.get('_id') == 'equality':
+        # A lookup by rowid beats any index.
+        return None, 0
+
+    best_index = None
+    best_score = None
+    candidates = 0
+    partial_scores = []
+    for index in indexes:
+        if index.get('state') == 'building':
+            continue
+
+        fields = [key[0] for key in index['keys']]
+        equalities = 0
+        for field in fields:
+            if constraints.get(field) != 'equality':
+                break
+            equalities += 1
+        ranged = (
+            equalities < len(fields) and
+            constraints.get(fields[equalities]) == 'range'
+        )
+        ordered = _serves_sort(index['keys'][equalities:], sort)
+        if not equalities and not ranged and not ordered:
+            continue
+
+        score = (equalities, ranged, ordered, -len(fields))
+        if 'partial_filter' in index:
+            partial_scores.append(score)
+            continue
+
+        candidates += 1
+        if best_score is None or score > best_score:
+            best_index = index['name']
+            best_score = score
+
+    # Whether the query implies the filter of a partial index depends on
+    # the values it is run with, which SQLite knows better than a plan.
+    if any(
+        best_score is None or score >= best_score for score in partial_scores
+    ):
+        return None, 0
+    return best_index, candidates
+
+
+class QueryPlan:
+    """
+        The compiled form of a query shape.
+
+        A plan holds the SQL statement of a query, the slots of the query
+        values to bind to it, the selectors that remain to be matched in
+        Python and the projection to apply on matching documents.
+        Queries that only differ by their values share the same plan.
+    """
+    __slots__ = (
+        '_covered_fields', '_exclude_fields', '_include_fields', '_index',
+        '_limited', '_projected', '_python_sort', '_query_tree',
+        '_select_id', '_skipped', '_slots', '_sql', '_with_id',
+    )
+
+    def __init__(self, sql: str, slots: list, query_tree: And,
+                 include_fields: set=None, exclude_fields: set=None,
+                 covered_fields: tuple=(), limited: bool=False,
+                 skipped: bool=False, select_id: bool=False,
+                 with_id: bool=False, index: str=None,
+                 python_sort: tuple=(), projected: bool=False) -> None:
+        self._sql = sql
+        self._slots = slots
+        self._query_tree = query_tree
+        self._include_fields = include_fields or set()
+        self._exclude_fields = exclude_fields or set()
+        # The projected fields, in the order of the columns selected to
+        # build documents without decoding them, if the query is covered.
+        self._covered_fields = covered_fields
+        self._limited = limited
+        self._skipped = skipped
+        # Whether rows start with the document id, and whether it is
+        # kept in returned documents as their "_id" field.
+        self._select_id = select_id
+        self._with_id = with_id
+        # The index chosen by the planner, if any.
+        self._index = index
+        # The sort keys SQLite can not order documents by.
+        self._python_sort = python_sort
+        # Whether SQLite only returns the projected part of documents.
+        self._projected = projected
+
+
 class SelectQuery:
     __slots__ = (
-        '_collection', '_exclude_fields', '_include_fields',
-        '_indexed_fields', '_limit', '_query_tree',
+        '_cached', '_collection', '_limit', '_plan', '_skip', '_values'
     )
 
     def __init__(self, collection, indexed_fields: set,
-                 query: dict, projection: dict=None, limit: int=None) -> None:
+                 query: dict, projection: dict=None, limit: int=None,
+                 pushdown: bool=False, skip: int=0,
+                 with_id: bool=False, sort=None) -> None:
         self._collection = collection
-        self._indexed_fields = set(indexed_fields)
         self._limit = limit
-        query = [{key: value} for key, value in query.items()]
-        self._query_tree = And(query)
-
-        self._include_fields = set()
-        self._exclude_fields = set()
-        if projection is None:
-            return
-        for field, presence in projection.items():
-            if presence == 1:
-                self._include_fields.add(field)
-            elif presence == 0:
-                self._exclude_fields.add(field)
-
-        if self._include_fields and self._exclude_fields:
-            msg = 'A projection can only include or exclude fields:\n {}'
-            raise BadProjection(msg.format(projection))
-
-    def match_many(self, documents: list) -> list:
-        # If all filters have been applyed on indexed field
-        # we can return the documents directly.
-        if not self._query_tree._selectors:
-            return list(documents)
-
-        return (
-            document for document in documents
-            if self._query_tree.match(document)
+        self._skip = skip
+        self._values = []
+        shape = _parse_query(query, self._values)
+        sort = _parse_sort(sort)
+
+        plan_key = (
+            'select', shape,
+            None if projection is None else tuple(projection.items()),
+            bool(limit), bool(skip), tuple(indexed_fields), pushdown,
+            with_id, sort,
         )
+        self._plan = collection._plans.get(plan_key)
+        self._cached = self._plan is not None
+        if self._plan is None:
+            self._plan = self._compile(
+                shape, set(indexed_fields), projection, bool(limit),
+                bool(skip), pushdown, with_id, sort
+            )
+            collection._plans.set(plan_key, self._plan)
+
+    def _compile(self, shape: tuple, indexed_fields: set, projection: dict,
+                 limited: bool, skipped: bool, pushdown: bool,
+                 with_id: bool, sort: tuple=()) -> QueryPlan:
+        include_fields, exclude_fields = _parse_projection(projection)
+        query_tree = _build_selector(shape, itertools.count())
+        index, candidates = _choose_index(
+            self._collection._indexes['indexes'],
+            _index_constraints(query_tree, indexed_fields, pushdown),
+            sort
+        )
+        where_clause = query_tree.split_sql(indexed_fields, pushdown)
+        with_id = (
+            (with_id or '_id' in include_fields) and
+            '_id' not in exclude_fields
+        )
+        if with_id and include_fields:
+            include_fields.add('_id')
+        python_sort = _python_sort(sort, indexed_fields, pushdown)
+        # Documents entirely built from indexed columns are never decoded,
+        # and SQLite reads them from an index covering the query if any.
+        covered_fields = ()
+        if include_fields and query_tree.is_empty() and not python_sort:
+            covered_fields = tuple(sorted(include_fields))
+            columns = [
+                _sql_column(field, indexed_fields, False)
+                for field in covered_fields
+            ]
+            if None in columns:
+                covered_fields = ()
+        # Documents matched in Python against an "_id" selector
+        # need to know their id.
+        select_id = not covered_fields and (
+            with_id or '_id' in set(_selector_fields(query_tree))
+        )
+        # Otherwise, documents that are neither matched nor sorted in
+        # Python are projected by SQLite before being decoded.
+        data = None
+        if (
+            not covered_fields and (include_fields or exclude_fields) and
+            pushdown is True and _JSON_ARROW and query_tree.is_empty() and
+            not python_sort
+        ):
+            data = _json_projection(include_fields, exclude_fields)
+        projected = data is not None
+        if data is None:
+            data = '_data'
 
-    def match_one(self, documents: list) -> dict:
-        if documents and self._query_tree.is_empty():
-            return list(documents)[0]
-
-        for document in documents:
-            if self._query_tree.match(document):
-                return document
+        select_query = ['SELECT']
+        slots = []
+        if covered_fields:
+            select_query.append(', '.join(columns))
+        elif select_id:
+            select_query.append('id, ' + data)
+        else:
+            select_query.append(data)
+        select_query += ['FROM', self._collection._name]
+        # SQLite is only told which index to use when several of them
+        # compete, as it lacks statistics to tell them apart.
+        if candidates > 1:
+            select_query += ['INDEXED BY', '"' + index + '"']
 
-    def _projection_is_index_only(self):
-        return (self._include_fields and self._include_fields.issubset(
-            self._indexed_fields)
+        if where_clause is not None:
+            select_query += ['WHERE', where_clause[0]]
+            slots = where_clause[1]
+
+        if sort and not python_sort:
+            order_by = [
+                _sql_sort_value(
+                    field, _sql_column(field, indexed_fields, pushdown)
+                ) + ' ' + direction
+                for field, direction in sort
+            ]
+            select_query += ['ORDER BY', ', '.join(order_by)]
+
+        # Documents can only be limited or skipped by SQLite if they
+        # don't need to be matched or sorted in Python afterwards.
+        sql_only = query_tree.is_empty() and not python_sort
+        limited = limited and sql_only
+        skipped = skipped and sql_only
+        if limited:
+            select_query.append('LIMIT ?')
+        elif skipped:
+            select_query.append('LIMIT -1')
+        if skipped:
+            select_query.append('OFFSET ?')
+
+        return QueryPlan(
+            ' '.join(select_query), slots, query_tree,
+            include_fields, exclude_fields, covered_fields, limited, skipped,
+            select_id, with_id, index, python_sort, projected
         )
 
     def _skim(self, document: dict) -> dict:
-        if self._include_fields:
-            new_document = {}
-            for field in self._include_fields:
-                value = _nested_get(document, field)
-                _nested_set(new_document, field, value)
-            return new_document
-        elif self._exclude_fields:
-            for field in self._exclude_fields:
-                _nested_pop(document, field)
-            return document
-        else:
-            return document
+        return _project(
+            document, self._plan._include_fields, self._plan._exclude_fields
+        )
 
-    def _sql_query(self) -> str:
-        select_query = ['SELECT']
-        where_clause = self._query_tree.sql(self._indexed_fields)
+    def _sql_query(self) -> tuple:
+        params = _bind(self._values, self._plan._slots)
+        if self._plan._limited:
+            params.append(self._limit)
+        if self._plan._skipped:
+            params.append(self._skip)
+        return self._plan._sql, params
+
+    def iterate(self, batch_size: int=DEFAULT_BATCH_SIZE):
+        """
+            Lazily yields the matching documents.
 
-        if (self._projection_is_index_only() and self._query_tree.is_empty()):
-            fields = ', '.join(
-                '"' + field + '"' for field in self._indexed_fields
+            Rows are fetched one batch at a time, so that SQLite stops
+            reading the collection as soon as enough documents matched.
+        """
+        sql_query, params = self._sql_query()
+        db = self._collection._db
+        connection = db._acquire()
+        try:
+            cursor = db._execute(sql_query, params, connection)
+        except BaseException:
+            db._release(connection)
+            raise
+        rows = _iter_rows(cursor, batch_size)
+        plan = self._plan
+        if plan._covered_fields:
+            documents = (
+                self._rebuild(plan._covered_fields, row) for row in rows
             )
-            select_query.append(fields)
         else:
-            select_query.append('_data')
-        select_query += ['FROM', self._collection._name]
+            if plan._select_id and not plan._with_id:
+                # Documents are matched against a copy holding their id,
+                # so that their own "_id" field is kept.
+                documents = (
+                    document for document, _id in (
+                        (json.loads(data), _id) for _id, data in rows
+                    )
+                    if plan._query_tree.match(
+                        _merge_id(dict(document), _id), self._values
+                    )
+                )
+            else:
+                if plan._select_id:
+                    documents = (
+                        _merge_id(json.loads(data), _id)
+                        for _id, data in rows
+                    )
+                else:
+                    documents = (json.loads(row[0]) for row in rows)
+                if not plan._query_tree.is_empty():
+                    documents = (
+                        document for document in documents
+                        if plan._query_tree.match(document, self._values)
+                    )
+            if plan._python_sort:
+                documents = _sort_documents(documents, plan._python_sort)
+            if not plan._projected:
+                documents = (self._skim(document) for document in documents)
+
+        if self._skip and not plan._skipped:
+            documents = itertools.islice(documents, self._skip, None)
+        if self._limit and not plan._limited:
+            documents = itertools.islice(documents, self._limit)
 
-        if where_clause is not None:
-            select_query += ['WHERE', where_clause]
+        try:
+            yield from documents
+        finally:
+            rows.close()
+            db._release(connection)
+
+    @staticmethod
+    def _rebuild(fields, row) -> dict:
+        """Builds a document from the values of indexed columns."""
+        document = {}
+        for field, value in zip(fields, row):
+            _nested_set(document, field, value)
+        return document
 
-        if self._limit and not self._query_tree._selectors:
-            select_query += ['LIMIT', str(self._limit)]
+    def execute(self):
+        documents = self.iterate()
+        try:
+            if self._limit == 1:
+                return next(documents, None)
+            return list(documents)
+        finally:
+            documents.close()
 
-        return ' '.join(select_query)
+    def count(self) -> int:
+        """
+            Counts the matching documents, with count(*) if SQLite applies
+            the whole query, or else without keeping them in memory.
+        """
+        if not self._plan._query_tree.is_empty():
+            documents = self.iterate()
+            try:
+                return sum(1 for document in documents)
+            finally:
+                documents.close()
+
+        sql_query, params = self._sql_query()
+        db = self._collection._db
+        connection = db._acquire()
+        try:
+            return db._execute(
+                'SELECT count(*) FROM (' + sql_query + ')', params,
+                connection
+            ).fetchone()[0]
+        finally:
+            db._release(connection)
 
-    def execute(self):
-        sql_query = self._sql_query()
-        result = self._collection._db._connection.execute(sql_query).fetchall()
-        if (self._projection_is_index_only() and self._query_tree.is_empty()):
-            # If the selection and the projection have been applied on
-            # indexed fields only, we have to rebuild a dictionary from
-            # the value of each returned row.
-            if result and self._limit == 1:
-                new_document = {}
-                for field, value in zip(self._include_fields, result[0]):
-                    _nested_set(new_document, field, value)
-                return new_document
-
-            documents = []
-            for row in result:
-                new_document = {}
-                for field, value in zip(self._include_fields, row):
-                    _nested_set(new_document, field, value)
-                documents.append(new_document)
-            return documents
-
-        partially_matching_documents = (json.loads(row[0]) for row in result)
-        if self._limit == 1:
-            matching_document = self.match_one(partially_matching_documents)
-            return self._skim(matching_document)
-        else:
-            matching_documents = self.match_many(partially_matching_documents)
-            return [self._skim(document) for document in matching_documents]
 
+class Cursor:
+    """
+        A lazy iterator over the documents matching a query.
 
-class ReplaceQuery:
+        Rows are fetched from SQLite `batch_size` at a time and documents
+        are decoded and matched one batch after the other, so iterating
+        over a large collection uses a flat amount of memory.
+        A cursor can be configured until its first document is read.
+    """
     __slots__ = (
-        '_collection', '_indexed_fields', '_query_tree',
-        '_replacement', '_upsert'
+        '_batch_size', '_collection', '_documents', '_limit',
+        '_projection', '_query', '_skip', '_sort', '_with_id',
     )
 
-    def __init__(self, collection, indexed_fields: set, query: dict,
-                 replacement: dict, upsert: bool) -> None:
+    def __init__(self, collection, query: dict, projection: dict=None,
+                 limit: int=None, with_id: bool=False, sort=None,
+                 skip: int=0) -> None:
         self._collection = collection
-        self._indexed_fields = set(indexed_fields)
-        self._replacement = replacement
-        self._upsert = upsert
-        query = [{key: value} for key, value in query.items()]
-        self._query_tree = And(query)
+        self._query = query
+        self._projection = projection
+        self._limit = limit
+        self._with_id = with_id
+        self._sort = sort
+        self._skip = skip
+        self._batch_size = DEFAULT_BATCH_SIZE
+        self._documents = None
+
+    def _check_not_started(self) -> None:
+        if self._documents is not None:
+            raise InvalidOperation(
+                'A cursor can not be modified once iterated.'
+            )
 
-    def _match_one(self, documents: list) -> dict:
-        if self._query_tree.is_empty():
-            documents = list(documents)
-            if documents:
-                return documents[0]
+    def batch_size(self, batch_size: int) -> 'Cursor':
+        self._check_not_started()
+        self._batch_size = batch_size
+        return self
 
-        for _id, document in documents:
-            if self._query_tree.match(document):
-                return (_id, document)
+    def limit(self, limit: int) -> 'Cursor':
+        self._check_not_started()
+        self._limit = limit
+        return self
+
+    def skip(self, skip: int) -> 'Cursor':
+        self._check_not_started()
+        self._skip = skip
+        return self
+
+    def sort(self, sort) -> 'Cursor':
+        self._check_not_started()
+        self._sort = sort
+        return self
+
+    def __iter__(self) -> 'Cursor':
+        return self
+
+    def __next__(self) -> dict:
+        if self._documents is None:
+            collection = self._collection
+            select_query = SelectQuery(
+                collection, collection._indexed_fields, self._query,
+                self._projection, self._limit, collection._pushdown(),
+                self._skip, self._with_id, self._sort
+            )
+            self._documents = select_query.iterate(self._batch_size)
+        return next(self._documents)
+
+    def close(self) -> None:
+        """Releases the SQLite statement before the cursor is exhausted."""
+        if self._documents is not None:
+            self._documents.close()
+        self._documents = iter(())
+
+    def __enter__(self) -> 'Cursor':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+
+_STAGES = ('$group', '$limit', '$match', '$project', '$sort')
+_ACCUMULATORS = ('$avg', '$count', '$max', '$min', '$sum')
+
+
+def _parse_pipeline(pipeline: list) -> list:
+    """Returns the (stage, specification) pairs of a pipeline."""
+    stages = []
+    for stage in pipeline:
+        if not isinstance(stage, dict) or len(stage) != 1:
+            raise BadQuery('Invalid pipeline stage: {}'.format(stage))
+        (name, spec), = stage.items()
+        if name not in _STAGES:
+            raise BadQuery('Unknown pipeline stage: {}'.format(name))
+        if name == '$group':
+            spec = _parse_group(spec)
+        elif name == '$limit':
+            if type(spec) is not int or spec < 1:
+                raise BadQuery('Invalid limit: {}'.format(spec))
+        elif name == '$project':
+            spec = _parse_projection(spec)
+        elif name == '$sort':
+            spec = _parse_sort(spec)
+        stages.append((name, spec))
+    return stages
+
+
+def _field_reference(operand) -> str:
+    """Returns the field referenced by a "$field" operand, or None."""
+    if isinstance(operand, str) and operand.startswith('$'):
+        return operand[1:]
+
+
+def _parse_group(spec: dict) -> tuple:
+    """
+        Returns the keys and the accumulators of a $group stage.
 
-        return (None, None)
+        Keys are (name, field) pairs, named only when the group id is a
+        document, and accumulators are (name, operator, operand) triples
+        whose operand is a field name or a numeric constant.
+    """
+    if not isinstance(spec, dict) or '_id' not in spec:
+        raise BadQuery('A $group stage requires an _id: {}'.format(spec))
+
+    group_id = spec['_id']
+    if group_id is None:
+        keys = ()
+    elif isinstance(group_id, dict):
+        keys = tuple(
+            (name, _field_reference(operand))
+            for name, operand in group_id.items()
+        )
+    else:
+        keys = ((None, _field_reference(group_id)),)
+    if any(field is None for name, field in keys):
+        raise BadQuery('Groups are keyed by "$field": {}'.format(group_id))
+
+    accumulators = []
+    for name, expression in spec.items():
+        if name == '_id':
+            continue
+        if not (
+            isinstance(expression, dict) and len(expression) == 1 and
+            next(iter(expression)) in _ACCUMULATORS and '.' not in name
+        ):
+            raise BadQuery('Invalid accumulator: {}'.format(expression))
+        (operator, operand), = expression.items()
+        if operator == '$count':
+            operand = None
+        elif _field_reference(operand) is not None:
+            operand = _field_reference(operand)
+        elif not isinstance(operand, (int, float)) or (
+            isinstance(operand, bool)
+        ):
+            raise BadQuery('Invalid accumulator: {}'.format(expression))
+        accumulators.append((name, operator, operand))
+    return keys, tuple(accumulators)
+
+
+def _group_id(keys: tuple, values: tuple):
+    if not keys:
+        return None
+    elif keys[0][0] is None:
+        return values[0]
+    return {name: value for (name, field), value in zip(keys, values)}
 
-    def _sql_query(self) -> str:
-        select_query = ['SELECT id, _data FROM', self._collection._name]
-        where_clause = self._query_tree.sql(self._indexed_fields)
 
-        if where_clause is not None:
-            select_query += ['WHERE', where_clause]
+def _sql_sort_value(field: str, column: str) -> str:
+    """
+        Returns the SQL expression of a field ordered as Python does.
 
-        if self._query_tree.is_empty():
-            # If selectors only apply on indexed field, return only 1 document
-            select_query.append('LIMIT 1')
+        Arrays and objects are extracted as JSON texts, but are ordered
+        after texts in Python: blobs are too in SQLite.
+    """
+    json_type = _json_type(field, column)
+    if json_type is None:
+        return column
+    return (
+        "CASE WHEN {0} IN ('array', 'object') "
+        'THEN CAST({1} AS BLOB) ELSE {1} END'
+    ).format(json_type, column)
 
-        return ' '.join(select_query)
 
-    def execute(self):
-        sql_query = self._sql_query()
-        result = self._collection._db._connection.execute(sql_query).fetchall()
-        partially_matching_documents = (
-            (_id, json.loads(data)) for _id, data in result
+def _sql_accumulator(operator: str, operand, indexed_fields: set,
+                     pushdown) -> str:
+    """
+        Returns the SQL aggregate of an accumulator, or None if its field
+        can only be read from the decoded document in Python.
+    """
+    if operator == '$count':
+        return 'count(*)'
+    elif not isinstance(operand, str):
+        literal = _sql_literal(operand)
+        return 'sum(' + literal + ')' if operator == '$sum' else literal
+
+    column = _sql_column(operand, indexed_fields, pushdown)
+    if column is None:
+        return None
+    elif operator in ('$min', '$max'):
+        column = _sql_sort_value(operand, column)
+        return operator[1:] + '(' + column + ')'
+    # Values that are not numbers are ignored, as in Python.
+    number = "CASE WHEN typeof({0}) IN ('integer', 'real') THEN {0} END"
+    if operator == '$sum':
+        return 'coalesce(sum(' + number.format(column) + '), 0)'
+    return 'avg(' + number.format(column) + ')'
+
+
+def _decode_json(value):
+    """Decodes a value extracted as JSON, which is NULL when missing."""
+    if value is not None:
+        return json.loads(value)
+
+
+def _decode_group_value(value, decoder, row: tuple):
+    """
+        Restores the type of a grouped value or extreme value read by
+        SQLite: a `decoder` is either a function, or the position of the
+        extreme boolean of an accumulator in the `row`.
+    """
+    if decoder is None:
+        return value
+    elif not isinstance(decoder, int):
+        return decoder(value)
+    elif isinstance(value, bytes):
+        return json.loads(value)
+    elif row[decoder] is not None and row[decoder] == value:
+        return bool(value)
+    return value
+
+
+def _hashable(value):
+    """Returns a value that identifies a document value in a set."""
+    if isinstance(value, (dict, list)):
+        return _encode_document(value)
+    return value
+
+
+def _group_documents(documents, keys: tuple, accumulators: tuple):
+    """
+        Groups documents in Python, keeping only the running state of the
+        accumulators of each group.
+    """
+    groups = {}
+    for document in documents:
+        values = tuple(_nested_get(document, field) for name, field in keys)
+        group_key = tuple(_hashable(value) for value in values)
+        group = groups.get(group_key)
+        if group is None:
+            # The total, the count and the extreme value of accumulators.
+            group = groups[group_key] = (
+                values, [[0, 0, None] for _ in accumulators]
+            )
+        for (name, operator, operand), state in zip(accumulators, group[1]):
+            if operator == '$count':
+                state[1] += 1
+                continue
+            value = (
+                _nested_get(document, operand) if isinstance(operand, str)
+                else operand
+            )
+            if operator in ('$min', '$max'):
+                if value is not None and (
+                    state[2] is None or
+                    (_sort_key(value) < _sort_key(state[2])) ==
+                    (operator == '$min')
+                ):
+                    state[2] = value
+            elif isinstance(value, (int, float)):
+                state[0] += value
+                state[1] += 1
+
+    for values, states in groups.values():
+        document = {'_id': _group_id(keys, values)}
+        for (name, operator, operand), (total, count, extreme) in zip(
+            accumulators, states
+        ):
+            if operator == '$count':
+                document[name] = count
+            elif operator == '$sum':
+                document[name] = total
+            elif operator == '$avg':
+                document[name] = total / count if count else None
+            else:
+                document[name] = extreme
+        yield document
+
+
+def _run_stage(documents, stage: str, spec):
+    """Runs a pipeline stage in Python on a stream of documents."""
+    if stage == '$match':
+        values = []
+        query_tree = _build_selector(
+            _parse_query(spec, values), itertools.count()
+        )
+        return (
+            document for document in documents
+            if query_tree.match(document, values)
+        )
+    elif stage == '$group':
+        return _group_documents(documents, *spec)
+    elif stage == '$limit':
+        return itertools.islice(documents, spec)
+    elif stage == '$project':
+        return (_project(document, *spec) for document in documents)
+    return iter(_sort_documents(documents, spec))
+
+
+class AggregateQuery:
+    """
+        An aggregation pipeline.
+
+        Its leading stages are compiled to a single SQL statement as long
+        as SQLite can run them: $match stages make its WHERE clause, and
+        a $group stage over indexed columns and json_extract() expressions
+        its GROUP BY clause. The following stages run in Python, on the
+        stream of documents returned by SQLite.
+    """
+    __slots__ = ('_collection', '_indexed_fields', '_pushdown', '_stages')
+
+    def __init__(self, collection, indexed_fields: set, pipeline: list,
+                 pushdown: bool=False) -> None:
+        self._collection = collection
+        self._indexed_fields = set(indexed_fields)
+        self._pushdown = pushdown
+        self._stages = _parse_pipeline(pipeline)
+
+    def _compile_group(self, query: dict, stages: list) -> tuple:
+        """
+            Returns the SQL statement and parameters grouping the documents
+            matching a query, along with the number of stages it runs, or
+            None if the documents must be grouped in Python.
+        """
+        values = []
+        query_tree = _build_selector(
+            _parse_query(query, values), itertools.count()
+        )
+        where_clause = query_tree.split_sql(
+            self._indexed_fields, self._pushdown
+        )
+        if not query_tree.is_empty():
+            return None
+
+        keys, accumulators = stages[0][1]
+        key_columns = [
+            _sql_column(field, self._indexed_fields, self._pushdown)
+            for name, field in keys
+        ]
+        if None in key_columns:
+            return None
+
+        # json_extract() returns booleans as integers and documents as
+        # JSON texts, so their values are decoded from JSON, or told
+        # apart by a hidden column, to keep the types Python returns.
+        columns = []
+        decoders = []
+        hidden_columns = []
+        for (name, field), column in zip(keys, key_columns):
+            if _json_type(field, column) is None:
+                decoders.append(None)
+            elif not _JSON_ARROW:
+                return None
+            else:
+                column = '_data -> ' + _json_path(field)
+                decoders.append(_decode_json)
+            columns.append(column)
+        for name, operator, operand in accumulators:
+            column = _sql_accumulator(
+                operator, operand, self._indexed_fields, self._pushdown
+            )
+            if column is None:
+                return None
+            columns.append(column)
+            json_type = None
+            if operator in ('$min', '$max') and isinstance(operand, str):
+                json_type = _json_type(operand, _sql_column(
+                    operand, self._indexed_fields, self._pushdown
+                ))
+            if json_type is None:
+                decoders.append(None)
+                continue
+            # The extreme boolean, which is the extreme value if equal.
+            decoders.append(len(keys) + len(accumulators) + len(
+                hidden_columns
+            ))
+            hidden_columns.append(
+                "{}(CASE WHEN {} IN ('true', 'false') THEN {} END)".format(
+                    operator[1:], json_type, _json_extract(operand)
+                )
+            )
+        columns += hidden_columns
+        if not keys:
+            # Tells an empty collection from a group of documents.
+            columns.append('count(*)')
+
+        select_query = [
+            'SELECT', ', '.join(columns), 'FROM', self._collection._name
+        ]
+        params = []
+        if where_clause is not None:
+            select_query += ['WHERE', where_clause[0]]
+            params = _bind(values, where_clause[1])
+        if keys:
+            select_query += ['GROUP BY', ', '.join(key_columns)]
+
+        # Groups are sorted and limited by SQLite too, by their grouped
+        # values, or referring to the position of their accumulators in
+        # the results.
+        positions = {
+            '_id' if name is None else '_id.' + name: _sql_sort_value(
+                field, column
+            )
+            for (name, field), column in zip(keys, key_columns)
+        }
+        positions.update(
+            (name, str(position))
+            for position, (name, operator, operand) in enumerate(
+                accumulators, len(keys) + 1
+            )
         )
-        _id, matching_document = self._match_one(partially_matching_documents)
+        compiled = 1
+        if compiled < len(stages) and stages[compiled][0] == '$sort':
+            sort = stages[compiled][1]
+            if all(field in positions for field, direction in sort):
+                select_query += ['ORDER BY', ', '.join(
+                    positions[field] + ' ' + direction
+                    for field, direction in sort
+                )]
+                compiled += 1
+        if compiled < len(stages) and stages[compiled][0] == '$limit':
+            select_query.append('LIMIT ?')
+            params.append(stages[compiled][1])
+            compiled += 1
+        return ' '.join(select_query), params, decoders, compiled
+
+    def _group_in_sql(self, sql_query: str, params: list, decoders: list,
+                      keys: tuple, accumulators: tuple):
+        db = self._collection._db
+        connection = db._acquire()
+        try:
+            cursor = db._execute(sql_query, params, connection)
+        except BaseException:
+            db._release(connection)
+            raise
+        rows = _iter_rows(cursor, DEFAULT_BATCH_SIZE)
+        try:
+            for row in rows:
+                if not keys and not row[-1]:
+                    continue
+                values = [
+                    _decode_group_value(value, decoder, row)
+                    for value, decoder in zip(row, decoders)
+                ]
+                document = {'_id': _group_id(keys, values)}
+                for (name, operator, operand), value in zip(
+                    accumulators, values[len(keys):]
+                ):
+                    document[name] = value
+                yield document
+        finally:
+            rows.close()
+            db._release(connection)
+
+    def _find(self, query: dict, stages: list) -> tuple:
+        """
+            Returns the documents matching a query, along with the number
+            of the following $sort, $limit and $project stages applied by
+            a select query.
+        """
+        compiled = 0
+        options = {}
+        for stage in ('$sort', '$limit', '$project'):
+            if compiled < len(stages) and stages[compiled][0] == stage:
+                options[stage] = stages[compiled][1]
+                compiled += 1
+
+        projection = None
+        if '$project' in options:
+            include_fields, exclude_fields = options['$project']
+            projection = dict.fromkeys(include_fields, 1)
+            projection.update(dict.fromkeys(exclude_fields, 0))
+        elif stages and stages[0][0] == '$group':
+            # Documents grouped in Python only need the grouped fields.
+            keys, accumulators = stages[0][1]
+            projection = dict.fromkeys(
+                [field for name, field in keys] + [
+                    operand for name, operator, operand in accumulators
+                    if isinstance(operand, str)
+                ], 1
+            )
+
+        select_query = SelectQuery(
+            self._collection, self._indexed_fields, query,
+            projection or None, options.get('$limit'), self._pushdown,
+            sort=list(options.get('$sort', ()))
+        )
+        return select_query.iterate(), compiled
+
+    def iterate(self):
+        """Lazily yields the documents output by the pipeline."""
+        matches = 0
+        while matches < len(self._stages) and (
+            self._stages[matches][0] == '$match'
+        ):
+            matches += 1
+        queries = [spec for stage, spec in self._stages[:matches]]
+        stages = self._stages[matches:]
+        query = queries[0] if len(queries) == 1 else (
+            {'$and': queries} if queries else {}
+        )
+
+        compiled = None
+        if stages and stages[0][0] == '$group':
+            compiled = self._compile_group(query, stages)
+        if compiled is not None:
+            sql_query, params, decoders, compiled = compiled
+            source = self._group_in_sql(
+                sql_query, params, decoders, *stages[0][1]
+            )
+        else:
+            source, compiled = self._find(query, stages)
+
+        documents = source
+        for stage, spec in stages[compiled:]:
+            documents = _run_stage(documents, stage, spec)
+        try:
+            yield from documents
+        finally:
+            source.close()
+
+    def execute(self) -> list:
+        return list(self.iterate())
+
+
+class DistinctQuery:
+    """
+        The distinct values of a field among the documents matching a query.
+
+        SQLite returns them with SELECT DISTINCT, walking the index of the
+        field if any, unless documents must be matched in Python: values
+        are then yielded as soon as they are first seen.
+    """
+    __slots__ = (
+        '_collection', '_field', '_indexed_fields', '_pushdown', '_query'
+    )
+
+    def __init__(self, collection, indexed_fields: set, field: str,
+                 query: dict=None, pushdown: bool=False) -> None:
+        self._collection = collection
+        self._indexed_fields = set(indexed_fields)
+        self._field = field
+        self._query = query or {}
+        self._pushdown = pushdown
+
+    def _column(self) -> tuple:
+        """
+            Returns the SQL expression of the field and whether its values
+            are JSON texts to decode, or None if it is only read in Python.
+        """
+        field = self._field
+        path = _json_path(field)
+        if (
+            self._pushdown is True and _JSON_ARROW and path is not None and
+            field not in self._indexed_fields and field != '_id' and
+            field not in self._collection._expression_fields
+        ):
+            # Values are extracted as JSON, so that they keep their type.
+            return '_data -> ' + path, True
+        column = _sql_column(field, self._indexed_fields, self._pushdown)
+        if column is not None:
+            return column, False
+
+    def _iterate_in_sql(self, column: str, decode: bool,
+                        where_clause: tuple, values: list):
+        conditions = [column + ' IS NOT NULL']
+        params = []
+        if where_clause is not None:
+            conditions.insert(0, where_clause[0])
+            params = _bind(values, where_clause[1])
+        sql_query = ' '.join((
+            'SELECT DISTINCT', column, 'FROM', self._collection._name,
+            'WHERE', ' AND '.join(conditions)
+        ))
+
+        db = self._collection._db
+        connection = db._acquire()
+        try:
+            cursor = db._execute(sql_query, params, connection)
+        except BaseException:
+            db._release(connection)
+            raise
+        rows = _iter_rows(cursor, DEFAULT_BATCH_SIZE)
+        try:
+            for row in rows:
+                value = json.loads(row[0]) if decode else row[0]
+                if value is not None:
+                    yield value
+        finally:
+            rows.close()
+            db._release(connection)
+
+    def _iterate_in_python(self):
+        select_query = SelectQuery(
+            self._collection, self._indexed_fields, self._query,
+            {self._field: 1}, pushdown=self._pushdown
+        )
+        seen = set()
+        documents = select_query.iterate()
+        try:
+            for document in documents:
+                value = _nested_get(document, self._field)
+                # Values of different types are distinct, as they are in
+                # JSON, even when equal in Python, like True and 1.
+                key = (type(value), _hashable(value))
+                if value is not None and key not in seen:
+                    seen.add(key)
+                    yield value
+        finally:
+            documents.close()
+
+    def iterate(self):
+        """Lazily yields the distinct values."""
+        values = []
+        query_tree = _build_selector(
+            _parse_query(self._query, values), itertools.count()
+        )
+        where_clause = query_tree.split_sql(
+            self._indexed_fields, self._pushdown
+        )
+        column = self._column()
+        if column is None or not query_tree.is_empty():
+            return self._iterate_in_python()
+        return self._iterate_in_sql(*column, where_clause, values)
+
+    def execute(self) -> list:
+        return list(self.iterate())
+
+
+class ReplaceQuery:
+    __slots__ = (
+        '_collection', '_indexed_fields', '_plan', '_replacement',
+        '_upsert', '_values',
+    )
+
+    def __init__(self, collection, indexed_fields: set, query: dict,
+                 replacement: dict, upsert: bool,
+                 pushdown: bool=False) -> None:
+        self._collection = collection
+        self._indexed_fields = indexed_fields
+        self._replacement = replacement
+        self._upsert = upsert
+        self._values = []
+        shape = _parse_query(query, self._values)
+
+        plan_key = ('replace', shape, tuple(indexed_fields), pushdown)
+        self._plan = collection._plans.get(plan_key)
+        if self._plan is None:
+            self._plan = self._compile(shape, set(indexed_fields), pushdown)
+            collection._plans.set(plan_key, self._plan)
+
+    def _compile(self, shape: tuple, indexed_fields: set,
+                 pushdown: bool) -> QueryPlan:
+        query_tree = _build_selector(shape, itertools.count())
+        where_clause = query_tree.split_sql(indexed_fields, pushdown)
+
+        select_query = ['SELECT id, _data FROM', self._collection._name]
+        slots = []
+        if where_clause is not None:
+            select_query += ['WHERE', where_clause[0]]
+            slots = where_clause[1]
+
+        if query_tree.is_empty():
+            # If selectors only apply on indexed field, return only 1 document
+            select_query.append('LIMIT 1')
+
+        return QueryPlan(' '.join(select_query), slots, query_tree)
+
+    def _match_one(self, rows) -> tuple:
+        query_tree = self._plan._query_tree
+        for _id, data in rows:
+            document = _merge_id(json.loads(data), _id)
+            if query_tree.match(document, self._values):
+                return (_id, document)
+
+        return (None, None)
+
+    def _sql_query(self) -> tuple:
+        params = _bind(self._values, self._plan._slots)
+        return self._plan._sql, params
+
+    def execute(self):
+        sql_query, params = self._sql_query()
+        cursor = self._collection._db._execute(sql_query, params)
+        rows = _iter_rows(cursor, DEFAULT_BATCH_SIZE)
+        try:
+            _id, matching_document = self._match_one(rows)
+        finally:
+            rows.close()
 
         if matching_document is None:
             if self._upsert:
                 return self._collection.insert_one(self._replacement)
             return
 
-        fields = ['_data']
-        values = [json.dumps(self._replacement)]
-        if self._indexed_fields:
-            fields += self._indexed_fields
-            values += [
-                _nested_get(self._replacement, field)
-                for field in self._indexed_fields
-            ]
-        formated_fields = ['"' + field + '"' for field in fields]
+        # Columns of indexes still being built are updated as well.
+        formated_fields = (
+            ['"_data"'] + self._collection._formated_indexed_fields
+        )
+        values = [_encode_document(self._replacement)]
+        values += [
+            _path_get(self._replacement, path)
+            for path in self._collection._index_paths
+        ]
         fields_to_update = ' = ?, '.join(formated_fields)
         fields_to_update += ' = ?'
         values.append(_id)
@@ -457,7 +2100,7 @@ class ReplaceQuery:
             self._collection._name,
             fields_to_update,
         )
-        self._collection._db._connection.execute(update_query, values)
+        self._collection._db._execute(update_query, values)
 
 
 class CreateIndexQuery:
@@ -473,6 +2116,8 @@ class CreateIndexQuery:
         self._collection = collection
         self._keys = keys
         self._options = kwargs
+        # Rejects a bad partial filter before the collection is altered.
+        self._prepare_partial_filter(())
 
     def _prepare_index_keys(self, keys: list) -> list:
         """
@@ -498,8 +2143,15 @@ class CreateIndexQuery:
         return index_keys
 
     def _prepare_index_columns(self, index_keys: list) -> list:
-        """Create a new column for non-indexed fields."""
+        """
+            Create a new column for non-indexed fields, and returns the
+            fields whose column is to be fed.
+
+            The column of an index still being built already exists, but
+            is fed again as its build may have been interrupted.
+        """
         indexed_fields = self._collection._indexes['indexed_fields']
+        formated_indexed_fields = self._collection._formated_indexed_fields
         keys_to_index = [
             key for key in index_keys
             if key[0] not in indexed_fields
@@ -508,81 +2160,244 @@ class CreateIndexQuery:
             ('ALTER TABLE ', self._collection._name, ' ADD COLUMN "{}" {}')
         )
         for field_name, _type, order in keys_to_index:
+            if '"' + field_name + '"' in formated_indexed_fields:
+                continue
             query = create_column_query.format(field_name, _type)
             self._collection._db._connection.execute(query)
 
         fields_to_index = [key[0] for key in keys_to_index]
         return fields_to_index
 
-    def _feed_index(self, indexed_fields: list) -> None:
-        row_number = self._collection._db._connection.execute(
-            'SELECT count(id) FROM ' + self._collection._name
-        ).fetchone()[0]
+    def _count_documents(self) -> tuple:
+        """
+            Returns the number of documents to feed and the last of their
+            ids, which must be read within a transaction on the writer
+            connection.
+        """
+        return self._collection._db._connection.execute(
+            'SELECT count(id), max(id) FROM ' + self._collection._name
+        ).fetchone()
 
-        if row_number == 0:
+    def _feed_index(self, indexed_fields: list, snapshot: tuple,
+                    commit: bool=False) -> None:
+        """
+            Copies the values of fields from documents to their new columns,
+            one chunk of `chunk_size` documents at a time, reporting the
+            number of documents done to the `progress` callback option.
+            Only the documents counted in the `snapshot` are fed, and with
+            `commit`, each chunk is committed on its own.
+        """
+        if not indexed_fields:
             return
 
-        formated_indexed_fields = [
+        db = self._collection._db
+        total, max_id = snapshot
+        if total == 0:
+            return
+
+        chunk_size = self._options.get('chunk_size', DEFAULT_CHUNK_SIZE)
+        progress = self._options.get('progress')
+        expressions = [_json_extract(field) for field in indexed_fields]
+        if self._collection._db._json1 and None not in expressions:
+            feed_chunk = self._feed_chunk_in_sql
+        else:
+            feed_chunk = self._feed_chunk_in_python
+
+        # Documents are walked through by id, so that each chunk starts
+        # with an index lookup whatever the size of the collection.
+        # Documents inserted meanwhile already have their values.
+        done = 0
+        last_id = 0
+        while last_id is not None:
+            if commit:
+                with db.transaction():
+                    count, last_id = feed_chunk(
+                        indexed_fields, last_id, max_id, chunk_size
+                    )
+            else:
+                count, last_id = feed_chunk(
+                    indexed_fields, last_id, max_id, chunk_size
+                )
+            done += count
+            if progress is not None and count:
+                progress(done, total)
+
+    def _feed_chunk_in_sql(self, indexed_fields: list, last_id: int,
+                           max_id: int, chunk_size: int) -> tuple:
+        """Lets SQLite copy the values of a chunk of documents."""
+        connection = self._collection._db._connection
+        name = self._collection._name
+        row = connection.execute(
+            'SELECT id FROM ' + name + ' WHERE id > ? '
+            'ORDER BY id LIMIT 1 OFFSET ?', [last_id, chunk_size - 1]
+        ).fetchone()
+        next_id = row[0] if row is not None and row[0] < max_id else None
+
+        assignments = ', '.join(
+            '"' + field + '" = ' + _json_extract(field)
+            for field in indexed_fields
+        )
+        cursor = connection.execute(
+            'UPDATE ' + name + ' SET ' + assignments +
+            ' WHERE id > ? AND id <= ?',
+            [last_id, max_id if next_id is None else next_id]
+        )
+        return cursor.rowcount, next_id
+
+    def _feed_chunk_in_python(self, indexed_fields: list, last_id: int,
+                              max_id: int, chunk_size: int) -> tuple:
+        """Decodes a chunk of documents to copy their values."""
+        connection = self._collection._db._connection
+        name = self._collection._name
+        rows = connection.execute(
+            'SELECT id, _data FROM ' + name + ' WHERE id > ? AND id <= ? '
+            'ORDER BY id LIMIT ?', [last_id, max_id, chunk_size]
+        ).fetchall()
+        if not rows:
+            return 0, None
+
+        csv_fields = ' = ?, '.join(
             '"' + field + '"' for field in indexed_fields
-        ]
-        select_query = 'SELECT id, _data FROM ' + self._collection._name
-        csv_fields = ' = ?, '.join(formated_indexed_fields)
-        csv_fields += ' = ?'
+        )
         update_query = (
-            'UPDATE ' + self._collection._name
-            + ' SET ' + csv_fields + ' WHERE id = ?'
-        )
-        cursor = self._collection._db._connection.execute(select_query)
-        for _id, document in cursor.fetchall():
-            document = json.loads(document)
-            index_values = [
-                _nested_get(document, field) for field in indexed_fields
-            ]
-            index_values.append(_id)
-            self._collection._db._connection.execute(
-                update_query, index_values
+            'UPDATE ' + name + ' SET ' + csv_fields + ' = ? WHERE id = ?'
+        )
+        index_paths = [field.split('.') for field in indexed_fields]
+        connection.executemany(update_query, (
+            [_path_get(json.loads(document), path) for path in index_paths]
+            + [_id]
+            for _id, document in rows
+        ))
+        next_id = rows[-1][0] if rows[-1][0] < max_id else None
+        return len(rows), next_id
+
+    def _prepare_index_expressions(self, index_keys: list) -> list:
+        """
+            Returns the fields of an expression index that are read from
+            documents with json_extract(), rather than from a column.
+        """
+        if not self._collection._db._json1:
+            raise InvalidOperation(
+                'Expression indexes require the JSON1 extension.'
             )
+        indexed_fields = self._collection._indexes['indexed_fields']
+        expression_fields = []
+        for field, _type, order in index_keys:
+            if field in indexed_fields:
+                continue
+            if _json_extract(field) is None:
+                raise InvalidOperation(
+                    'Field {!r} can not be indexed by expression.'.format(
+                        field
+                    )
+                )
+            expression_fields.append(field)
+        return expression_fields
 
-    def execute(self):
-        index_keys = self._prepare_index_keys(self._keys)
-
-        # Check if the index already exists (all key are equivalent)
-        for index in self._collection._indexes['indexes']:
-            if index['keys'] == index_keys:
-                return
-
-        # Create a new column for non-indexed fields
-        new_indexed_fields = self._prepare_index_columns(index_keys)
-
-        # Copy data from document to new index column
-        self._feed_index(new_indexed_fields)
-
-        # Create the index
+    def _index_name(self, index_keys: list) -> str:
         index_name = self._options.get('name')
-        indexed_fields = [key[0] for key in index_keys]
         if index_name is None:
+            indexed_fields = [key[0] for key in index_keys]
             index_name = '_'.join((
                 self._collection._name, 'index', *indexed_fields
             ))
+            if self._options.get('unique'):
+                index_name += '_unique'
+            partial_filter = self._options.get('partial_filter')
+            if partial_filter:
+                digest = hashlib.sha1(
+                    json.dumps(partial_filter, sort_keys=True).encode()
+                )
+                index_name += '_partial_' + digest.hexdigest()[:8]
+        return index_name
+
+    def _is_same_index(self, index: dict, index_keys: list) -> bool:
+        return (
+            index['keys'] == index_keys and
+            index.get('unique', False) == bool(self._options.get('unique'))
+            and index.get('partial_filter') == (
+                self._options.get('partial_filter') or None
+            )
+        )
+
+    def _prepare_partial_filter(self, indexed_fields: list) -> str:
+        """
+            Returns the WHERE clause of a partial index, or None.
+
+            The partial filter is a query whose values are written in the
+            clause, as an index can not be created with bound parameters.
+        """
+        partial_filter = self._options.get('partial_filter')
+        if not partial_filter:
+            return None
+
+        values = []
+        shape = _parse_query(partial_filter, values)
+        if any('?' in field for field in _shape_fields(shape)):
+            raise BadQuery('Partial filter fields can not contain "?"')
+
+        query_tree = _build_selector(shape, itertools.count())
+        compiled = query_tree.sql(
+            set(indexed_fields), self._collection._db._json1
+        )
+        if compiled is None or any(
+            isinstance(values[slot], _SQL_LISTS) for slot in compiled[1]
+        ):
+            raise BadQuery(
+                'Partial filter can not be applied by SQLite: {}'.format(
+                    partial_filter
+                )
+            )
 
+        clause, slots = compiled
+        literals = [_sql_literal(values[slot]) for slot in slots]
+        parts = clause.split('?')
+        return ''.join(itertools.chain.from_iterable(
+            zip(parts, literals + [''])
+        ))
+
+    def _create_index(self, index_name: str, index_keys: list,
+                      expression_fields: list=()) -> None:
         formated_indexed_fields = [
-            '"' + field + '"' for field in indexed_fields
+            (
+                _json_extract(field) if field in expression_fields
+                else '"' + field + '"'
+            ) + ' ' + order
+            for field, _type, order in index_keys
         ]
         csv_fields = ', '.join(formated_indexed_fields)
-        create_index = 'CREATE INDEX IF NOT EXISTS "{}" ON {}({})'.format(
+        create_index = 'CREATE {}INDEX IF NOT EXISTS "{}" ON {}({})'.format(
+            'UNIQUE ' if self._options.get('unique') else '',
             index_name,
             self._collection._name,
             csv_fields
         )
-        self._collection._db._connection.execute(create_index)
+        where_clause = self._prepare_partial_filter(
+            self._collection._indexes['indexed_fields'] +
+            [key[0] for key in index_keys if key[0] not in expression_fields]
+        )
+        if where_clause is not None:
+            create_index += ' WHERE ' + where_clause
+        try:
+            self._collection._db._connection.execute(create_index)
+        except sqlite3.IntegrityError as error:
+            raise DuplicateKey(str(error)) from error
 
-        # Register the new index in the master table.
+    def _describe_index(self, index_name: str, index_keys: list) -> dict:
         index = {
             'name': index_name,
             'keys': index_keys,
         }
-        self._collection.register_index(index, new_indexed_fields)
-
+        if self._options.get('expression'):
+            index['expression'] = True
+        if self._options.get('unique'):
+            index['unique'] = True
+        if self._options.get('partial_filter'):
+            index['partial_filter'] = self._options['partial_filter']
+        return index
+
+    def _save_indexes(self) -> None:
+        """Saves the indexes of the collection in the master table."""
         json_indexes = json.dumps(self._collection._indexes)
         update_master = (
             'UPDATE plume_master SET indexes = ? '
@@ -592,18 +2407,110 @@ class CreateIndexQuery:
             update_master, [json_indexes]
         )
 
+    def execute(self):
+        index_keys = self._prepare_index_keys(self._keys)
+
+        # Check if the index already exists (all key are equivalent)
+        for index in self._collection._indexes['indexes']:
+            if self._is_same_index(index, index_keys):
+                if index.get('state') == 'building':
+                    # Completes an interrupted background build at once.
+                    self._feed_index(
+                        index['backfill'], self._count_documents()
+                    )
+                    self._ready_index(index, index_keys)
+                return
+
+        if self._options.get('expression'):
+            # The index is built on the documents themselves, so there is
+            # no column to create nor to feed.
+            new_indexed_fields = []
+            expression_fields = self._prepare_index_expressions(index_keys)
+        else:
+            # Create a new column for non-indexed fields
+            new_indexed_fields = self._prepare_index_columns(index_keys)
+            expression_fields = []
+
+            # Copy data from document to new index column
+            self._feed_index(new_indexed_fields, self._count_documents())
+
+        # Create the index
+        index_name = self._index_name(index_keys)
+        self._create_index(index_name, index_keys, expression_fields)
+
+        # Register the new index in the master table.
+        index = self._describe_index(index_name, index_keys)
+        self._collection.register_index(
+            index, new_indexed_fields, expression_fields
+        )
+        self._save_indexes()
+
+    def execute_in_background(self):
+        """
+            Builds an index without locking the collection for the whole
+            build: new columns are fed by chunks, each of them committed in
+            its own transaction so that writers can go on in between.
+
+            Until the index is ready, its columns are written along with
+            documents but the planner does not use them. An interrupted
+            build is resumed by creating the same index again, or completed
+            in a single transaction when created without `background`.
+        """
+        db = self._collection._db
+        index_keys = self._prepare_index_keys(self._keys)
+        with db.transaction():
+            for index in self._collection._indexes['indexes']:
+                if self._is_same_index(index, index_keys):
+                    break
+            else:
+                index = None
+
+            if index is None:
+                new_indexed_fields = self._prepare_index_columns(index_keys)
+                index = self._describe_index(
+                    self._index_name(index_keys), index_keys
+                )
+                index['state'] = 'building'
+                index['backfill'] = new_indexed_fields
+                self._collection.register_index(
+                    index, new_indexed_fields, ready=False
+                )
+                self._save_indexes()
+            elif index.get('state') != 'building':
+                return
+            # Documents inserted after this snapshot already have their
+            # values.
+            snapshot = self._count_documents()
+
+        self._feed_index(index['backfill'], snapshot, commit=True)
+
+        with db.transaction():
+            self._ready_index(index, index_keys)
+
+    def _ready_index(self, index: dict, index_keys: list) -> None:
+        """Creates the index of a complete build, and lets it be used."""
+        self._create_index(index['name'], index_keys)
+        self._collection.ready_index(index)
+        self._save_indexes()
+
 
 class Collection:
     __slots__ = (
-        '_db', '_formated_indexed_fields', '_indexed_fields',
-        '_indexes', '_name', '_registered'
+        '_db', '_expression_fields', '_formated_indexed_fields',
+        '_index_paths', '_indexed_fields', '_indexes', '_name', '_plans',
+        '_registered'
     )
 
     def __init__(self, db, name: str, **kwargs) -> None:
         self._db = db
         self._name = name
-        self._registered = kwargs.get('registered', False)
-        self._indexes = kwargs.get('indexes', {})
+        self._plans = _LRUCache(kwargs.get('cached_plans', 128))
+        self._load(kwargs.get('indexes', {}), kwargs.get('registered', False))
+
+    def _load(self, indexes: dict, registered: bool) -> None:
+        """Sets the indexes of the collection, as saved in the master table."""
+        self._registered = registered
+        self._indexes = indexes
         self._indexes.setdefault('indexes', [])
         self._indexed_fields = self._indexes.setdefault(
             'indexed_fields', []
@@ -611,6 +2518,14 @@ class Collection:
         self._formated_indexed_fields = self._indexes.setdefault(
             'formated_indexed_fields', []
         )
+        # Fields of expression indexes, which have no column.
+        self._expression_fields = self._indexes.get('expression_fields', [])
+        # Every column is written along with documents, including those
+        # of indexes still being built.
+        self._index_paths = [
+            field[1:-1].split('.') for field in self._formated_indexed_fields
+        ]
+        self._plans.clear()
 
     @transactional
     def _register(self):
@@ -629,24 +2544,58 @@ class Collection:
             ' VALUES (?)', (self._name,)
         )
 
-        self._db._collections[self._name] = self
+        self._db._collections.setdefault(self._name, self)
         self._registered = True
 
-    @transactional
     def create_index(self, keys: list, **kwargs) -> None:
+        """
+            Creates an index on the (field, type[, order]) keys.
+
+            With `background`, the collection is not locked for the whole
+            build, and the index is only used once completely built.
+            Expression indexes have no column to feed, and unique indexes
+            must check every document at once, so they are always built
+            in a single transaction.
+
+            A `unique` index rejects documents with DuplicateKey, and a
+            `partial_filter` query restricts an index to the documents
+            matching it.
+        """
+        if kwargs.get('background') and not (
+            kwargs.get('expression') or kwargs.get('unique')
+        ):
+            create_index_query = CreateIndexQuery(self, keys, **kwargs)
+            if not self._registered:
+                self._register()
+            return create_index_query.execute_in_background()
+        return self._create_index(keys, **kwargs)
+
+    @transactional
+    def _create_index(self, keys: list, **kwargs) -> None:
+        create_index_query = CreateIndexQuery(self, keys, **kwargs)
         if not self._registered:
             self._register()
 
-        create_index_query = CreateIndexQuery(self, keys, **kwargs)
         return create_index_query.execute()
 
-    def register_index(self, index: dict, new_indexed_fields: list) -> None:
+    def register_index(self, index: dict, new_indexed_fields: list,
+                       expression_fields: list=(),
+                       ready: bool=True) -> None:
         """Register a newly created index in Collection attributes."""
         self._indexes['indexes'].append(index)
-        self._indexes['indexed_fields'] += new_indexed_fields
+        if ready:
+            self._indexes['indexed_fields'] += new_indexed_fields
+        if expression_fields:
+            self._expression_fields += [
+                field for field in expression_fields
+                if field not in self._expression_fields
+            ]
+            self._indexes['expression_fields'] = self._expression_fields
 
+        # The columns of an index still being built may already exist.
         new_formated_indexed_fields = [
             '"' + field + '"' for field in new_indexed_fields
+            if '"' + field + '"' not in self._formated_indexed_fields
         ]
         self._indexes['formated_indexed_fields'] += (
             new_formated_indexed_fields
@@ -654,78 +2603,310 @@ class Collection:
         self._formated_indexed_fields = (
             self._indexes['formated_indexed_fields']
         )
+        self._index_paths += [
+            field[1:-1].split('.') for field in new_formated_indexed_fields
+        ]
+        # Query plans compiled without the new index are now outdated.
+        self._plans.clear()
+
+    def ready_index(self, index: dict) -> None:
+        """Lets the planner use an index whose build is complete."""
+        self._indexes['indexed_fields'] += [
+            field for field in index.pop('backfill')
+            if field not in self._indexes['indexed_fields']
+        ]
+        del index['state']
+        self._plans.clear()
+
+    def _pushdown(self):
+        """
+            Tells whether non-indexed fields are read by SQLite, or the set
+            of those that are: fields of expression indexes always are.
+        """
+        if self._db._pushdown or not self._db._json1:
+            return self._db._pushdown
+        return frozenset(self._expression_fields)
+
+    def explain(self, query: dict, projection: dict=None,
+                limit: int=None, sort=None, skip: int=0) -> dict:
+        """
+            Describes how a query is executed: its SQL statement and
+            parameters, the index chosen by the planner and the steps SQLite
+            takes, whether documents are also matched in Python and
+            whether its plan was already cached.
+        """
+        if not self._registered:
+            self._register()
+
+        select_query = SelectQuery(
+            self, self._indexed_fields, query, projection, limit,
+            self._pushdown(), skip, sort=sort
+        )
+        sql_query, params = select_query._sql_query()
+        connection = self._db._acquire()
+        try:
+            query_plan = [
+                row[3] for row in connection.execute(
+                    'EXPLAIN QUERY PLAN ' + sql_query, params
+                )
+            ]
+        finally:
+            self._db._release(connection)
+        return {
+            'cached': select_query._cached,
+            'sql': sql_query,
+            'params': params,
+            'index': select_query._plan._index,
+            'query_plan': query_plan,
+            'python_filter': not select_query._plan._query_tree.is_empty(),
+            'python_sort': bool(select_query._plan._python_sort),
+            'index_only': bool(select_query._plan._covered_fields),
+        }
 
     def find(self, query: dict, projection: dict=None,
-             limit: int=None) -> list:
+             limit: int=None, lazy: bool=False, with_id: bool=False,
+             sort=None, skip: int=0) -> list:
+        """
+            Retrieves the documents matching a query, sorted by the
+            (field, ASCENDING or DESCENDING) pairs of `sort`.
+        """
         if not self._registered:
             self._register()
 
+        if lazy:
+            return Cursor(self, query, projection, limit, with_id, sort, skip)
+
         select_query = SelectQuery(
-            self, self._indexed_fields, query, projection, limit
+            self, self._indexed_fields, query, projection, limit,
+            self._pushdown(), skip, with_id, sort
         )
         return select_query.execute()
 
-    def find_one(self, query: dict, projection: dict=None):
+    def find_by_id(self, _id: int) -> dict:
+        """Retrieves a document by its id, without any selector."""
+        if not self._registered:
+            self._register()
+
+        connection = self._db._acquire()
+        try:
+            row = self._db._execute(
+                'SELECT _data FROM ' + self._name + ' WHERE id = ?', [_id],
+                connection
+            ).fetchone()
+        finally:
+            self._db._release(connection)
+        if row is not None:
+            return json.loads(row[0])
+
+    def get_many(self, ids: list) -> list:
+        """
+            Retrieves documents by their ids, without any selector.
+
+            Documents are returned in the order of the given ids, with None
+            in place of the ids that do not exist.
+        """
+        if not self._registered:
+            self._register()
+
+        ids = list(ids)
+        documents = {}
+        connection = self._db._acquire()
+        try:
+            if self._db._json1:
+                select_query = (
+                    'SELECT id, _data FROM ' + self._name +
+                    ' WHERE id IN (SELECT value FROM json_each(?))'
+                )
+                documents.update(self._db._execute(
+                    select_query, [json.dumps(ids)], connection
+                ))
+            else:
+                for start in range(0, len(ids), MAX_VARIABLES):
+                    chunk = ids[start:start + MAX_VARIABLES]
+                    select_query = 'SELECT id, _data FROM {} WHERE id IN ({})'
+                    select_query = select_query.format(
+                        self._name, ', '.join(len(chunk) * ['?'])
+                    )
+                    documents.update(
+                        self._db._execute(select_query, chunk, connection)
+                    )
+        finally:
+            self._db._release(connection)
+
+        return [
+            json.loads(documents[_id]) if _id in documents else None
+            for _id in ids
+        ]
+
+    def find_one(self, query: dict, projection: dict=None,
+                 with_id: bool=False, sort=None):
         if not self._registered:
             self._register()
 
         select_query = SelectQuery(
-            self, self._indexed_fields, query, projection, 1
+            self, self._indexed_fields, query, projection, 1,
+            self._pushdown(), with_id=with_id, sort=sort
         )
         return select_query.execute()
 
-    @transactional
-    def insert_one(self, document: dict) -> None:
+    def aggregate(self, pipeline: list, lazy: bool=False) -> list:
+        """
+            Runs an aggregation pipeline of $match, $group, $sort, $limit
+            and $project stages. Groups accumulate fields with $sum, $avg,
+            $min, $max and $count.
+
+            With `lazy`, documents output by the pipeline are yielded one
+            at a time instead of being returned in a list.
+        """
         if not self._registered:
             self._register()
 
-        fields = ['_data']
-        values = [json.dumps(document)]
-        placeholders = ['?']
+        aggregate_query = AggregateQuery(
+            self, self._indexed_fields, pipeline, self._pushdown()
+        )
+        if lazy:
+            return aggregate_query.iterate()
+        return aggregate_query.execute()
 
-        if self._indexed_fields:
-            fields += self._formated_indexed_fields
-            values += (
-                _nested_get(document, field)
-                for field in self._indexed_fields
-            )
-            placeholders += (len(self._formated_indexed_fields) * ['?'])
+    def count(self, query: dict=None) -> int:
+        """
+            Counts the documents matching a query. Documents are only
+            decoded if they must be matched in Python.
+        """
+        if not self._registered:
+            self._register()
+
+        # Only ids are selected, from an index covering the query if any.
+        select_query = SelectQuery(
+            self, self._indexed_fields, query or {}, {'_id': 1},
+            pushdown=self._pushdown()
+        )
+        return select_query.count()
+
+    def exists(self, query: dict=None) -> bool:
+        """Tells whether a document matches a query."""
+        if not self._registered:
+            self._register()
+
+        select_query = SelectQuery(
+            self, self._indexed_fields, query or {}, {'_id': 1}, 1,
+            self._pushdown()
+        )
+        return select_query.execute() is not None
+
+    def distinct(self, field: str, query: dict=None,
+                 lazy: bool=False) -> list:
+        """
+            Retrieves the distinct values of a field among the documents
+            matching a query, documents missing the field aside.
+
+            With `lazy`, values are yielded one at a time instead of being
+            returned in a list.
+        """
+        if not self._registered:
+            self._register()
+
+        distinct_query = DistinctQuery(
+            self, self._indexed_fields, field, query, self._pushdown()
+        )
+        if lazy:
+            return distinct_query.iterate()
+        return distinct_query.execute()
+
+    def estimated_count(self) -> int:
+        """
+            Returns the number of documents of the collection from the
+            sequence of its ids kept by SQLite, without reading them.
+            It is exact as long as no document is deleted behind plume.
+        """
+        if not self._registered:
+            self._register()
 
-        insert_one_query = 'INSERT INTO {}({}) VALUES ({})'.format(
+        connection = self._db._acquire()
+        try:
+            row = self._db._execute(
+                'SELECT seq FROM sqlite_sequence WHERE name = ?',
+                [self._name], connection
+            ).fetchone()
+        finally:
+            self._db._release(connection)
+        return 0 if row is None else row[0]
+
+    def _insert_query(self) -> str:
+        fields = ['_data'] + self._formated_indexed_fields
+        return 'INSERT INTO {}({}) VALUES ({})'.format(
             self._name,
             ', '.join(fields),
-            ', '.join(placeholders)
+            ', '.join(len(fields) * ['?'])
         )
-        self._db._connection.execute(insert_one_query, values)
+
+    def _rows(self, documents):
+        """Yields the values to insert for each document."""
+        index_paths = self._index_paths
+        if not index_paths:
+            for document in documents:
+                yield (_encode_document(document),)
+            return
+
+        for document in documents:
+            row = [_encode_document(document)]
+            row += [_path_get(document, path) for path in index_paths]
+            yield row
 
     @transactional
-    def insert_many(self, documents: list) -> None:
+    def insert_one(self, document: dict) -> int:
+        """Inserts a document and returns its id."""
         if not self._registered:
             self._register()
 
-        fields = ['_data']
-        placeholders = ['?']
-        if not self._indexed_fields:
-            rows = [[json.dumps(document)] for document in documents]
-        else:
-            fields += self._formated_indexed_fields
-            placeholders += (len(self._formated_indexed_fields) * ['?'])
-            rows = []
-            for document in documents:
-                row = [json.dumps(document)]
-                row += (
-                    _nested_get(document, field)
-                    for field in self._indexed_fields
-                )
-                rows.append(row)
+        row = next(self._rows((document,)))
+        return self._db._execute(self._insert_query(), row).lastrowid
 
-        insert_query = 'INSERT INTO {}({}) VALUES ({})'.format(
-            self._name,
-            ', '.join(fields),
-            ', '.join(placeholders)
+    @transactional
+    def insert_many(self, documents) -> range:
+        """
+            Inserts documents from any iterable within a single transaction,
+            and returns the range of their ids.
+
+            Documents are encoded while SQLite inserts them, so a generator
+            of documents is never loaded in memory at once.
+        """
+        if not self._registered:
+            self._register()
+
+        cursor = self._db._executemany(
+            self._insert_query(), self._rows(documents)
         )
+        # The transaction prevents concurrent insertions, so ids
+        # of inserted documents are consecutive.
+        last_id = self._db._execute('SELECT last_insert_rowid()').fetchone()[0]
+        return range(last_id - cursor.rowcount + 1, last_id + 1)
+
+    @transactional
+    def _insert_chunk(self, rows) -> int:
+        cursor = self._db._executemany(self._insert_query(), rows)
+        return cursor.rowcount
 
-        self._db._connection.executemany(insert_query, rows)
+    def bulk_load(self, documents, chunk_size: int=DEFAULT_CHUNK_SIZE) -> int:
+        """
+            Inserts documents from any iterable, and commits them by chunks
+            of `chunk_size` documents.
+
+            Unlike insert_many(), the chunks committed before a failing one
+            stay in the collection. Returns the number of inserted documents.
+        """
+        if chunk_size < 1:
+            raise BadQuery('Invalid chunk size: {}'.format(chunk_size))
+        if not self._registered:
+            self._register()
+
+        rows = self._rows(documents)
+        count = 0
+        while True:
+            inserted = self._insert_chunk(itertools.islice(rows, chunk_size))
+            count += inserted
+            if inserted < chunk_size:
+                return count
 
     @transactional
     def replace_one(self, query: dict, replacement: dict, upsert: bool=False):
@@ -733,18 +2914,245 @@ class Collection:
             self._register()
 
         replace_query = ReplaceQuery(
-            self, self._indexed_fields, query, replacement, upsert
+            self, self._indexed_fields, query, replacement, upsert,
+            self._pushdown()
         )
         return replace_query.execute()
 
 
+class _GroupCommitCollection:
+    """A collection whose writes are queued by a GroupCommitWriter."""
+    __slots__ = ('_name', '_writer')
+
+    def __init__(self, writer, name: str) -> None:
+        self._writer = writer
+        self._name = name
+
+    def insert_one(self, document: dict) -> Future:
+        """Queues a document, and returns a future resolving to its id."""
+        return self._writer._submit(self._name, 'insert_one', document)
+
+    def replace_one(self, query: dict, replacement: dict,
+                    upsert: bool=False) -> Future:
+        return self._writer._submit(
+            self._name, 'replace_one', query, replacement, upsert
+        )
+
+
+class GroupCommitWriter:
+    """
+        Queues single-document writes from any thread, and commits them
+        together in one transaction every `max_delay` seconds, or as soon
+        as `max_batch` operations are queued.
+
+        Each operation runs within its own savepoint, so a failing one does
+        not abort the others. The future returned to its caller resolves
+        once the transaction is committed.
+    """
+    __slots__ = (
+        '_closed', '_db', '_flushes', '_max_batch', '_max_delay',
+        '_operations', '_thread',
+    )
+
+    def __init__(self, db, max_delay: float=DEFAULT_GROUP_DELAY,
+                 max_batch: int=DEFAULT_GROUP_SIZE) -> None:
+        if db._pool is None:
+            raise InvalidOperation(
+                'A group commit writer requires a pooled database.'
+            )
+        self._db = db
+        self._max_delay = max_delay
+        self._max_batch = max_batch
+        self._operations = queue.Queue()
+        self._closed = False
+        self._flushes = 0
+        self._thread = threading.Thread(
+            target=self._run, name='plume-group-commit', daemon=True
+        )
+        self._thread.start()
+
+    def _submit(self, collection_name: str, method: str, *args) -> Future:
+        if self._closed:
+            raise InvalidOperation('The group commit writer is closed.')
+        future = Future()
+        self._operations.put((future, collection_name, method, args))
+        return future
+
+    def _run(self) -> None:
+        stopped = False
+        while not stopped:
+            operation = self._operations.get()
+            if operation is None:
+                break
+            batch = [operation]
+            deadline = time.monotonic() + self._max_delay
+            while len(batch) < self._max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    operation = self._operations.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if operation is None:
+                    stopped = True
+                    break
+                batch.append(operation)
+            self._flush(batch)
+
+        # Operations submitted while the writer was closing.
+        while not self._operations.empty():
+            future = self._operations.get()[0]
+            future.set_exception(
+                InvalidOperation('The group commit writer is closed.')
+            )
+
+    def _flush(self, batch: list) -> None:
+        db = self._db
+        outcomes = []
+        try:
+            with db.transaction():
+                for future, collection_name, method, args in batch:
+                    if not future.set_running_or_notify_cancel():
+                        continue
+                    collection = getattr(db, collection_name)
+                    try:
+                        result = getattr(collection, method)(*args)
+                    except Exception as error:
+                        outcomes.append((future, None, error))
+                    else:
+                        outcomes.append((future, result, None))
+        except Exception as error:
+            for future, _, _, _ in batch:
+                if not future.done():
+                    future.set_exception(error)
+            return
+        finally:
+            self._flushes += 1
+
+        for future, result, error in outcomes:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+
+    def close(self) -> None:
+        """Commits the queued operations, and stops the writer."""
+        if not self._closed:
+            self._closed = True
+            self._operations.put(None)
+            self._thread.join()
+
+    def __enter__(self) -> 'GroupCommitWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb) -> None:
+        self.close()
+
+    def __getattr__(self, collection_name: str) -> _GroupCommitCollection:
+        return _GroupCommitCollection(self, collection_name)
+
+
+def _pragma_value(pragma: str, value):
+    choices = _PRAGMA_CHOICES.get(pragma)
+    if choices is None:
+        if isinstance(value, bool) or not isinstance(value, int):
+            raise BadSetting(
+                '{} expects an integer, got {!r}'.format(pragma, value)
+            )
+        return str(value)
+    if str(value).lower() not in choices:
+        raise BadSetting(
+            '{} expects one of {}, got {!r}'.format(
+                pragma, ', '.join(choices), value
+            )
+        )
+    return str(value).lower()
+
+
+def _prepare_pragmas(profile: str, overrides: dict) -> list:
+    try:
+        settings = dict(PROFILES[profile])
+    except KeyError:
+        raise BadSetting('Unknown profile {!r}'.format(profile))
+    settings.update(
+        (pragma, value) for pragma, value in overrides.items()
+        if value is not None
+    )
+    return [
+        (pragma, _pragma_value(pragma, settings[pragma]))
+        for pragma in PRAGMAS if pragma in settings
+    ]
+
+
+def _has_json1(connection) -> bool:
+    """Checks if SQLite has been compiled with the JSON1 extension."""
+    try:
+        connection.execute("SELECT json('{}')")
+    except sqlite3.OperationalError:
+        return False
+    return True
+
+
 class Database:
-    __slots__ = ('_collections', '_connection', '_name',)
+    """
+        A SQLite3 database that stores collections of documents.
+
+        When `pushdown` is enabled and SQLite provides the JSON1 extension,
+        selectors on non-indexed fields are applied by SQLite with
+        json_extract() instead of decoding every document in Python.
+
+        Queries are executed with bound parameters, so queries sharing the
+        same shape reuse one of the `cached_statements` prepared statements.
+        Each collection also keeps up to `cached_plans` compiled query plans.
+
+        SQLite pragmas are applied on connect from a named `profile` (see
+        PROFILES), each of them being overridable by its keyword argument.
+
+        With a `pool_size`, the database can be shared by threads: writes
+        are serialized on a single connection while reads check out one of
+        `pool_size` reader connections, which is best used along with WAL.
+        A read raises InvalidOperation when no reader connection is released
+        within `pool_timeout` seconds.
+    """
+    __slots__ = (
+        '_cached_plans', '_collections', '_connection', '_json1', '_name',
+        '_pool', '_pushdown', '_reader_statements', '_statements',
+        '_write_lock', '_writer',
+    )
+
+    def __init__(self, name: str, pushdown: bool=True,
+                 cached_statements: int=128, cached_plans: int=128,
+                 profile: str='default', journal_mode: str=None,
+                 synchronous: str=None, cache_size: int=None,
+                 mmap_size: int=None, temp_store: str=None,
+                 page_size: int=None, pool_size: int=0,
+                 pool_timeout: float=DEFAULT_POOL_TIMEOUT) -> None:
+        pragmas = _prepare_pragmas(profile, {
+            'cache_size': cache_size,
+            'journal_mode': journal_mode,
+            'mmap_size': mmap_size,
+            'page_size': page_size,
+            'synchronous': synchronous,
+            'temp_store': temp_store,
+        })
+        if pool_size and name == ':memory:':
+            raise BadSetting('An in-memory database cannot be pooled')
 
-    def __init__(self, name: str) -> None:
         self._name = name
         self._collections = {}
-        self._connection = sqlite3.connect(self._name, isolation_level=None)
+        self._cached_plans = cached_plans
+        self._write_lock = threading.RLock()
+        self._writer = None
+        self._connection = self._connect(
+            pragmas, cached_statements, pool_size > 0
+        )
+        self._json1 = _has_json1(self._connection)
+        self._pushdown = pushdown and self._json1
+        # Mirrors the LRU statement cache of each sqlite3 connection,
+        # which does not report its own hits and misses.
+        self._statements = _LRUCache(cached_statements)
+        self._reader_statements = {}
 
         with Transaction(self._connection):
             self._connection.execute(
@@ -754,21 +3162,388 @@ class Database:
                 'indexes TEXT DEFAULT "{}")'
             )
 
-        collections = self._connection.execute(
+        self._load_collections()
+
+        self._pool = None
+        if pool_size:
+            # The journal mode and the page size belong to the database
+            # file, and were already set by the writer connection.
+            reader_pragmas = [
+                (pragma, value) for pragma, value in pragmas
+                if pragma not in ('journal_mode', 'page_size')
+            ]
+            readers = [
+                self._connect(reader_pragmas, cached_statements, True)
+                for _ in range(pool_size)
+            ]
+            self._reader_statements = {
+                reader: _LRUCache(cached_statements) for reader in readers
+            }
+            self._pool = _ConnectionPool(readers, pool_timeout)
+
+    def _load_collections(self) -> None:
+        """
+            Loads the collections and their indexes from the master table,
+            updating those already loaded.
+        """
+        collections = dict(self._connection.execute(
             'SELECT collection_name, indexes FROM plume_master;'
-        ).fetchall()
+        ).fetchall())
 
-        for collection_name, indexes in collections:
+        for collection_name, collection in self._collections.items():
+            if collection_name not in collections:
+                collection._load({}, False)
+
+        for collection_name, indexes in collections.items():
+            collection = self._collections.get(collection_name)
+            if collection is not None:
+                collection._load(json.loads(indexes), True)
+                continue
             collection = Collection(
                 self,
                 collection_name,
-                indexes=indexes,
+                indexes=json.loads(indexes),
                 registered=True,
+                cached_plans=self._cached_plans,
             )
             self._collections[collection_name] = collection
 
+    def _connect(self, pragmas: list, cached_statements: int,
+                 shared: bool):
+        connection = sqlite3.connect(
+            self._name,
+            isolation_level=None,
+            cached_statements=cached_statements,
+            check_same_thread=not shared,
+        )
+        for pragma, value in pragmas:
+            connection.execute(
+                'PRAGMA {} = {};'.format(pragma, value)
+            ).fetchall()
+        return connection
+
+    def _acquire(self):
+        """
+            Returns a connection to read from.
+
+            The thread owning a transaction reads from the writer connection
+            to see its own changes.
+        """
+        if self._pool is None or self._writer == threading.get_ident():
+            return self._connection
+        return self._pool.acquire()
+
+    def _release(self, connection) -> None:
+        if connection is not self._connection:
+            self._pool.release(connection)
+
+    def _close(self) -> None:
+        if self._pool is not None:
+            self._pool.close()
+        self._connection.close()
+
+    def _execute(self, sql_query: str, params: list=(), connection=None):
+        if connection is None:
+            connection = self._connection
+        statements = self._reader_statements.get(
+            connection, self._statements
+        )
+        if statements.get(sql_query) is None:
+            statements.set(sql_query, True)
+        try:
+            return connection.execute(sql_query, params)
+        except sqlite3.IntegrityError as error:
+            # Unique indexes are the only constraints on documents.
+            raise DuplicateKey(str(error)) from error
+
+    def _executemany(self, sql_query: str, rows):
+        if self._statements.get(sql_query) is None:
+            self._statements.set(sql_query, True)
+        try:
+            return self._connection.executemany(sql_query, rows)
+        except sqlite3.IntegrityError as error:
+            raise DuplicateKey(str(error)) from error
+
+    def settings(self) -> dict:
+        """Reports the pragmas in effect on the writer connection."""
+        settings = {}
+        for pragma in PRAGMAS:
+            with self._write_lock:
+                row = self._connection.execute(
+                    'PRAGMA {};'.format(pragma)
+                ).fetchone()
+            # Unsupported pragmas, like mmap_size in memory, return no row.
+            value = row[0] if row is not None else None
+            choices = _PRAGMA_CHOICES.get(pragma)
+            if choices is not None and isinstance(value, int):
+                # Some pragmas report the index of their current choice.
+                value = choices[value]
+            settings[pragma] = value
+        return settings
+
+    def statement_cache_info(self) -> CacheInfo:
+        """
+            Reports hits and misses of the prepared statement caches, summed
+            over the connections of the database.
+
+            Only the statements of queries are counted: those maintaining
+            the database, like index builds or settings, are not, so the
+            figures are an estimate of the actual cache use.
+        """
+        infos = [self._statements.info()] + [
+            statements.info()
+            for statements in self._reader_statements.values()
+        ]
+        return CacheInfo(*(sum(values) for values in zip(*infos)))
+
+    def transaction(self, mode: str='IMMEDIATE') -> Transaction:
+        """
+            Returns a context manager grouping the operations run within it
+            into a single transaction, or into a savepoint when nested.
+
+            The `mode` of the outermost transaction is one of DEFERRED,
+            IMMEDIATE or EXCLUSIVE.
+        """
+        return _DatabaseTransaction(self, mode)
+
+    def group_writer(self, max_delay: float=DEFAULT_GROUP_DELAY,
+                     max_batch: int=DEFAULT_GROUP_SIZE) -> GroupCommitWriter:
+        """
+            Starts a writer committing the insert_one and replace_one calls
+            of concurrent callers together, which requires a pooled database.
+        """
+        return GroupCommitWriter(self, max_delay, max_batch)
+
+    def pool_info(self) -> PoolInfo:
+        """
+            Reports the size and the use of the reader connection pool,
+            or None if the database is not pooled.
+        """
+        if self._pool is not None:
+            return self._pool.info()
+
     def __getattr__(self, collection_name: str) -> Collection:
         try:
             return self._collections[collection_name]
         except KeyError:
-            return Collection(self, collection_name)
+            # Threads touching a new collection at once share the first
+            # Collection stored, which is registered only once.
+            return self._collections.setdefault(collection_name, Collection(
+                self, collection_name, cached_plans=self._cached_plans
+            ))
+
+
+class AsyncCursor:
+    """
+        An asynchronous iterator over the documents matching a query.
+
+        Documents are fetched by the executor one batch at a time, and only
+        when the previous batch has been consumed, so a slow consumer never
+        makes the executor buffer the whole result set.
+    """
+    __slots__ = (
+        '_batch_size', '_buffer', '_collection', '_cursor', '_db',
+        '_exhausted', '_limit', '_projection', '_query', '_skip', '_sort',
+        '_with_id',
+    )
+
+    def __init__(self, db, collection_name: str, query: dict,
+                 projection: dict=None, limit: int=None,
+                 with_id: bool=False, sort=None, skip: int=0) -> None:
+        self._db = db
+        self._collection = collection_name
+        self._query = query
+        self._projection = projection
+        self._limit = limit
+        self._with_id = with_id
+        self._sort = sort
+        self._skip = skip
+        self._batch_size = DEFAULT_BATCH_SIZE
+        self._buffer = deque()
+        self._cursor = None
+        self._exhausted = False
+
+    def _check_not_started(self) -> None:
+        if self._cursor is not None or self._exhausted:
+            raise InvalidOperation(
+                'A cursor can not be modified once iterated.'
+            )
+
+    def batch_size(self, batch_size: int) -> 'AsyncCursor':
+        self._check_not_started()
+        self._batch_size = batch_size
+        return self
+
+    def limit(self, limit: int) -> 'AsyncCursor':
+        self._check_not_started()
+        self._limit = limit
+        return self
+
+    def skip(self, skip: int) -> 'AsyncCursor':
+        self._check_not_started()
+        self._skip = skip
+        return self
+
+    def sort(self, sort) -> 'AsyncCursor':
+        self._check_not_started()
+        self._sort = sort
+        return self
+
+    def _fetch(self) -> list:
+        if self._cursor is None:
+            collection = getattr(self._db._db, self._collection)
+            self._cursor = collection.find(
+                self._query, self._projection, self._limit, lazy=True,
+                with_id=self._with_id, sort=self._sort, skip=self._skip
+            )
+            self._cursor.batch_size(self._batch_size)
+        return list(itertools.islice(self._cursor, self._batch_size))
+
+    def __aiter__(self) -> 'AsyncCursor':
+        return self
+
+    async def __anext__(self) -> dict:
+        if not self._buffer and not self._exhausted:
+            documents = await self._db._run(self._fetch)
+            if len(documents) < self._batch_size:
+                self._exhausted = True
+            self._buffer.extend(documents)
+        if not self._buffer:
+            await self.close()
+            raise StopAsyncIteration
+        return self._buffer.popleft()
+
+    async def close(self) -> None:
+        """Releases the SQLite statement before the cursor is exhausted."""
+        self._exhausted = True
+        self._buffer.clear()
+        if self._cursor is not None:
+            cursor, self._cursor = self._cursor, None
+            await self._db._run(cursor.close)
+
+    async def __aenter__(self) -> 'AsyncCursor':
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb) -> None:
+        await self.close()
+
+
+class AsyncCollection:
+    """A collection whose operations are coroutines run by an executor."""
+    __slots__ = ('_db', '_name')
+
+    def __init__(self, db, name: str) -> None:
+        self._db = db
+        self._name = name
+
+    def _call(self, method: str, *args, **kwargs):
+        collection = getattr(self._db._db, self._name)
+        return getattr(collection, method)(*args, **kwargs)
+
+    async def create_index(self, keys: list, **kwargs) -> None:
+        await self._db._run(self._call, 'create_index', keys, **kwargs)
+
+    def find(self, query: dict, projection: dict=None, limit: int=None,
+             lazy: bool=False, with_id: bool=False, sort=None,
+             skip: int=0):
+        """
+            Returns a coroutine resolving to the list of matching documents,
+            or an AsyncCursor streaming them if `lazy` is True.
+        """
+        if lazy:
+            return AsyncCursor(
+                self._db, self._name, query, projection, limit, with_id,
+                sort, skip
+            )
+        return self._db._run(
+            self._call, 'find', query, projection, limit, with_id=with_id,
+            sort=sort, skip=skip
+        )
+
+    async def find_one(self, query: dict, projection: dict=None,
+                       with_id: bool=False, sort=None):
+        return await self._db._run(
+            self._call, 'find_one', query, projection, with_id=with_id,
+            sort=sort
+        )
+
+    async def aggregate(self, pipeline: list) -> list:
+        return await self._db._run(self._call, 'aggregate', pipeline)
+
+    async def count(self, query: dict=None) -> int:
+        return await self._db._run(self._call, 'count', query)
+
+    async def distinct(self, field: str, query: dict=None) -> list:
+        return await self._db._run(self._call, 'distinct', field, query)
+
+    async def exists(self, query: dict=None) -> bool:
+        return await self._db._run(self._call, 'exists', query)
+
+    async def estimated_count(self) -> int:
+        return await self._db._run(self._call, 'estimated_count')
+
+    async def insert_one(self, document: dict) -> int:
+        return await self._db._run(self._call, 'insert_one', document)
+
+    async def insert_many(self, documents) -> range:
+        return await self._db._run(self._call, 'insert_many', documents)
+
+    async def replace_one(self, query: dict, replacement: dict,
+                          upsert: bool=False):
+        return await self._db._run(
+            self._call, 'replace_one', query, replacement, upsert
+        )
+
+
+class AsyncDatabase:
+    """
+        An asyncio front-end of a Database.
+
+        Operations run on a dedicated executor, which owns the connections
+        of the database: a single thread, or one thread per connection of a
+        pooled database. At most `max_pending` operations are queued at
+        once; further callers wait for a slot instead of piling up work.
+        Other keyword arguments are those of Database.
+    """
+    __slots__ = ('_db', '_executor', '_max_pending', '_pending')
+
+    def __init__(self, name: str, max_pending: int=DEFAULT_MAX_PENDING,
+                 **kwargs) -> None:
+        self._executor = ThreadPoolExecutor(
+            max_workers=kwargs.get('pool_size', 0) + 1
+        )
+        self._max_pending = max_pending
+        self._pending = None
+        # Connections of a database that is not pooled can only be used
+        # by the thread that opened them.
+        self._db = self._executor.submit(Database, name, **kwargs).result()
+
+    async def _run(self, fun, *args, **kwargs):
+        if self._pending is None:
+            self._pending = asyncio.Semaphore(self._max_pending)
+        async with self._pending:
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(
+                self._executor, functools.partial(fun, *args, **kwargs)
+            )
+
+    async def close(self) -> None:
+        """
+            Waits for pending operations, closes the connections of the
+            database and stops the executor.
+        """
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, self._shutdown)
+
+    def _shutdown(self) -> None:
+        if self._db._pool is None:
+            # The connection belongs to the single thread of the executor,
+            # which runs operations in the order they were submitted.
+            self._executor.submit(self._db._close)
+            self._executor.shutdown()
+        else:
+            self._executor.shutdown()
+            self._db._close()
+
+    def __getattr__(self, collection_name: str) -> AsyncCollection:
+        return AsyncCollection(self, collection_name)
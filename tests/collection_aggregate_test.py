@@ -0,0 +1,225 @@
+# Built-in dependencies
+import json
+import os
+
+# External dependencies
+import pytest
+
+# Internal dependencies
+from plume import ASCENDING, BadQuery, Database, DESCENDING
+
+
+SALES = [
+    {'shop': 'north', 'amount': 10, 'day': {'month': 1, 'week': 1}},
+    {'shop': 'south', 'amount': 5.5, 'day': {'month': 1, 'week': 2}},
+    {'shop': 'north', 'amount': 20, 'day': {'month': 2, 'week': 5}},
+    {'shop': 'north', 'amount': 'refunded', 'day': {'month': 2, 'week': 6}},
+    {'shop': 'east', 'day': {'month': 2, 'week': 6}},
+]
+
+SHOPS = [
+    {
+        '_id': 'east', 'total': 0, 'average': None, 'lowest': None,
+        'highest': None, 'sales': 1,
+    },
+    {
+        '_id': 'north', 'total': 30, 'average': 15.0, 'lowest': 10,
+        'highest': 'refunded', 'sales': 3,
+    },
+    {
+        '_id': 'south', 'total': 5.5, 'average': 5.5, 'lowest': 5.5,
+        'highest': 5.5, 'sales': 1,
+    },
+]
+
+
+class TestCollectionAggregate:
+
+    def setup(self):
+        self.db = Database('test.db')
+        self.db.sales.insert_many(SALES)
+
+    def last_statement(self):
+        return list(self.db._statements._entries)[-1]
+
+    def group_by_shop(self):
+        return {'$group': {
+            '_id': '$shop',
+            'total': {'$sum': '$amount'},
+            'average': {'$avg': '$amount'},
+            'lowest': {'$min': '$amount'},
+            'highest': {'$max': '$amount'},
+            'sales': {'$count': {}},
+        }}
+
+    def test_group_in_sql(self):
+        shops = self.db.sales.aggregate([
+            self.group_by_shop(), {'$sort': ('_id', ASCENDING)}
+        ])
+        assert shops == SHOPS
+        statement = self.last_statement()
+        assert 'GROUP BY json_extract(_data, \'$."shop"\')' in statement
+        assert statement.startswith('SELECT _data -> \'$."shop"\', ')
+        assert statement.endswith(
+            'THEN CAST(json_extract(_data, \'$."shop"\') AS BLOB) '
+            'ELSE json_extract(_data, \'$."shop"\') END ASC'
+        )
+
+    def test_group_on_indexed_field(self):
+        self.db.sales.create_index(('shop', str))
+        shops = self.db.sales.aggregate([
+            {'$match': {'shop': {'$ne': 'east'}}},
+            {'$group': {'_id': '$shop', 'sales': {'$sum': 1}}},
+            {'$sort': [('sales', DESCENDING)]},
+            {'$limit': 1},
+        ])
+        assert shops == [{'_id': 'north', 'sales': 3}]
+        statement = self.last_statement()
+        assert 'WHERE "shop" IS NOT ?' in statement
+        assert statement.endswith(
+            'GROUP BY "shop" ORDER BY 2 DESC LIMIT ?'
+        )
+
+    def test_group_by_several_fields(self):
+        months = self.db.sales.aggregate([
+            {'$match': {'shop': 'north'}},
+            {'$group': {
+                '_id': {'shop': '$shop', 'month': '$day.month'},
+                'total': {'$sum': '$amount'},
+            }},
+            {'$sort': [('_id.month', DESCENDING)]},
+        ])
+        assert months == [
+            {'_id': {'shop': 'north', 'month': 2}, 'total': 20},
+            {'_id': {'shop': 'north', 'month': 1}, 'total': 10},
+        ]
+
+    def test_group_all_documents(self):
+        assert self.db.sales.aggregate([
+            {'$group': {'_id': None, 'total': {'$sum': '$amount'}}}
+        ]) == [{'_id': None, 'total': 35.5}]
+        assert self.db.sales.aggregate([
+            {'$match': {'shop': 'west'}},
+            {'$group': {'_id': None, 'total': {'$sum': '$amount'}}},
+        ]) == []
+
+    def test_group_in_python(self):
+        shops = self.db.sales.aggregate([
+            {'$match': {'day': {'month': 2, 'week': 6}}},
+            self.group_by_shop(),
+            {'$sort': ('_id', ASCENDING)},
+        ])
+        assert 'GROUP BY' not in self.last_statement()
+        assert shops == [
+            SHOPS[0],
+            {
+                '_id': 'north', 'total': 0, 'average': None,
+                'lowest': 'refunded', 'highest': 'refunded', 'sales': 1,
+            },
+        ]
+
+    def test_group_without_pushdown(self):
+        db = Database('test.db', pushdown=False)
+        shops = db.sales.aggregate([self.group_by_shop()])
+        assert sorted(shops, key=lambda shop: shop['_id']) == SHOPS
+
+    def test_group_keeps_types_of_values(self):
+        self.db.flags.insert_many([
+            {'on': True, 'meta': {'a': 1}, 'rank': 2},
+            {'on': True, 'meta': {'a': 1}, 'rank': True},
+            {'on': False, 'meta': [1], 'rank': 'x'},
+            {'on': False, 'meta': 'text', 'rank': {'b': 2}},
+            {'meta': None, 'rank': False},
+        ])
+        pipeline = [{'$group': {
+            '_id': {'on': '$on', 'meta': '$meta'},
+            'lowest': {'$min': '$rank'},
+            'highest': {'$max': '$rank'},
+            'lowest_meta': {'$min': '$meta'},
+            'highest_meta': {'$max': '$meta'},
+        }}]
+        groups = self.db.flags.aggregate(pipeline)
+        assert 'GROUP BY' in self.last_statement()
+        db = Database('test.db', pushdown=False)
+        python_groups = db.flags.aggregate(pipeline)
+
+        def key(group):
+            return json.dumps(group['_id'], sort_keys=True)
+
+        assert sorted(groups, key=key) == sorted(python_groups, key=key)
+        pipeline.append({'$sort': ('_id.meta', ASCENDING)})
+        assert [group['_id'] for group in self.db.flags.aggregate(
+            pipeline
+        )] == [group['_id'] for group in db.flags.aggregate(pipeline)]
+        assert sorted(groups, key=key) == [
+            {
+                '_id': {'on': False, 'meta': 'text'}, 'lowest': {'b': 2},
+                'highest': {'b': 2}, 'lowest_meta': 'text',
+                'highest_meta': 'text',
+            },
+            {
+                '_id': {'on': False, 'meta': [1]}, 'lowest': 'x',
+                'highest': 'x', 'lowest_meta': [1], 'highest_meta': [1],
+            },
+            {
+                '_id': {'on': None, 'meta': None}, 'lowest': False,
+                'highest': False, 'lowest_meta': None, 'highest_meta': None,
+            },
+            {
+                '_id': {'on': True, 'meta': {'a': 1}}, 'lowest': True,
+                'highest': 2, 'lowest_meta': {'a': 1},
+                'highest_meta': {'a': 1},
+            },
+        ]
+
+    def test_stages_after_group_run_in_python(self):
+        shops = self.db.sales.aggregate([
+            self.group_by_shop(),
+            {'$match': {'total': {'$gt': 1}}},
+            {'$project': {'total': 1}},
+            {'$sort': [('total', DESCENDING)]},
+        ])
+        assert shops == [{'total': 30}, {'total': 5.5}]
+
+    def test_pipeline_without_group(self):
+        sales = self.db.sales.aggregate([
+            {'$match': {'shop': 'north'}},
+            {'$match': {'day.month': 2}},
+            {'$sort': [('day.week', DESCENDING)]},
+            {'$limit': 1},
+            {'$project': {'amount': 1}},
+        ])
+        assert sales == [{'amount': 'refunded'}]
+        assert self.last_statement().endswith(
+            'ELSE json_extract(_data, \'$."day"."week"\') END DESC LIMIT ?'
+        )
+
+    def test_lazy_pipeline(self):
+        documents = self.db.sales.aggregate(
+            [{'$limit': 2}, {'$project': {'shop': 1}}], lazy=True
+        )
+        assert next(documents) == {'shop': 'north'}
+        assert list(documents) == [{'shop': 'south'}]
+
+    def test_count(self):
+        assert self.db.sales.count() == 5
+        assert self.db.sales.count({'shop': 'north'}) == 3
+        assert self.db.sales.count({'day': {'month': 2, 'week': 6}}) == 2
+        assert self.db.sales.count({'shop': 'west'}) == 0
+
+    def test_invalid_pipelines(self):
+        for pipeline in (
+            [{'$unwind': '$shop'}],
+            [{'$match': {}, '$limit': 1}],
+            [{'$limit': 0}],
+            [{'$group': {'total': {'$sum': '$amount'}}}],
+            [{'$group': {'_id': 'shop'}}],
+            [{'$group': {'_id': None, 'total': {'$push': '$amount'}}}],
+            [{'$group': {'_id': None, 'total': {'$sum': '1'}}}],
+            [{'$sort': [('shop', 1)]}],
+        ):
+            with pytest.raises(BadQuery):
+                self.db.sales.aggregate(pipeline)
+
+    def teardown(self):
+        os.remove('test.db')
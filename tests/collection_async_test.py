@@ -0,0 +1,156 @@
+# Built-in dependencies
+import asyncio
+import sqlite3
+
+# External dependencies
+import pytest
+
+# Internal dependencies
+from plume import AsyncCursor, AsyncDatabase, DESCENDING, InvalidOperation
+from utils import WritingBaseTest
+
+
+class TestAsyncCollection(WritingBaseTest):
+
+    def setup(self):
+        self.db = AsyncDatabase('test.db')
+
+    def run(self, coroutine):
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            loop.close()
+
+    def test_insert_and_find(self):
+        async def scenario():
+            _id = await self.db.users.insert_one({'name': 'Mario'})
+            ids = await self.db.users.insert_many(
+                [{'name': 'Luigi'}, {'name': 'Peach'}]
+            )
+            documents = await self.db.users.find({'name': 'Luigi'})
+            return _id, ids, documents
+
+        _id, ids, documents = self.run(scenario())
+        assert _id == 1
+        assert list(ids) == [2, 3]
+        assert documents == [{'name': 'Luigi'}]
+
+    def test_find_one_and_replace_one(self):
+        async def scenario():
+            await self.db.users.insert_one({'name': 'Mario', 'age': 42})
+            await self.db.users.replace_one(
+                {'name': 'Mario'}, {'name': 'Mario', 'age': 43}
+            )
+            return await self.db.users.find_one(
+                {'name': 'Mario'}, with_id=True
+            )
+
+        assert self.run(scenario()) == {'name': 'Mario', 'age': 43, '_id': 1}
+
+    def test_create_index(self):
+        async def scenario():
+            await self.db.users.create_index(('name', str))
+            await self.db.users.insert_one({'name': 'Mario'})
+            return await self.db.users.find({'name': 'Mario'})
+
+        assert self.run(scenario()) == [{'name': 'Mario'}]
+        assert self.db._db.users._indexed_fields == ['name']
+
+    def test_aggregate_and_count(self):
+        async def scenario():
+            await self.db.users.insert_many(
+                [{'age': age % 2} for age in range(5)]
+            )
+            groups = await self.db.users.aggregate([
+                {'$group': {'_id': '$age', 'users': {'$count': {}}}},
+                {'$sort': ('_id', DESCENDING)},
+            ])
+            return groups, await self.db.users.count({'age': 1})
+
+        groups, count = self.run(scenario())
+        assert groups == [{'_id': 1, 'users': 2}, {'_id': 0, 'users': 3}]
+        assert count == 2
+
+    def test_lazy_find_streams_batches(self):
+        async def scenario():
+            await self.db.users.insert_many(
+                [{'age': age} for age in range(10)]
+            )
+            cursor = self.db.users.find({}, lazy=True).batch_size(3)
+            assert isinstance(cursor, AsyncCursor)
+            ages = []
+            async for document in cursor:
+                # Only the current batch is buffered.
+                assert len(cursor._buffer) < 3
+                ages.append(document['age'])
+            return ages
+
+        assert self.run(scenario()) == list(range(10))
+
+    def test_lazy_find_with_limit_and_skip(self):
+        async def scenario():
+            await self.db.users.insert_many(
+                [{'age': age} for age in range(10)]
+            )
+            cursor = self.db.users.find({}, lazy=True).skip(2).limit(5)
+            async with cursor:
+                return [document['age'] async for document in cursor]
+
+        assert self.run(scenario()) == [2, 3, 4, 5, 6]
+
+    def test_cursor_can_not_be_modified_once_iterated(self):
+        async def scenario():
+            await self.db.users.insert_one({'age': 1})
+            cursor = self.db.users.find({}, lazy=True)
+            await cursor.__anext__()
+            with pytest.raises(InvalidOperation):
+                cursor.limit(1)
+            await cursor.close()
+
+        self.run(scenario())
+
+    def test_pending_operations_are_bounded(self):
+        db = AsyncDatabase('test.db', max_pending=2)
+
+        async def scenario():
+            await asyncio.gather(*(
+                db.users.insert_one({'age': age}) for age in range(20)
+            ))
+            return await db.users.find({})
+
+        assert len(self.run(scenario())) == 20
+        assert db._pending._value == 2
+
+    def test_pooled_database(self):
+        db = AsyncDatabase('test.db', journal_mode='wal', pool_size=2)
+
+        async def scenario():
+            await db.users.insert_many([{'age': age} for age in range(5)])
+            results = await asyncio.gather(*(
+                db.users.find({'age': {'$gte': age}}) for age in range(5)
+            ))
+            await db.close()
+            return [len(result) for result in results]
+
+        assert self.run(scenario()) == [5, 4, 3, 2, 1]
+
+    def test_close_closes_connections(self):
+        db = AsyncDatabase('test.db', journal_mode='wal', pool_size=2)
+
+        async def scenario():
+            await db.users.insert_one({'name': 'Mario'})
+            await db.close()
+
+        connections = [db._db._connection] + list(
+            db._db._pool._connections.queue
+        )
+        self.run(scenario())
+        assert len(connections) == 3
+        for connection in connections:
+            with pytest.raises(sqlite3.ProgrammingError):
+                connection.execute('SELECT 1')
+
+    def teardown(self):
+        self.run(self.db.close())
+        super().teardown()
@@ -0,0 +1,63 @@
+# Built-in dependencies
+import json
+
+# External dependencies
+import pytest
+
+# Internal dependencies
+from factories import Persona
+from plume import BadQuery
+from utils import WritingBaseTest, with_index
+
+
+class TestCollectionBulkLoad(WritingBaseTest):
+
+    def setup(self):
+        super().setup()
+        self.personas = Persona.create_batch(5)
+
+    def test_load_documents_from_a_generator(self):
+        count = self.db.personas.bulk_load(
+            (persona for persona in self.personas), chunk_size=2
+        )
+        assert count == 5
+        rows = self.db._connection.execute(
+            'SELECT _data FROM personas'
+        ).fetchall()
+        assert [json.loads(row[0]) for row in rows] == self.personas
+
+    def test_load_a_multiple_of_chunk_size(self):
+        count = self.db.personas.bulk_load(self.personas[:4], chunk_size=2)
+        assert count == 4
+
+    @with_index(index=[('meta.mastodon_profile', str)])
+    def test_load_with_nested_field_index(self):
+        self.db.personas.bulk_load(self.personas, chunk_size=3)
+        rows = self.db._connection.execute(
+            'SELECT "meta.mastodon_profile" FROM personas ORDER BY id'
+        ).fetchall()
+        assert [row[0] for row in rows] == [
+            persona['meta']['mastodon_profile'] for persona in self.personas
+        ]
+
+    def test_committed_chunks_are_kept_on_failure(self):
+        documents = self.personas[:4] + [{'not_json': {1, 2}}]
+        with pytest.raises(TypeError):
+            self.db.personas.bulk_load(documents, chunk_size=2)
+        count = self.db._connection.execute(
+            'SELECT count(*) FROM personas'
+        ).fetchone()[0]
+        assert count == 4
+
+    def test_invalid_chunk_size(self):
+        for chunk_size in (0, -1):
+            with pytest.raises(BadQuery):
+                self.db.personas.bulk_load(self.personas, chunk_size)
+        assert self.db.personas.count() == 0
+
+    def test_documents_are_stored_compactly(self):
+        self.db.personas.bulk_load([{'name': 'Mario', 'age': 42}])
+        data = self.db._connection.execute(
+            'SELECT _data FROM personas'
+        ).fetchone()[0]
+        assert data == '{"name":"Mario","age":42}'
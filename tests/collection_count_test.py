@@ -0,0 +1,65 @@
+# Built-in dependencies
+import os
+
+# Internal dependencies
+from plume import Database
+
+
+class TestCollectionCount:
+
+    def setup(self):
+        self.db = Database('test.db')
+        self.db.users.insert_many([
+            {'name': 'Mario', 'age': 42, 'meta': {'lives': 3}},
+            {'name': 'Luigi', 'age': 40, 'meta': {'lives': 1}},
+            {'name': 'Peach', 'age': 30},
+        ])
+
+    def last_statement(self):
+        return list(self.db._statements._entries)[-1]
+
+    def test_count_in_sql(self):
+        assert self.db.users.count() == 3
+        assert self.db.users.count({'age': {'$gt': 35}}) == 2
+        assert self.last_statement().startswith(
+            'SELECT count(*) FROM (SELECT id FROM users WHERE'
+        )
+
+    def test_count_on_indexed_field(self):
+        self.db.users.create_index(('age', int))
+        assert self.db.users.count({'age': {'$gte': 40}}) == 2
+        assert self.last_statement() == (
+            'SELECT count(*) FROM (SELECT id FROM users WHERE "age" >= ? '
+            'AND typeof("age") IN (\'integer\', \'real\'))'
+        )
+
+    def test_count_in_python(self):
+        assert self.db.users.count({'meta': {'lives': 3}}) == 1
+        assert not self.last_statement().startswith('SELECT count(*)')
+
+    def test_count_without_match(self):
+        assert self.db.users.count({'name': 'Bowser'}) == 0
+        assert self.db.players.count() == 0
+
+    def test_exists(self):
+        assert self.db.users.exists()
+        assert self.db.users.exists({'name': 'Peach'})
+        assert self.last_statement() == (
+            'SELECT id FROM users '
+            'WHERE json_extract(_data, \'$."name"\') = ? AND '
+            'json_type(_data, \'$."name"\') NOT IN (\'array\', \'object\') '
+            'LIMIT ?'
+        )
+        assert not self.db.users.exists({'name': 'Bowser'})
+        assert self.db.users.exists({'meta': {'lives': 1}})
+        assert not self.db.users.exists({'meta': {'lives': 2}})
+        assert not self.db.players.exists()
+
+    def test_estimated_count(self):
+        assert self.db.users.estimated_count() == 3
+        self.db.users.insert_one({'name': 'Toad'})
+        assert self.db.users.estimated_count() == 4
+        assert self.db.players.estimated_count() == 0
+
+    def teardown(self):
+        os.remove('test.db')
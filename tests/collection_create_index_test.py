@@ -1,7 +1,11 @@
 # Built-in dependencies
 import json
 
+# External dependencies
+import pytest
+
 # Internal dependencies
+from plume import BadQuery, Database, DESCENDING, DuplicateKey
 from factories import Persona
 from utils import index_list, table_info, WritingBaseTest
 
@@ -319,3 +323,377 @@ class TestCollectionCreateIndexOnExistingData(WritingBaseTest):
         assert json.loads(rows[2][0]) == self.personas[2]
         assert rows[2][1] == self.personas[2]['name']
         assert rows[2][2] == self.personas[2]['age']
+
+
+class TestCollectionCreateIndexBackfill(WritingBaseTest):
+
+    def setup(self):
+        super().setup()
+        self.db.personas.insert_many(
+            {'name': 'Persona {}'.format(i), 'meta': {'rank': i}}
+            for i in range(10)
+        )
+        # Ids of the collection are not contiguous.
+        self.db.personas.replace_one({'meta.rank': 4}, {'removed': True})
+        self.db._connection.execute('DELETE FROM personas WHERE id = 3')
+
+    def rows(self, column):
+        return self.db._connection.execute(
+            'SELECT id, "{}" FROM personas ORDER BY id'.format(column)
+        ).fetchall()
+
+    def test_backfill_by_chunks_reports_progress(self):
+        progress = []
+        self.db.personas.create_index(
+            ('meta.rank', int), chunk_size=4,
+            progress=lambda done, total: progress.append((done, total))
+        )
+        assert progress == [(4, 9), (8, 9), (9, 9)]
+        assert self.rows('meta.rank') == [
+            (1, 0), (2, 1), (4, 3), (5, None), (6, 5), (7, 6), (8, 7),
+            (9, 8), (10, 9),
+        ]
+
+    def test_backfill_in_python(self):
+        self.db._json1 = False
+        progress = []
+        self.db.personas.create_index(
+            ('meta.rank', int), chunk_size=4,
+            progress=lambda done, total: progress.append((done, total))
+        )
+        assert progress == [(4, 9), (8, 9), (9, 9)]
+        assert self.rows('meta.rank') == [
+            (1, 0), (2, 1), (4, 3), (5, None), (6, 5), (7, 6), (8, 7),
+            (9, 8), (10, 9),
+        ]
+
+
+class TestCollectionCreateIndexInBackground(WritingBaseTest):
+
+    def setup(self):
+        super().setup()
+        self.db.personas.insert_many(
+            {'name': 'Persona {}'.format(i), 'age': i} for i in range(10)
+        )
+
+    def master_indexes(self, db=None):
+        row = (db or self.db)._connection.execute(
+            'SELECT indexes FROM plume_master '
+            'WHERE collection_name = "personas";'
+        ).fetchone()
+        return json.loads(row[0])
+
+    def test_background_build_registers_index(self):
+        self.db.personas.create_index(
+            ('age', int), background=True, chunk_size=3
+        )
+        assert self.master_indexes() == {
+            'indexes': [
+                {
+                    'keys': [['age', 'INTEGER', 'ASC']],
+                    'name': 'personas_index_age'
+                }
+            ],
+            'indexed_fields': ['age'],
+            'formated_indexed_fields': ['"age"']
+        }
+        indexes = index_list(self.db, '"personas"')
+        assert indexes[0][1] == 'personas_index_age'
+        assert self.db.personas.explain({'age': 3})['index'] == (
+            'personas_index_age'
+        )
+        assert self.db.personas.find({'age': 3}) == [
+            {'name': 'Persona 3', 'age': 3}
+        ]
+
+    def test_writes_go_on_during_build(self):
+        explanations = []
+
+        def write(done, total):
+            assert not self.db._connection.in_transaction
+            explanations.append(self.db.personas.explain({'age': 42}))
+            self.db.personas.insert_one({'name': 'New', 'age': 42})
+            self.db.personas.replace_one(
+                {'name': 'Persona 0'}, {'name': 'Persona 0', 'age': 100}
+            )
+            assert len(self.db.personas.find({'age': 42})) == len(
+                explanations
+            )
+
+        self.db.personas.create_index(
+            ('age', int), background=True, chunk_size=4, progress=write
+        )
+        assert len(explanations) == 3
+        for explanation in explanations:
+            assert explanation['index'] is None
+            assert 'json_extract' in explanation['sql']
+
+        rows = self.db._connection.execute(
+            'SELECT count(*) FROM personas WHERE age = 42'
+        ).fetchone()
+        assert rows[0] == 3
+        assert self.db.personas.find({'age': 100}) == [
+            {'name': 'Persona 0', 'age': 100}
+        ]
+
+    def interrupt_build(self):
+        def interrupt(done, total):
+            raise KeyboardInterrupt
+
+        with pytest.raises(KeyboardInterrupt):
+            self.db.personas.create_index(
+                ('age', int), background=True, chunk_size=4,
+                progress=interrupt
+            )
+
+    def test_interrupted_build_is_resumed(self):
+        self.interrupt_build()
+        indexes = self.master_indexes()
+        assert indexes['indexes'][0]['state'] == 'building'
+        assert indexes['indexed_fields'] == []
+        assert index_list(self.db, '"personas"') == []
+
+        db = Database('test.db')
+        db.personas.insert_one({'name': 'New', 'age': 42})
+        assert db.personas.find({'age': 9}) == [
+            {'name': 'Persona 9', 'age': 9}
+        ]
+        db.personas.create_index(('age', int), background=True)
+        assert self.master_indexes(db)['indexed_fields'] == ['age']
+        rows = db._connection.execute(
+            'SELECT age FROM personas ORDER BY id'
+        ).fetchall()
+        assert [row[0] for row in rows] == list(range(10)) + [42]
+
+    def test_interrupted_build_is_completed_in_foreground(self):
+        self.interrupt_build()
+        self.db.personas.create_index(('age', int))
+        indexes = self.master_indexes()
+        assert 'state' not in indexes['indexes'][0]
+        assert indexes['indexed_fields'] == ['age']
+        assert index_list(self.db, '"personas"')[0][1] == (
+            'personas_index_age'
+        )
+        assert self.db.personas.explain({'age': 9})['index'] == (
+            'personas_index_age'
+        )
+        assert self.db.personas.find({'age': 9}) == [
+            {'name': 'Persona 9', 'age': 9}
+        ]
+
+    def test_other_index_on_a_building_column(self):
+        self.interrupt_build()
+        self.db.personas.create_index(('age', int), unique=True)
+        indexes = self.master_indexes()
+        assert indexes['indexed_fields'] == ['age']
+        assert indexes['formated_indexed_fields'] == ['"age"']
+        assert self.db.personas.find({'age': 9}) == [
+            {'name': 'Persona 9', 'age': 9}
+        ]
+        with pytest.raises(DuplicateKey):
+            self.db.personas.insert_one({'name': 'New', 'age': 9})
+
+        self.db.personas.create_index(('age', int), background=True)
+        indexes = self.master_indexes()
+        assert indexes['indexed_fields'] == ['age']
+        assert len(index_list(self.db, '"personas"')) == 2
+
+
+class TestCollectionCreateExpressionIndex(WritingBaseTest):
+
+    def test_create_expression_index(self):
+        self.db.personas.insert_one({'name': 'Mario', 'meta': {'age': 42}})
+        self.db.personas.create_index([
+            ('name', str), ('meta.age', int, DESCENDING)
+        ], expression=True)
+        row = self.db._connection.execute(
+            'SELECT indexes FROM plume_master '
+            'WHERE collection_name = "personas";'
+        ).fetchone()
+        indexes = json.loads(row[0])
+        assert indexes == {
+            'indexes': [
+                {
+                    'keys': [
+                        ['name', 'TEXT', 'ASC'],
+                        ['meta.age', 'INTEGER', 'DESC'],
+                    ],
+                    'name': 'personas_index_name_meta.age',
+                    'expression': True,
+                }
+            ],
+            'indexed_fields': [],
+            'formated_indexed_fields': [],
+            'expression_fields': ['name', 'meta.age'],
+        }
+
+        # Documents are not copied in any column.
+        columns = table_info(self.db, 'personas')
+        assert len(columns) == 2
+
+        indexes = index_list(self.db, '"personas"')
+        assert len(indexes) == 1
+        assert indexes[0][1] == 'personas_index_name_meta.age'
+
+    def test_queries_use_expression_index(self):
+        self.db.personas.create_index(('name', str), expression=True)
+        self.db.personas.insert_many(
+            [{'name': 'Mario'}, {'name': 'Luigi'}]
+        )
+        explanation = self.db.personas.explain({'name': 'Luigi'})
+        assert any(
+            'USING INDEX personas_index_name' in step
+            for step in explanation['query_plan']
+        )
+        assert self.db.personas.find({'name': 'Luigi'}) == [
+            {'name': 'Luigi'}
+        ]
+
+    def test_expression_index_without_pushdown(self):
+        db = Database('test.db', pushdown=False)
+        db.personas.create_index(('name', str), expression=True)
+        db.personas.insert_one({'name': 'Mario'})
+        explanation = db.personas.explain(
+            {'name': 'Mario', 'age': {'$gt': 18}}
+        )
+        assert explanation['sql'] == (
+            'SELECT _data FROM personas '
+            'WHERE json_extract(_data, \'$."name"\') = ? AND '
+            'json_type(_data, \'$."name"\') NOT IN (\'array\', \'object\')'
+        )
+        assert explanation['python_filter'] is True
+        assert any(
+            'USING INDEX personas_index_name' in step
+            for step in explanation['query_plan']
+        )
+
+    def test_expression_index_on_indexed_field(self):
+        self.db.personas.create_index(('age', int))
+        self.db.personas.create_index(
+            [('age', int), ('name', str)], expression=True
+        )
+        row = self.db._connection.execute(
+            "SELECT sql FROM sqlite_master WHERE name = ?",
+            ['personas_index_age_name']
+        ).fetchone()
+        assert row[0].endswith(
+            '("age" ASC, json_extract(_data, \'$."name"\') ASC)'
+        )
+
+    def test_expression_index_is_reloaded(self):
+        self.db.personas.create_index(('name', str), expression=True)
+        db = Database('test.db', pushdown=False)
+        assert db.personas._expression_fields == ['name']
+        assert 'json_extract' in db.personas.explain({'name': 'Mario'})['sql']
+
+
+class TestCollectionCreateUniqueAndPartialIndex(WritingBaseTest):
+
+    def index_sql(self, name):
+        row = self.db._connection.execute(
+            "SELECT sql FROM sqlite_master WHERE name = ?", [name]
+        ).fetchone()
+        return row[0]
+
+    def test_unique_index_rejects_duplicates(self):
+        self.db.personas.create_index(('name', str), unique=True)
+        self.db.personas.insert_one({'name': 'Mario'})
+        with pytest.raises(DuplicateKey):
+            self.db.personas.insert_one({'name': 'Mario'})
+        with pytest.raises(DuplicateKey):
+            self.db.personas.insert_many([{'name': 'Luigi'}] * 2)
+        self.db.personas.insert_one({'name': 'Peach'})
+        with pytest.raises(DuplicateKey):
+            self.db.personas.replace_one({'name': 'Peach'}, {'name': 'Mario'})
+        names = [persona['name'] for persona in self.db.personas.find({})]
+        assert names == ['Mario', 'Peach']
+
+    def test_unique_index_allows_missing_fields(self):
+        self.db.personas.create_index(('name', str), unique=True)
+        self.db.personas.insert_many([{'age': 1}, {'age': 2}])
+        assert len(self.db.personas.find({})) == 2
+
+    def test_unique_index_on_duplicated_data(self):
+        self.db.personas.insert_many([{'name': 'Mario'}] * 2)
+        with pytest.raises(DuplicateKey):
+            self.db.personas.create_index(
+                ('name', str), unique=True, background=True
+            )
+        assert self.db.personas._indexes['indexes'] == []
+
+    def test_unique_index_is_described(self):
+        self.db.personas.create_index(('name', str))
+        self.db.personas.create_index(('name', str), unique=True)
+        indexes = self.db.personas._indexes['indexes']
+        assert [index['name'] for index in indexes] == [
+            'personas_index_name', 'personas_index_name_unique'
+        ]
+        assert indexes[1]['unique'] is True
+        assert self.index_sql('personas_index_name_unique').startswith(
+            'CREATE UNIQUE INDEX'
+        )
+
+    def test_partial_index_where_clause(self):
+        self.db.personas.create_index(
+            ('created_at', int), partial_filter={'status': 'open'}
+        )
+        index = self.db.personas._indexes['indexes'][0]
+        assert index['name'].startswith('personas_index_created_at_partial_')
+        assert index['partial_filter'] == {'status': 'open'}
+        assert self.index_sql(index['name']).endswith(
+            'WHERE json_extract(_data, \'$."status"\') = \'open\' AND '
+            'json_type(_data, \'$."status"\') NOT IN (\'array\', \'object\')'
+        )
+
+    def test_partial_index_on_indexed_field(self):
+        self.db.personas.create_index(
+            [('status', str), ('created_at', int)],
+            partial_filter={'status': 'open', 'created_at': {'$gt': 10}}
+        )
+        index = self.db.personas._indexes['indexes'][0]
+        assert self.index_sql(index['name']).endswith(
+            'WHERE "status" = \'open\' AND "created_at" > 10 AND '
+            'typeof("created_at") IN (\'integer\', \'real\')'
+        )
+
+    def test_queries_use_partial_index_when_implied(self):
+        self.db.personas.create_index(
+            ('created_at', int), partial_filter={'status': 'open'}
+        )
+        self.db.personas.insert_many([
+            {'status': 'open', 'created_at': 1},
+            {'status': 'closed', 'created_at': 2},
+        ])
+        name = self.db.personas._indexes['indexes'][0]['name']
+
+        def uses_index(query):
+            explanation = self.db.personas.explain(query)
+            assert explanation['index'] is None
+            return any(
+                'INDEX ' + name in step
+                for step in explanation['query_plan']
+            )
+
+        assert uses_index({'status': 'open', 'created_at': {'$gt': 0}})
+        assert not uses_index({'status': 'closed', 'created_at': {'$gt': 0}})
+        assert not uses_index({'created_at': {'$gt': 0}})
+        assert self.db.personas.find(
+            {'status': 'open', 'created_at': {'$gt': 0}}
+        ) == [{'status': 'open', 'created_at': 1}]
+
+    def test_partial_filter_values_are_escaped(self):
+        self.db.personas.create_index(
+            ('name', str), partial_filter={'title': "Mario's"}
+        )
+        index = self.db.personas._indexes['indexes'][0]
+        assert "= 'Mario''s' AND" in self.index_sql(index['name'])
+
+    def test_unsupported_partial_filter(self):
+        with pytest.raises(BadQuery):
+            self.db.personas.create_index(
+                ('name', str), partial_filter={'status': {'$in': ['open']}}
+            )
+        with pytest.raises(BadQuery):
+            self.db.personas.create_index(
+                ('name', str), partial_filter={'status?': 'open'}
+            )
@@ -0,0 +1,71 @@
+# External dependencies
+import pytest
+
+# Internal dependencies
+from factories import Persona
+from plume import Cursor, InvalidOperation
+from utils import ReadingBaseTest
+
+
+class TestCollectionCursor(ReadingBaseTest):
+
+    def setup_class(cls):
+        super().setup_class(cls)
+        cls.personas = [
+            Persona(age=age, meta__mastodon_followers=age)
+            for age in range(10, 60, 10)
+        ]
+        cls.db.personas.insert_many(cls.personas)
+
+    def test_find_returns_a_cursor(self):
+        cursor = self.db.personas.find({}, lazy=True)
+        assert isinstance(cursor, Cursor)
+        assert list(cursor) == self.personas
+
+    def test_iterate_with_small_batches(self):
+        cursor = self.db.personas.find({}, lazy=True).batch_size(2)
+        assert list(cursor) == self.personas
+
+    def test_selector_and_projection(self):
+        cursor = self.db.personas.find(
+            {'age': {'$gt': 20}}, {'name': 1}, lazy=True
+        )
+        assert list(cursor) == [
+            {'name': persona['name']} for persona in self.personas[2:]
+        ]
+
+    def test_limit(self):
+        cursor = self.db.personas.find({}, lazy=True).limit(2)
+        assert list(cursor) == self.personas[:2]
+
+    def test_skip(self):
+        cursor = self.db.personas.find({}, lazy=True).skip(3)
+        assert list(cursor) == self.personas[3:]
+
+    def test_skip_and_limit(self):
+        cursor = self.db.personas.find({}, lazy=True).skip(1).limit(2)
+        assert list(cursor) == self.personas[1:3]
+
+    def test_skip_and_limit_with_python_selector(self):
+        # Documents matched in Python can't be skipped or limited by SQLite.
+        query = {'friends': None, 'meta': {'$ne': {}}}
+        cursor = self.db.personas.find(query, lazy=True)
+        cursor.batch_size(1).skip(1).limit(2)
+        assert list(cursor) == self.personas[1:3]
+
+    def test_close(self):
+        cursor = self.db.personas.find({}, lazy=True).batch_size(1)
+        assert next(cursor) == self.personas[0]
+        cursor.close()
+        assert list(cursor) == []
+
+    def test_context_manager(self):
+        with self.db.personas.find({}, lazy=True) as cursor:
+            assert next(cursor) == self.personas[0]
+        assert list(cursor) == []
+
+    def test_cursor_can_not_be_modified_once_iterated(self):
+        cursor = self.db.personas.find({}, lazy=True)
+        next(cursor)
+        with pytest.raises(InvalidOperation):
+            cursor.limit(2)
@@ -0,0 +1,86 @@
+# Built-in dependencies
+import os
+
+# Internal dependencies
+from plume import Database
+
+
+class TestCollectionDistinct:
+
+    def setup(self):
+        self.db = Database('test.db')
+        self.db.events.insert_many([
+            {'kind': 'click', 'user': {'name': 'Mario'}, 'flag': True},
+            {'kind': 'view', 'user': {'name': 'Luigi'}, 'flag': 1},
+            {'kind': 'click', 'user': {'name': 'Mario'}, 'flag': None},
+            {'kind': 'scroll', 'tags': ['a', 'b']},
+            {'user': {'name': 'Peach'}, 'tags': ['a', 'b']},
+        ])
+
+    def last_statement(self):
+        return list(self.db._statements._entries)[-1]
+
+    def test_distinct_in_sql(self):
+        kinds = self.db.events.distinct('kind')
+        assert sorted(kinds) == ['click', 'scroll', 'view']
+        assert self.last_statement() == (
+            'SELECT DISTINCT _data -> \'$."kind"\' FROM events '
+            'WHERE _data -> \'$."kind"\' IS NOT NULL'
+        )
+
+    def test_distinct_values_keep_their_type(self):
+        flags = self.db.events.distinct('flag')
+        assert sorted(flags, key=repr) == [1, True]
+        assert self.db.events.distinct('tags') == [['a', 'b']]
+        assert self.db.events.distinct('user') == [
+            {'name': 'Mario'}, {'name': 'Luigi'}, {'name': 'Peach'}
+        ]
+
+    def test_distinct_with_query(self):
+        names = self.db.events.distinct('user.name', {'kind': 'click'})
+        assert names == ['Mario']
+
+    def test_distinct_on_indexed_field_walks_the_index(self):
+        self.db.events.create_index(('kind', str))
+        assert self.db.events.distinct('kind') == ['click', 'scroll', 'view']
+        statement = self.last_statement()
+        assert statement == (
+            'SELECT DISTINCT "kind" FROM events WHERE "kind" IS NOT NULL'
+        )
+        query_plan = self.db._connection.execute(
+            'EXPLAIN QUERY PLAN ' + statement
+        ).fetchall()
+        assert 'COVERING INDEX events_index_kind' in query_plan[0][3]
+
+    def test_distinct_in_python(self):
+        names = self.db.events.distinct(
+            'user.name', {'tags': ['a', 'b']}
+        )
+        assert names == ['Peach']
+        assert 'DISTINCT' not in self.last_statement()
+
+    def test_distinct_without_pushdown(self):
+        db = Database('test.db', pushdown=False)
+        assert db.events.distinct('user.name') == ['Mario', 'Luigi', 'Peach']
+        assert db.events.distinct('tags') == [['a', 'b']]
+
+    def test_distinct_in_python_keeps_types_apart(self):
+        self.db.events.insert_many([
+            {'flag': False}, {'flag': 0}, {'flag': 1.0}, {'flag': '[1]'},
+            {'flag': [1]},
+        ])
+        db = Database('test.db', pushdown=False)
+        flags = db.events.distinct('flag')
+        assert flags == [True, 1, False, 0, 1.0, '[1]', [1]]
+        assert sorted(flags, key=repr) == sorted(
+            self.db.events.distinct('flag'), key=repr
+        )
+
+    def test_lazy_distinct(self):
+        values = self.db.events.distinct('kind', lazy=True)
+        assert next(values) in ('click', 'scroll', 'view')
+        values.close()
+        assert list(self.db.events.distinct('missing', lazy=True)) == []
+
+    def teardown(self):
+        os.remove('test.db')
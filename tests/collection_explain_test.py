@@ -0,0 +1,169 @@
+# Built-in dependencies
+import os
+
+# External dependencies
+import pytest
+
+# Internal dependencies
+from plume import BadQuery, Database, DESCENDING
+from utils import WritingBaseTest
+
+
+class TestCollectionExplain(WritingBaseTest):
+
+    def test_first_query_is_not_cached(self):
+        explanation = self.db.personas.explain({'name': 'Mario'})
+        assert explanation['cached'] is False
+
+    def test_query_with_same_shape_reuses_plan(self):
+        collection = self.db.personas
+        collection.explain({'name': 'Mario', 'age': {'$gt': 18}})
+        explanation = collection.explain({'name': 'Luigi', 'age': {'$gt': 42}})
+        assert explanation['cached'] is True
+        assert explanation['params'] == ['Luigi', 42]
+
+    def test_query_with_another_operator_is_not_cached(self):
+        collection = self.db.personas
+        collection.explain({'age': {'$gt': 18}})
+        explanation = collection.explain({'age': {'$lt': 18}})
+        assert explanation['cached'] is False
+
+    def test_query_with_another_projection_is_not_cached(self):
+        collection = self.db.personas
+        collection.explain({'age': 18}, {'name': 1})
+        explanation = collection.explain({'age': 18}, {'age': 1})
+        assert explanation['cached'] is False
+
+    def test_query_with_none_value_has_its_own_plan(self):
+        collection = self.db.personas
+        collection.explain({'age': 18})
+        explanation = collection.explain({'age': None})
+        assert explanation['cached'] is False
+        assert explanation['params'] == []
+
+    def test_plan_of_non_sql_selector(self):
+        explanation = self.db.personas.explain({'friends': ['Luigi']})
+        assert explanation['sql'] == 'SELECT _data FROM personas'
+        assert explanation['python_filter'] is True
+
+    def test_cached_plan_matches_new_values(self):
+        collection = self.db.personas
+        collection.insert_many([
+            {'name': 'Mario', 'friends': ['Luigi']},
+            {'name': 'Luigi', 'friends': ['Mario']},
+        ])
+        assert collection.find({'friends': ['Luigi']}) == [
+            {'name': 'Mario', 'friends': ['Luigi']}
+        ]
+        assert collection.find({'friends': ['Mario']}) == [
+            {'name': 'Luigi', 'friends': ['Mario']}
+        ]
+
+    def test_new_index_invalidates_plans(self):
+        collection = self.db.personas
+        collection.explain({'name': 'Mario'})
+        collection.create_index([('name', str)])
+        explanation = collection.explain({'name': 'Mario'})
+        assert explanation['cached'] is False
+        assert explanation['sql'] == (
+            'SELECT _data FROM personas WHERE "name" = ?'
+        )
+
+    def test_query_is_not_altered(self):
+        query = {'$or': [{'name': 'Mario'}, {'age': {'$gt': 18}}]}
+        self.db.personas.find(query)
+        assert query == {'$or': [{'name': 'Mario'}, {'age': {'$gt': 18}}]}
+
+    def test_unknown_operator(self):
+        with pytest.raises(BadQuery):
+            self.db.personas.find({'age': {'$unknown': 18}})
+
+
+class TestPlanCacheSize:
+
+    def test_least_recently_used_plan_is_evicted(self):
+        db = Database('test.db', cached_plans=2)
+        collection = db.personas
+        collection.explain({'name': 'Mario'})
+        collection.explain({'age': 18})
+        collection.explain({'name': 'Luigi'})
+        collection.explain({'size': 1.8})
+        assert collection.explain({'age': 42})['cached'] is False
+        assert collection.explain({'name': 'Peach'})['cached'] is False
+
+    def teardown(self):
+        os.remove('test.db')
+
+
+class TestCollectionExplainWithIndexes(WritingBaseTest):
+
+    def setup(self):
+        super().setup()
+        self.collection = self.db.events
+        self.collection.create_index(('tenant', str))
+        self.collection.create_index([('tenant', str), ('created_at', int)])
+        self.collection.create_index(('created_at', int))
+        self.collection.insert_many([
+            {'tenant': tenant, 'created_at': created_at}
+            for tenant in ('mario', 'luigi') for created_at in range(5)
+        ])
+
+    def test_compound_index_serves_equality_then_range(self):
+        explanation = self.collection.explain(
+            {'tenant': 'mario', 'created_at': {'$gte': 3}}
+        )
+        assert explanation['index'] == 'events_index_tenant_created_at'
+        assert 'INDEXED BY "events_index_tenant_created_at"' in (
+            explanation['sql']
+        )
+        assert any(
+            'events_index_tenant_created_at' in step
+            for step in explanation['query_plan']
+        )
+        assert self.collection.find(
+            {'tenant': 'mario', 'created_at': {'$gte': 3}}
+        ) == [
+            {'tenant': 'mario', 'created_at': 3},
+            {'tenant': 'mario', 'created_at': 4},
+        ]
+
+    def test_smallest_index_serves_leftmost_prefix(self):
+        explanation = self.collection.explain({'tenant': 'mario'})
+        assert explanation['index'] == 'events_index_tenant'
+
+    def test_range_on_leading_key(self):
+        explanation = self.collection.explain({'created_at': {'$lt': 2}})
+        assert explanation['index'] == 'events_index_created_at'
+
+    def test_compound_index_is_not_used_without_its_leading_key(self):
+        self.db.logs.create_index([('tenant', str), ('created_at', int)])
+        explanation = self.db.logs.explain({'created_at': {'$lt': 2}})
+        assert explanation['index'] is None
+        assert 'INDEXED BY' not in explanation['sql']
+
+    def test_id_lookup_does_not_use_indexes(self):
+        explanation = self.collection.explain({'_id': 1, 'tenant': 'mario'})
+        assert explanation['index'] is None
+        assert 'INDEXED BY' not in explanation['sql']
+
+    def test_selectors_matched_in_python_are_ignored(self):
+        explanation = self.collection.explain(
+            {'tenant': {'$ne': 'mario'}, 'created_at': 1}
+        )
+        assert explanation['index'] == 'events_index_created_at'
+
+    def test_index_on_indexed_fields(self):
+        self.collection.create_index([('created_at', int), ('tenant', str)])
+        explanation = self.collection.explain(
+            {'created_at': 1, 'tenant': {'$gt': 'a'}}
+        )
+        assert explanation['index'] == 'events_index_created_at_tenant'
+        assert len(self.collection.find({'created_at': 1})) == 2
+
+    def test_index_keeps_its_order(self):
+        self.db.logs.create_index([('created_at', int, DESCENDING)])
+        row = self.db._connection.execute(
+            "SELECT sql FROM sqlite_master WHERE name = ?",
+            ['logs_index_created_at']
+        ).fetchone()
+        assert row[0].endswith('("created_at" DESC)')
@@ -0,0 +1,101 @@
+# Internal dependencies
+from factories import Persona
+from utils import ReadingBaseTest, WritingBaseTest
+
+
+class TestCollectionFindById(ReadingBaseTest):
+
+    def setup_class(cls):
+        super().setup_class(cls)
+        cls.personas = Persona.create_batch(3)
+        cls.ids = cls.db.personas.insert_many(cls.personas)
+
+    def test_find_by_id(self):
+        document = self.db.personas.find_by_id(self.ids[1])
+        assert document == self.personas[1]
+
+    def test_find_by_unknown_id(self):
+        assert self.db.personas.find_by_id(42) is None
+
+    def test_get_many(self):
+        documents = self.db.personas.get_many([self.ids[2], self.ids[0]])
+        assert documents == [self.personas[2], self.personas[0]]
+
+    def test_get_many_with_unknown_id(self):
+        documents = self.db.personas.get_many([self.ids[0], 42])
+        assert documents == [self.personas[0], None]
+
+    def test_get_many_without_json1(self):
+        self.db._json1 = False
+        try:
+            documents = self.db.personas.get_many(reversed(self.ids))
+        finally:
+            self.db._json1 = True
+        assert documents == self.personas[::-1]
+
+
+class TestCollectionFindOnId(ReadingBaseTest):
+
+    def setup_class(cls):
+        super().setup_class(cls)
+        cls.personas = Persona.create_batch(5)
+        cls.ids = cls.db.personas.insert_many(cls.personas)
+
+    def test_equal_selector(self):
+        result = self.db.personas.find({'_id': self.ids[2]})
+        assert result == [self.personas[2]]
+
+    def test_range_selector(self):
+        result = self.db.personas.find({
+            '_id': {'$gt': self.ids[1], '$lte': self.ids[3]}
+        })
+        assert result == self.personas[2:4]
+
+    def test_id_selector_matched_in_python(self):
+        result = self.db.personas.find({
+            '$or': [{'_id': self.ids[0]}, {'meta': {}}]
+        })
+        assert result == [self.personas[0]]
+
+    def test_find_with_id(self):
+        result = self.db.personas.find({}, with_id=True)
+        assert result == [
+            dict(persona, _id=_id)
+            for persona, _id in zip(self.personas, self.ids)
+        ]
+
+    def test_find_one_with_id_and_projection(self):
+        document = self.db.personas.find_one(
+            {'_id': self.ids[1]}, {'name': 1}, with_id=True
+        )
+        assert document == {'name': self.personas[1]['name'], '_id': 2}
+
+    def test_projection_include_id(self):
+        document = self.db.personas.find_one(
+            {'_id': self.ids[1]}, {'name': 1, '_id': 1}
+        )
+        assert document == {'name': self.personas[1]['name'], '_id': 2}
+
+    def test_replace_on_id(self):
+        self.db.personas.replace_one({'_id': self.ids[4]}, {'name': 'Mario'})
+        assert self.db.personas.find_by_id(self.ids[4]) == {'name': 'Mario'}
+
+
+class TestCollectionFindOnIdKeepsStoredId(WritingBaseTest):
+
+    def setup(self):
+        super().setup()
+        self.db.personas.insert_one({'_id': 'mine', 'a': 1})
+        self.db.personas.insert_one({'a': 2})
+
+    def test_id_selector_in_sql(self):
+        assert self.db.personas.find_one({'_id': 1}) == {'_id': 'mine', 'a': 1}
+        assert self.db.personas.find({'_id': {'$ne': 5}}) == [
+            {'_id': 'mine', 'a': 1}, {'a': 2}
+        ]
+
+    def test_id_selector_matched_in_python(self):
+        result = self.db.personas.find({
+            '$or': [{'_id': 1}, {'a': {'b': 1}}]
+        })
+        assert result == [{'_id': 'mine', 'a': 1}]
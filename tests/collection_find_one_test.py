@@ -61,6 +61,12 @@ class TestCollectionFindOne(ReadingBaseTest):
         })
         assert document == self.personas[0]
 
+    def test_equal_selector_with_quotes(self):
+        persona = Persona(name='Peter "Pete" O\'Toole')
+        self.db.personas.insert_one(persona)
+        document = self.db.personas.find_one({'name': persona['name']})
+        assert document == persona
+
     def test_projection_include_field(self):
         query = {'age': {'$lte': self.personas[1]['age']}}
         projection = {'name': 1}
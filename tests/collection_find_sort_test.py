@@ -0,0 +1,176 @@
+# Built-in dependencies
+import os
+
+# External dependencies
+import pytest
+
+# Internal dependencies
+from plume import ASCENDING, BadQuery, Database, DESCENDING
+
+
+EVENTS = [
+    {'kind': 'click', 'created_at': 3, 'user': {'name': 'Mario'}},
+    {'kind': 'view', 'created_at': 1, 'user': {'name': 'Luigi'}},
+    {'kind': 'click', 'created_at': 5, 'user': {'name': 'Peach'}},
+    {'kind': 'view', 'created_at': 4, 'user': {'name': 'Toad'}},
+    {'kind': 'click', 'created_at': 2, 'user': {'name': 'Yoshi'}},
+]
+
+
+class TestCollectionFindWithSort:
+
+    def setup(self):
+        self.db = Database('test.db')
+        self.db.events.insert_many(EVENTS)
+
+    def created_at(self, documents):
+        return [document['created_at'] for document in documents]
+
+    def test_sort_on_non_indexed_field(self):
+        result = self.db.events.find({}, sort=[('created_at', DESCENDING)])
+        assert self.created_at(result) == [5, 4, 3, 2, 1]
+        explanation = self.db.events.explain(
+            {}, sort=[('created_at', DESCENDING)]
+        )
+        assert explanation['sql'].endswith(
+            'THEN CAST(json_extract(_data, \'$."created_at"\') AS BLOB) '
+            'ELSE json_extract(_data, \'$."created_at"\') END DESC'
+        )
+        assert explanation['python_sort'] is False
+
+    def test_sort_on_mixed_types_as_python(self):
+        self.db.events.insert_many([
+            {'created_at': value}
+            for value in ('late', [1], {'day': 1}, True, None)
+        ])
+        sort = [('created_at', ASCENDING)]
+        result = self.db.events.find({}, sort=sort)
+        assert self.db.events.explain({}, sort=sort)['python_sort'] is False
+        assert result == Database('test.db', pushdown=False).events.find(
+            {}, sort=sort
+        )
+        assert [document.get('created_at') for document in result][-3:] == [
+            'late', [1], {'day': 1}
+        ]
+
+    def test_sort_on_single_key_shortcut(self):
+        result = self.db.events.find({}, sort=('created_at', ASCENDING))
+        assert self.created_at(result) == [1, 2, 3, 4, 5]
+
+    def test_sort_on_nested_field(self):
+        result = self.db.events.find({}, sort=[('user.name', DESCENDING)])
+        assert result[0]['user']['name'] == 'Yoshi'
+
+    def test_sort_on_several_keys(self):
+        result = self.db.events.find(
+            {}, sort=[('kind', DESCENDING), ('created_at', ASCENDING)]
+        )
+        assert self.created_at(result) == [1, 4, 2, 3, 5]
+
+    def test_sort_with_limit_and_skip(self):
+        result = self.db.events.find(
+            {'kind': 'click'}, sort=[('created_at', ASCENDING)],
+            limit=2, skip=1
+        )
+        assert self.created_at(result) == [3, 5]
+
+    def test_sort_with_python_filter(self):
+        result = self.db.events.find(
+            {'user': {'name': 'Mario'}, 'kind': 'click'},
+            sort=[('created_at', ASCENDING)], limit=2
+        )
+        assert self.created_at(result) == [3]
+
+    def test_sort_on_indexed_field_uses_index_order(self):
+        self.db.events.create_index(('created_at', int, DESCENDING))
+        self.db.events.create_index(('kind', str))
+        explanation = self.db.events.explain(
+            {}, sort=[('created_at', DESCENDING)], limit=2
+        )
+        assert explanation['sql'].endswith(
+            'ORDER BY "created_at" DESC LIMIT ?'
+        )
+        assert not any(
+            'TEMP B-TREE' in step for step in explanation['query_plan']
+        )
+        assert self.created_at(self.db.events.find(
+            {}, sort=[('created_at', DESCENDING)], limit=2
+        )) == [5, 4]
+
+    def test_index_serving_equality_and_sort(self):
+        self.db.events.create_index(('kind', str))
+        self.db.events.create_index([('kind', str), ('created_at', int)])
+        query = {'kind': 'view'}
+        sort = [('created_at', DESCENDING)]
+        explanation = self.db.events.explain(query, sort=sort, limit=2)
+        assert explanation['index'] == 'events_index_kind_created_at'
+        assert not any(
+            'TEMP B-TREE' in step for step in explanation['query_plan']
+        )
+        assert self.created_at(
+            self.db.events.find(query, sort=sort, limit=2)
+        ) == [4, 1]
+
+    def test_sort_on_id(self):
+        result = self.db.events.find(
+            {}, sort=[('_id', DESCENDING)], with_id=True
+        )
+        assert [document['_id'] for document in result] == [5, 4, 3, 2, 1]
+
+    def test_missing_fields_are_sorted_first(self):
+        self.db.events.insert_one({'kind': 'scroll'})
+        result = self.db.events.find({}, sort=[('created_at', ASCENDING)])
+        assert result[0] == {'kind': 'scroll'}
+
+    def test_lazy_cursor_sort(self):
+        cursor = self.db.events.find({}, lazy=True)
+        cursor.sort([('created_at', DESCENDING)]).limit(2)
+        assert self.created_at(cursor) == [5, 4]
+
+    def test_find_one_sort(self):
+        document = self.db.events.find_one(
+            {'kind': 'view'}, sort=[('created_at', DESCENDING)]
+        )
+        assert document['created_at'] == 4
+
+    def test_invalid_sort(self):
+        with pytest.raises(BadQuery):
+            self.db.events.find({}, sort=[('created_at', 1)])
+
+    def teardown(self):
+        os.remove('test.db')
+
+
+class TestCollectionFindWithSortInPython:
+
+    def setup(self):
+        self.db = Database('test.db', pushdown=False)
+        self.db.events.insert_many(EVENTS)
+        self.db.events.insert_one({'kind': 'scroll', 'created_at': 'late'})
+
+    def test_sort_in_python(self):
+        explanation = self.db.events.explain(
+            {}, sort=[('created_at', DESCENDING)], limit=3, skip=1
+        )
+        assert explanation['python_sort'] is True
+        assert 'ORDER BY' not in explanation['sql']
+        assert 'LIMIT' not in explanation['sql']
+        result = self.db.events.find(
+            {}, sort=[('created_at', DESCENDING)], limit=3, skip=1
+        )
+        assert [document['created_at'] for document in result] == [5, 4, 3]
+
+    def test_python_sort_orders_types_as_sqlite(self):
+        self.db.events.insert_one({'kind': 'hover'})
+        result = self.db.events.find({}, sort=[('created_at', ASCENDING)])
+        created_at = [document.get('created_at') for document in result]
+        assert created_at == [None, 1, 2, 3, 4, 5, 'late']
+
+    def test_sort_on_projected_out_field(self):
+        result = self.db.events.find(
+            {'kind': 'click'}, {'kind': 1}, sort=[('created_at', DESCENDING)]
+        )
+        assert result == [{'kind': 'click'}] * 3
+
+    def teardown(self):
+        os.remove('test.db')
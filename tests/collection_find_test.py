@@ -1,5 +1,9 @@
+# Built-in dependencies
+import json
+
 # Internal dependencies
 from factories import Persona
+from plume import Database, DESCENDING
 from utils import ReadingBaseTest, with_index, WritingBaseTest
 
 
@@ -215,3 +219,376 @@ class TestCollectionFindWithIndex(WritingBaseTest):
             documents[1]['meta']['mastodon_followers'] ==
             self.personas[2]['meta']['mastodon_followers']
         )
+
+
+class TestCollectionFindWithoutPushdown(ReadingBaseTest):
+
+    def setup_class(cls):
+        cls.db = Database('test.db', pushdown=False)
+        cls.personas = [
+            Persona(age=10, meta__mastodon_followers=10),
+            Persona(age=20, meta__mastodon_followers=20),
+            Persona(age=30, meta__mastodon_followers=30)
+        ]
+        cls.db.personas.insert_many(cls.personas)
+
+    def test_greater_than_selector_on_nested_field(self):
+        result = self.db.personas.find({
+            'meta.mastodon_followers': {'$gt': 10}
+        })
+        assert result == self.personas[1:]
+
+    def test_or_selector(self):
+        result = self.db.personas.find({
+            '$or': [{'age': 10}, {'name': self.personas[2]['name']}]
+        })
+        assert result == [self.personas[0], self.personas[2]]
+
+
+class TestCollectionFindWithPushdown(WritingBaseTest):
+
+    def setup(self):
+        super().setup()
+        self.personas = [
+            Persona(age=10, meta__mastodon_followers=10),
+            Persona(age=20, meta__mastodon_followers=20),
+            Persona(age=30, meta__mastodon_followers=30)
+        ]
+        self.db.personas.insert_many(self.personas)
+
+    def test_not_equal_selector_matches_missing_field(self):
+        self.db.personas.insert_one({'name': 'Nobody'})
+        result = self.db.personas.find({'age': {'$ne': 10}})
+        assert len(result) == 3
+        assert result[-1] == {'name': 'Nobody'}
+
+    def test_equal_none_selector_matches_missing_field(self):
+        self.db.personas.insert_one({'name': 'Nobody'})
+        result = self.db.personas.find({'age': None})
+        assert result == [{'name': 'Nobody'}]
+
+    def test_or_selector_on_nested_fields(self):
+        result = self.db.personas.find({
+            '$or': [
+                {'meta.mastodon_followers': {'$lt': 15}},
+                {'meta.mastodon_followers': {'$gte': 30}},
+            ]
+        })
+        assert result == [self.personas[0], self.personas[2]]
+
+    def test_selector_with_non_scalar_value(self):
+        self.db.personas.insert_one({'name': 'Mario', 'friends': ['Luigi']})
+        result = self.db.personas.find({
+            'name': 'Mario', 'friends': ['Luigi']
+        })
+        assert result == [{'name': 'Mario', 'friends': ['Luigi']}]
+
+
+class TestCollectionFindWithLimit(WritingBaseTest):
+
+    def setup(self):
+        super().setup()
+        self.personas = [
+            Persona(age=age % 3, friends=[age % 2]) for age in range(250)
+        ]
+        self.db.personas.insert_many(self.personas)
+
+    def test_limit_is_applied_by_sqlite(self):
+        query = {'age': 1}
+        explanation = self.db.personas.explain(query, limit=5)
+        assert explanation['sql'].endswith('LIMIT ?')
+        assert explanation['params'] == [1, 5]
+        result = self.db.personas.find(query, limit=5)
+        assert result == [
+            persona for persona in self.personas if persona['age'] == 1
+        ][:5]
+
+    def test_limit_with_python_selector(self):
+        query = {'friends': [1], 'age': {'$gte': 1}}
+        explanation = self.db.personas.explain(query, limit=5)
+        assert 'LIMIT' not in explanation['sql']
+        result = self.db.personas.find(query, limit=5)
+        assert result == [
+            persona for persona in self.personas
+            if persona['friends'] == [1] and persona['age'] >= 1
+        ][:5]
+
+    def test_find_one_with_python_selector(self):
+        query = {'friends': [1], 'age': 0}
+        document = self.db.personas.find_one(query)
+        assert document == self.personas[3]
+
+    def test_find_one_without_match(self):
+        assert self.db.personas.find_one({'friends': [2]}) is None
+
+    def count_decoded_documents(self, monkeypatch) -> list:
+        decoded = []
+        loads = json.loads
+
+        def counting_loads(data, *args, **kwargs):
+            decoded.append(data)
+            return loads(data, *args, **kwargs)
+
+        monkeypatch.setattr(json, 'loads', counting_loads)
+        return decoded
+
+    def test_rows_past_the_limit_are_not_decoded(self, monkeypatch):
+        decoded = self.count_decoded_documents(monkeypatch)
+        query = {'friends': [1], 'age': {'$gte': 1}}
+        assert len(self.db.personas.find(query, limit=5)) == 5
+        # Only the candidates up to the fifth match, the 14th document,
+        # are decoded: those of age 0 are left out by SQLite.
+        assert len(decoded) == 9
+
+    def test_lazy_cursor_stops_on_break(self, monkeypatch):
+        decoded = self.count_decoded_documents(monkeypatch)
+        cursor = self.db.personas.find(
+            {'friends': [1]}, lazy=True
+        ).batch_size(10)
+        for document in cursor:
+            if document['age'] == 2:
+                break
+        cursor.close()
+        assert document == self.personas[5]
+        assert len(decoded) == 6
+
+
+class TestCollectionFindWithMembership(ReadingBaseTest):
+
+    def setup_class(cls):
+        super().setup_class(cls)
+        cls.personas = [Persona(age=age) for age in range(10, 60, 10)]
+        cls.personas.append({'name': 'Nobody'})
+        cls.db.personas.insert_many(cls.personas)
+
+    def test_in_selector(self):
+        result = self.db.personas.find({'age': {'$in': [20, 40, 41]}})
+        assert result == [self.personas[1], self.personas[3]]
+
+    def test_not_in_selector(self):
+        result = self.db.personas.find({'age': {'$nin': [20, 40, 41]}})
+        assert result == [
+            self.personas[0], self.personas[2], self.personas[4],
+            self.personas[5],
+        ]
+
+    def test_in_selector_with_none(self):
+        result = self.db.personas.find({'age': {'$in': [None, 10]}})
+        assert result == [self.personas[0], self.personas[5]]
+
+    def test_in_selector_on_indexed_field(self):
+        self.db.personas.create_index([('name', str)])
+        names = [persona['name'] for persona in self.personas[::2]]
+        result = self.db.personas.find({'name': {'$in': names}})
+        assert len(result) == 3
+        result_names = [document['name'] for document in result]
+        assert sorted(result_names) == sorted(names)
+
+    def test_in_selector_on_ids(self):
+        result = self.db.personas.find({'_id': {'$in': [2, 3]}})
+        assert result == self.personas[1:3]
+
+    def test_in_selector_without_pushdown(self):
+        self.db._pushdown = False
+        try:
+            result = self.db.personas.find({'age': {'$in': (20, 40)}})
+        finally:
+            self.db._pushdown = True
+        assert result == [self.personas[1], self.personas[3]]
+
+    def test_in_selector_on_ids_without_pushdown(self):
+        self.db._pushdown = False
+        try:
+            explanation = self.db.personas.explain(
+                {'_id': {'$in': [2, 3]}}
+            )
+            result = self.db.personas.find({'_id': {'$in': [2, 3]}})
+        finally:
+            self.db._pushdown = True
+        assert explanation['sql'] == (
+            'SELECT _data FROM personas '
+            'WHERE id IN (SELECT value FROM json_each(?))'
+        )
+        assert explanation['python_filter'] is False
+        assert result == self.personas[1:3]
+
+
+class TestCollectionFindCoveredByIndex(WritingBaseTest):
+
+    def setup(self):
+        super().setup()
+        self.personas = [
+            Persona(age=10), Persona(age=20), Persona(age=30)
+        ]
+        self.db.personas.insert_many(self.personas)
+        self.db.personas.create_index([('age', int), ('name', str)])
+        self.db.personas.create_index(('size', float))
+
+    def test_projected_columns_are_selected_in_order(self):
+        query = {'age': {'$gte': 20}}
+        projection = {'name': 1, 'age': 1}
+        explanation = self.db.personas.explain(query, projection)
+        assert explanation['sql'].startswith(
+            'SELECT "age", "name" FROM personas'
+        )
+        assert explanation['index_only'] is True
+        assert any(
+            'COVERING INDEX personas_index_age_name' in step
+            for step in explanation['query_plan']
+        )
+        assert self.db.personas.find(query, projection) == [
+            {'name': persona['name'], 'age': persona['age']}
+            for persona in self.personas[1:]
+        ]
+
+    def test_covered_query_with_id(self):
+        documents = self.db.personas.find(
+            {'age': 10}, {'name': 1}, with_id=True
+        )
+        assert documents == [{'_id': 1, 'name': self.personas[0]['name']}]
+
+    def test_covered_query_with_sort(self):
+        documents = self.db.personas.find(
+            {}, {'size': 1}, sort=[('size', DESCENDING)]
+        )
+        sizes = sorted(persona['size'] for persona in self.personas)
+        assert documents == [{'size': size} for size in reversed(sizes)]
+
+    def test_filter_on_non_indexed_field(self):
+        query = {'meta.mastodon_followers': {'$gte': 0}}
+        explanation = self.db.personas.explain(query, {'age': 1})
+        assert explanation['index_only'] is True
+        assert len(self.db.personas.find(query, {'age': 1})) == 3
+
+    def test_projection_of_non_indexed_field(self):
+        explanation = self.db.personas.explain({'age': 10}, {'meta': 1})
+        assert explanation['index_only'] is False
+        assert explanation['sql'].startswith("SELECT json_object('meta'")
+
+    def test_projection_with_python_filter(self):
+        query = {'meta': {'mastodon_followers': {'$gte': 0}}}
+        explanation = self.db.personas.explain(query, {'age': 1})
+        assert explanation['python_filter'] is True
+        assert explanation['index_only'] is False
+
+
+class TestCollectionFindWithProjectionPushdown(WritingBaseTest):
+
+    def setup(self):
+        super().setup()
+        self.db.personas.insert_many([
+            {'name': 'Mario', 'alive': True, 'meta': {'a': 1, 'b': [1]}},
+            {'name': 'Luigi', 'alive': False, 'meta': {'b': None}},
+        ])
+
+    def test_include_projection_is_applied_by_sqlite(self):
+        projection = {'alive': 1, 'meta.b': 1}
+        explanation = self.db.personas.explain({}, projection)
+        assert explanation['sql'] == (
+            'SELECT json_object(\'alive\', _data -> \'$."alive"\', '
+            '\'meta\', json_object(\'b\', _data -> \'$."meta"."b"\')) '
+            'FROM personas'
+        )
+        assert self.db.personas.find({}, projection) == [
+            {'alive': True, 'meta': {'b': [1]}},
+            {'alive': False, 'meta': {'b': None}},
+        ]
+
+    def test_missing_fields_are_projected_as_none(self):
+        documents = self.db.personas.find({}, {'meta.a': 1, 'size': 1})
+        assert documents == [
+            {'meta': {'a': 1}, 'size': None},
+            {'meta': {'a': None}, 'size': None},
+        ]
+
+    def test_exclude_projection_is_applied_by_sqlite(self):
+        projection = {'meta.b': 0, 'alive': 0}
+        explanation = self.db.personas.explain({}, projection)
+        assert explanation['sql'].startswith(
+            'SELECT json_remove(_data, \'$."alive"\', \'$."meta"."b"\')'
+        )
+        assert self.db.personas.find({}, projection) == [
+            {'name': 'Mario', 'meta': {'a': 1}}, {'name': 'Luigi', 'meta': {}}
+        ]
+
+    def test_projection_with_id(self):
+        documents = self.db.personas.find(
+            {'name': 'Luigi'}, {'name': 1}, with_id=True
+        )
+        assert documents == [{'_id': 2, 'name': 'Luigi'}]
+        documents = self.db.personas.find({'_id': 1}, {'name': 1})
+        assert documents == [{'name': 'Mario'}]
+
+    def test_projection_with_python_filter(self):
+        query = {'meta': {'a': 1, 'b': [1]}}
+        explanation = self.db.personas.explain(query, {'name': 1})
+        assert explanation['sql'].startswith('SELECT _data')
+        assert self.db.personas.find(query, {'name': 1}) == [
+            {'name': 'Mario'}
+        ]
+
+    def test_overlapping_fields_are_projected_in_python(self):
+        projection = {'meta': 1, 'meta.a': 1}
+        explanation = self.db.personas.explain({}, projection)
+        assert explanation['sql'] == 'SELECT _data FROM personas'
+
+    def test_projection_without_pushdown(self):
+        db = Database('test.db', pushdown=False)
+        explanation = db.personas.explain({}, {'name': 1})
+        assert explanation['sql'] == 'SELECT _data FROM personas'
+        assert db.personas.find({}, {'name': 1}) == [
+            {'name': 'Mario'}, {'name': 'Luigi'}
+        ]
+
+
+class TestCollectionFindOnMixedTypes(WritingBaseTest):
+
+    VALUES = [
+        7, 5, 2.5, True, 'abc', '[1,2]', [1, 2], {'x': 1}, None, []
+    ]
+
+    QUERIES = [
+        {'a': {'$gt': 5}},
+        {'a': {'$gte': 5}},
+        {'a': {'$lt': 5}},
+        {'a': {'$lte': 'b'}},
+        {'a': {'$gt': 'a'}},
+        {'a': '[1,2]'},
+        {'a': {'$ne': '[1,2]'}},
+        {'a': 5},
+        {'a': {'$ne': 5}},
+        {'$or': [{'a': {'$gt': 6}}, {'a': 'abc'}]},
+        {'a': {'$in': [5, 'abc', '[1,2]']}},
+        {'a': {'$nin': [5, 'abc', '[1,2]']}},
+    ]
+
+    def setup(self):
+        super().setup()
+        self.db.items.insert_many([{'a': value} for value in self.VALUES])
+        self.db.items.insert_one({'b': 1})
+
+    def test_pushdown_matches_python(self):
+        db = Database('test.db', pushdown=False)
+        for query in self.QUERIES:
+            assert self.db.items.explain(query)['python_filter'] is False
+            assert self.db.items.find(query) == db.items.find(query), query
+
+    def test_range_selectors_only_match_values_of_the_same_type(self):
+        assert self.db.items.find({'a': {'$gt': 5}}) == [{'a': 7}]
+        assert self.db.items.find({'a': {'$lt': 'b'}}) == [
+            {'a': 'abc'}, {'a': '[1,2]'}
+        ]
+        assert self.db.items.find({'a': '[1,2]'}) == [{'a': '[1,2]'}]
+
+    def test_membership_of_lists_and_documents(self):
+        db = Database('test.db', pushdown=False)
+        assert db.items.find({'a': {'$in': ['[1,2]', 7]}}) == [
+            {'a': 7}, {'a': '[1,2]'}
+        ]
+        assert len(db.items.find({'a': {'$nin': ['[1,2]', 7]}})) == 9
+
+    def test_indexed_field_matches_python(self):
+        self.db.items.create_index(('a', int))
+        db = Database('test.db', pushdown=False)
+        for query in self.QUERIES[:5]:
+            assert self.db.items.find(query) == db.items.find(query), query
@@ -32,6 +32,28 @@ class TestCollectionInsertMany(InsertManyBaseTest):
         assert json.loads(documents[1][0]) == self.personas[1]
         assert json.loads(documents[2][0]) == self.personas[2]
 
+    def test_insert_returns_document_ids(self):
+        self.db.personas.insert_one(Persona())
+        ids = self.db.personas.insert_many(self.personas)
+        assert list(ids) == [2, 3, 4]
+        rows = self.db._connection.execute(
+            'SELECT id, _data FROM personas WHERE id >= 2'
+        ).fetchall()
+        assert [row[0] for row in rows] == list(ids)
+        assert [json.loads(row[1]) for row in rows] == self.personas
+
+    def test_insert_nothing(self):
+        assert list(self.db.personas.insert_many([])) == []
+
+    def test_insert_documents_from_a_generator(self):
+        self.db.personas.insert_many(
+            persona for persona in self.personas
+        )
+        documents = self.db._connection.execute(
+            'SELECT _data FROM personas'
+        ).fetchall()
+        assert [json.loads(row[0]) for row in documents] == self.personas
+
 
 class TestCollectionInsertManyWithIndex(InsertManyBaseTest):
 
@@ -21,6 +21,12 @@ class TestCollectionInsertOne(InsertOneBaseTest):
         ).fetchone()
         assert row[0] == 1
 
+    def test_insert_returns_document_id(self):
+        first_id = self.db.personas.insert_one(self.persona)
+        second_id = self.db.personas.insert_one(Persona())
+        assert first_id == 1
+        assert second_id == 2
+
     def test_retrieve_document_values(self):
         self.db.personas.insert_one(self.persona)
         document = self.db._connection.execute(
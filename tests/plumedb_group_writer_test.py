@@ -0,0 +1,93 @@
+# Built-in dependencies
+import threading
+
+# External dependencies
+import pytest
+
+# Internal dependencies
+from plume import Database, GroupCommitWriter, InvalidOperation
+from utils import WritingBaseTest
+
+
+class TestGroupCommitWriter(WritingBaseTest):
+
+    def setup(self):
+        self.db = Database('test.db', journal_mode='wal', pool_size=2)
+
+    def test_requires_a_pooled_database(self):
+        with pytest.raises(InvalidOperation):
+            Database('test.db').group_writer()
+
+    def test_insert_one_resolves_to_document_id(self):
+        with self.db.group_writer() as writer:
+            assert isinstance(writer, GroupCommitWriter)
+            futures = [
+                writer.users.insert_one({'age': age}) for age in range(3)
+            ]
+            ids = [future.result(timeout=5) for future in futures]
+        assert ids == [1, 2, 3]
+        assert self.db.users.find_by_id(3) == {'age': 2}
+
+    def test_operations_are_committed_together(self):
+        writer = self.db.group_writer(max_delay=1, max_batch=10)
+        futures = [
+            writer.users.insert_one({'age': age}) for age in range(10)
+        ]
+        for future in futures:
+            future.result(timeout=5)
+        assert writer._flushes == 1
+        writer.close()
+        assert len(self.db.users.find({})) == 10
+
+    def test_close_flushes_queued_operations(self):
+        writer = self.db.group_writer(max_delay=60)
+        future = writer.users.insert_one({'name': 'Mario'})
+        writer.close()
+        assert future.result(timeout=0) == 1
+        with pytest.raises(InvalidOperation):
+            writer.users.insert_one({'name': 'Luigi'})
+
+    def test_replace_one(self):
+        self.db.users.insert_one({'name': 'Mario', 'age': 42})
+        with self.db.group_writer() as writer:
+            future = writer.users.replace_one(
+                {'name': 'Mario'}, {'name': 'Mario', 'age': 43}
+            )
+            future.result(timeout=5)
+        assert self.db.users.find({}) == [{'name': 'Mario', 'age': 43}]
+
+    def test_failing_operation_does_not_abort_the_others(self):
+        with self.db.group_writer(max_delay=1, max_batch=3) as writer:
+            first = writer.users.insert_one({'name': 'Mario'})
+            failing = writer.users.replace_one(
+                {'name': {'$unknown': 1}}, {'name': 'Luigi'}
+            )
+            last = writer.users.insert_one({'name': 'Peach'})
+            assert first.result(timeout=5) == 1
+            assert last.result(timeout=5) == 2
+            with pytest.raises(ValueError):
+                failing.result(timeout=5)
+        assert len(self.db.users.find({})) == 2
+
+    def test_threads_share_a_writer(self):
+        with self.db.group_writer() as writer:
+            ids = []
+
+            def work(worker):
+                futures = [
+                    writer.events.insert_one({'worker': worker})
+                    for _ in range(50)
+                ]
+                ids.extend(future.result(timeout=5) for future in futures)
+
+            threads = [
+                threading.Thread(target=work, args=(worker,))
+                for worker in range(4)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        assert sorted(ids) == list(range(1, 201))
+        assert writer._flushes < 200
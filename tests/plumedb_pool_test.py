@@ -0,0 +1,146 @@
+# Built-in dependencies
+import threading
+
+# External dependencies
+import pytest
+
+# Internal dependencies
+from plume import BadSetting, Database, InvalidOperation, transactional
+from utils import WritingBaseTest
+
+
+class TestDatabasePool(WritingBaseTest):
+
+    def test_database_is_not_pooled_by_default(self):
+        db = Database('test.db')
+        assert db._pool is None
+        assert db.pool_info() is None
+
+    def test_in_memory_database_cannot_be_pooled(self):
+        with pytest.raises(BadSetting):
+            Database(':memory:', pool_size=2)
+
+    def test_reads_check_out_reader_connections(self):
+        db = Database('test.db', journal_mode='wal', pool_size=2)
+        db.users.insert_one({'name': 'Mario'})
+        assert db.users.find({}) == [{'name': 'Mario'}]
+        assert db.users.find_by_id(1) == {'name': 'Mario'}
+        assert db.users.get_many([1]) == [{'name': 'Mario'}]
+        info = db.pool_info()
+        assert info.size == 2
+        assert info.available == 2
+        assert info.checkouts == 3
+        assert info.waits == 0
+
+    def test_statement_caches_of_readers_are_reported(self):
+        db = Database('test.db', cached_statements=16, pool_size=2)
+        db.users.insert_one({'user_id': 0})
+        hits, misses, maxsize, _ = db.statement_cache_info()
+        assert maxsize == 48
+        for user_id in range(3):
+            db.users.find_one({'user_id': user_id})
+        info = db.statement_cache_info()
+        assert info.misses == misses + 1
+        assert info.hits == hits + 2
+
+    def test_cursor_holds_its_connection_until_closed(self):
+        db = Database('test.db', pool_size=1)
+        db.users.insert_many([{'age': age} for age in range(3)])
+        with db.users.find({}, lazy=True) as cursor:
+            next(cursor)
+            assert db.pool_info().available == 0
+        assert db.pool_info().available == 1
+
+    def test_thread_reuses_the_connection_of_its_cursor(self):
+        db = Database('test.db', pool_size=1, pool_timeout=1)
+        db.users.insert_many([{'age': age} for age in range(3)])
+        ages = []
+        for document in db.users.find({}, lazy=True):
+            ages.append(db.users.find_one({'age': document['age']})['age'])
+        assert ages == [0, 1, 2]
+        info = db.pool_info()
+        assert info.available == 1
+        assert info.waits == 0
+
+    def test_read_times_out_while_connections_are_held(self):
+        db = Database('test.db', pool_size=1, pool_timeout=0.05)
+        db.users.insert_many([{'age': age} for age in range(3)])
+        errors = []
+
+        def read():
+            try:
+                db.users.find({})
+            except InvalidOperation as error:
+                errors.append(error)
+
+        with db.users.find({}, lazy=True) as cursor:
+            next(cursor)
+            thread = threading.Thread(target=read)
+            thread.start()
+            thread.join()
+        assert len(errors) == 1
+        assert db.pool_info().available == 1
+        assert db.users.find({}) == [{'age': 0}, {'age': 1}, {'age': 2}]
+
+    def test_transaction_reads_its_own_writes(self):
+        db = Database('test.db', journal_mode='wal', pool_size=1)
+
+        class Writer:
+            _db = db
+
+            @transactional
+            def insert_and_find(self):
+                db.users.insert_one({'name': 'Mario'})
+                return db.users.find({})
+
+        assert Writer().insert_and_find() == [{'name': 'Mario'}]
+
+    def test_threads_register_a_new_collection_once(self):
+        db = Database('test.db', journal_mode='wal', pool_size=4)
+        barrier = threading.Barrier(8)
+        errors = []
+
+        def work(worker):
+            try:
+                barrier.wait()
+                db.users.insert_one({'worker': worker})
+            except Exception as error:
+                errors.append(error)
+
+        threads = [
+            threading.Thread(target=work, args=(worker,))
+            for worker in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert errors == []
+        assert len(db.users.find({})) == 8
+
+    def test_threads_share_a_pooled_database(self):
+        db = Database('test.db', journal_mode='wal', pool_size=4)
+        db.users.insert_one({'worker': -1})
+        errors = []
+
+        def work(worker):
+            try:
+                for _ in range(20):
+                    db.users.insert_one({'worker': worker})
+                    db.users.find({'worker': worker})
+            except Exception as error:
+                errors.append(error)
+
+        threads = [
+            threading.Thread(target=work, args=(worker,))
+            for worker in range(8)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert errors == []
+        assert db.pool_info().checkouts == 160
+        assert len(db.users.find({})) == 161
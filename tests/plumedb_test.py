@@ -1,9 +1,12 @@
 # Built-in dependencies
 import os
 
+# External dependencies
+import pytest
+
 # Internal dependencies
-from plume import Collection, Database
-from utils import collection_is_registered
+from plume import BadSetting, Collection, Database, Transaction
+from utils import collection_is_registered, remove_database
 
 
 class TestDatabase:
@@ -32,5 +35,79 @@ class TestDatabase:
         assert collection._name == 'users'
         assert collection._registered is False
 
+    def test_pushdown_is_enabled_by_default(self):
+        db = Database('test.db')
+        assert db._pushdown is True
+
+    def test_disable_pushdown(self):
+        db = Database('test.db', pushdown=False)
+        assert db._pushdown is False
+
+    def test_statement_cache_size(self):
+        db = Database('test.db', cached_statements=16)
+        assert db.statement_cache_info().maxsize == 16
+
+    def test_statement_cache_reuses_query_shapes(self):
+        db = Database('test.db')
+        db.users.insert_one({'user_id': 0})
+        hits, misses, _, _ = db.statement_cache_info()
+        for user_id in range(3):
+            db.users.find_one({'user_id': user_id})
+        info = db.statement_cache_info()
+        assert info.misses == misses + 1
+        assert info.hits == hits + 2
+
+    def test_default_settings(self):
+        db = Database('test.db')
+        settings = db.settings()
+        assert settings['journal_mode'] == 'delete'
+        assert settings['synchronous'] == 'full'
+
+    def test_throughput_profile(self):
+        db = Database('test.db', profile='throughput')
+        settings = db.settings()
+        assert settings['journal_mode'] == 'wal'
+        assert settings['synchronous'] == 'normal'
+        assert settings['temp_store'] == 'memory'
+        assert settings['cache_size'] == -64000
+        assert settings['mmap_size'] == 268435456
+
+    def test_settings_override_profile(self):
+        db = Database(
+            'test.db', profile='throughput', synchronous='FULL',
+            page_size=8192,
+        )
+        settings = db.settings()
+        assert settings['journal_mode'] == 'wal'
+        assert settings['synchronous'] == 'full'
+        assert settings['page_size'] == 8192
+
+    def test_wal_readers_do_not_block_behind_writers(self):
+        db = Database('test.db', journal_mode='wal')
+        db.users.insert_one({'name': 'Mario'})
+        reader = Database('test.db')
+        with Transaction(db._connection):
+            db.users.insert_one({'name': 'Luigi'})
+            assert reader.users.find({}) == [{'name': 'Mario'}]
+        assert len(reader.users.find({})) == 2
+
+    def test_reopen_database_with_indexes(self):
+        db = Database('test.db')
+        db.users.create_index(('name', str))
+        db.users.insert_one({'name': 'Mario'})
+        reopened = Database('test.db')
+        assert reopened.users._indexed_fields == ['name']
+        assert reopened.users.find({'name': 'Mario'}) == [{'name': 'Mario'}]
+
+    def test_unknown_profile(self):
+        with pytest.raises(BadSetting):
+            Database('test.db', profile='fastest')
+
+    def test_bad_setting_value(self):
+        with pytest.raises(BadSetting):
+            Database('test.db', journal_mode='wal; DROP TABLE plume_master')
+        with pytest.raises(BadSetting):
+            Database('test.db', cache_size='big')
+
     def teardown(self):
-        os.remove('test.db')
+        remove_database()
@@ -0,0 +1,115 @@
+# Built-in dependencies
+import threading
+
+# External dependencies
+import pytest
+
+# Internal dependencies
+from plume import BadSetting, Database, DuplicateKey
+from utils import WritingBaseTest
+
+
+class TestDatabaseTransaction(WritingBaseTest):
+
+    def test_operations_share_one_transaction(self):
+        with self.db.transaction():
+            assert self.db._connection.in_transaction
+            self.db.users.insert_one({'name': 'Mario'})
+            self.db.users.insert_many([{'name': 'Luigi'}])
+            self.db.users.replace_one({'name': 'Luigi'}, {'name': 'Peach'})
+            self.db.users.create_index(('name', str))
+            assert self.db._connection.in_transaction
+        assert not self.db._connection.in_transaction
+        assert self.db.users.find({'name': 'Peach'}) == [{'name': 'Peach'}]
+
+    def test_transaction_is_rolled_back_on_error(self):
+        self.db.users.insert_one({'name': 'Mario'})
+        with pytest.raises(KeyError):
+            with self.db.transaction():
+                self.db.users.insert_one({'name': 'Luigi'})
+                raise KeyError
+        assert self.db.users.find({}) == [{'name': 'Mario'}]
+
+    def test_nested_transaction_is_a_savepoint(self):
+        with self.db.transaction():
+            self.db.users.insert_one({'name': 'Mario'})
+            with pytest.raises(KeyError):
+                with self.db.transaction():
+                    self.db.users.insert_one({'name': 'Luigi'})
+                    raise KeyError
+            with self.db.transaction():
+                self.db.users.insert_one({'name': 'Peach'})
+        names = [user['name'] for user in self.db.users.find({})]
+        assert names == ['Mario', 'Peach']
+
+    def test_rolled_back_index_is_forgotten(self):
+        self.db.users.insert_one({'name': 'Mario'})
+        with pytest.raises(KeyError):
+            with self.db.transaction():
+                self.db.users.create_index(('name', str))
+                raise KeyError
+        assert self.db.users._indexes['indexes'] == []
+        assert self.db.users._indexed_fields == []
+        self.db.users.insert_one({'name': 'Luigi'})
+        assert self.db.users.find({'name': 'Mario'}) == [{'name': 'Mario'}]
+
+    def test_rolled_back_collection_is_forgotten(self):
+        events = self.db.events
+        with pytest.raises(KeyError):
+            with self.db.transaction():
+                events.insert_one({'type': 'click'})
+                raise KeyError
+        assert not events._registered
+        events.insert_one({'type': 'view'})
+        assert self.db.events.find({}) == [{'type': 'view'}]
+
+    def test_index_rolled_back_to_a_savepoint_is_forgotten(self):
+        with self.db.transaction():
+            self.db.users.create_index(('age', int))
+            with pytest.raises(KeyError):
+                with self.db.transaction():
+                    self.db.users.create_index(('name', str))
+                    raise KeyError
+            self.db.users.insert_one({'name': 'Mario', 'age': 42})
+        assert self.db.users._indexed_fields == ['age']
+        assert self.db.users.find({'name': 'Mario'}) == [
+            {'name': 'Mario', 'age': 42}
+        ]
+
+    def test_nested_operation_is_all_or_nothing(self):
+        self.db.users.create_index(('name', str), unique=True)
+        with self.db.transaction():
+            self.db.users.insert_one({'name': 'Mario'})
+            with pytest.raises(DuplicateKey):
+                self.db.users.insert_many([
+                    {'name': 'Luigi'}, {'name': 'Mario'}, {'name': 'Peach'}
+                ])
+        assert self.db.users.find({}) == [{'name': 'Mario'}]
+
+    def test_transaction_modes(self):
+        for mode in ('deferred', 'immediate', 'EXCLUSIVE'):
+            with self.db.transaction(mode):
+                self.db.users.insert_one({'mode': mode})
+        assert len(self.db.users.find({})) == 3
+
+    def test_unknown_transaction_mode(self):
+        with pytest.raises(BadSetting):
+            self.db.transaction('eventually')
+
+    def test_other_threads_wait_for_the_transaction(self):
+        db = Database('test.db', journal_mode='wal', pool_size=1)
+        inserted = threading.Event()
+
+        def insert():
+            db.users.insert_one({'name': 'Luigi'})
+            inserted.set()
+
+        with db.transaction():
+            db.users.insert_one({'name': 'Mario'})
+            thread = threading.Thread(target=insert)
+            thread.start()
+            assert not inserted.wait(0.1)
+            # The owning thread reads its own changes.
+            assert db.users.find({}) == [{'name': 'Mario'}]
+        thread.join()
+        assert len(db.users.find({})) == 2
@@ -1,3 +1,6 @@
+# Built-in dependencies
+import json
+
 # Internal dependencies
 from plume import Collection, SelectQuery
 
@@ -12,51 +15,69 @@ class TestSQLSelection:
             'name': {'$eq': 'John'}
         })
 
-        sql_query = select_query._sql_query()
+        sql_query, params = select_query._sql_query()
         expected = 'SELECT _data FROM users'
         assert sql_query == expected
+        assert params == []
 
     def test_select_indexed_text_field(self):
         select_query = SelectQuery(self._collection, set(['name']), {
             'name': {'$eq': 'John'}
         })
 
-        sql_query = select_query._sql_query()
-        expected = 'SELECT _data FROM users WHERE "name" = "John"'
+        sql_query, params = select_query._sql_query()
+        expected = 'SELECT _data FROM users WHERE "name" = ?'
         assert sql_query == expected
+        assert params == ['John']
+
+    def test_select_indexed_text_with_quotes(self):
+        select_query = SelectQuery(self._collection, set(['name']), {
+            'name': {'$eq': 'John "Johnny" O\'Neil'}
+        })
+
+        sql_query, params = select_query._sql_query()
+        expected = 'SELECT _data FROM users WHERE "name" = ?'
+        assert sql_query == expected
+        assert params == ['John "Johnny" O\'Neil']
 
     def test_select_indexed_integer_field(self):
         select_query = SelectQuery(self._collection, set(['age']), {
             'age': {'$eq': 42}
         })
 
-        sql_query = select_query._sql_query()
-        expected = 'SELECT _data FROM users WHERE "age" = 42'
+        sql_query, params = select_query._sql_query()
+        expected = 'SELECT _data FROM users WHERE "age" = ?'
         assert sql_query == expected
+        assert params == [42]
 
     def test_select_indexed_float_field(self):
         select_query = SelectQuery(self._collection, set(['size']), {
             'size': {'$eq': 1.66}
         })
 
-        sql_query = select_query._sql_query()
-        expected = 'SELECT _data FROM users WHERE "size" = 1.66'
+        sql_query, params = select_query._sql_query()
+        expected = 'SELECT _data FROM users WHERE "size" = ?'
         assert sql_query == expected
+        assert params == [1.66]
 
     def test_select_implicit_and(self):
         indexed_fields = set(['age'])
         query = {'age': {'$gt': 18, '$lt': 42}}
         select_query = SelectQuery(self._collection, indexed_fields, query)
-        sql_query = select_query._sql_query()
-        expected_1 = 'SELECT _data FROM users WHERE "age" > 18 AND "age" < 42'
-        expected_2 = 'SELECT _data FROM users WHERE "age" < 42 AND "age" > 18'
-        assert (sql_query == expected_1 or sql_query == expected_2)
+        sql_query, params = select_query._sql_query()
+        expected = (
+            'SELECT _data FROM users WHERE '
+            '"age" > ? AND typeof("age") IN (\'integer\', \'real\') AND '
+            '"age" < ? AND typeof("age") IN (\'integer\', \'real\')'
+        )
+        assert sql_query == expected
+        assert params == [18, 42]
 
     def test_select_implicit_and_on_non_indexed_field(self):
         indexed_fields = set(['name'])
         query = {'age': {'$gt': 18, '$lt': 42}}
         select_query = SelectQuery(self._collection, indexed_fields, query)
-        sql_query = select_query._sql_query()
+        sql_query, params = select_query._sql_query()
         expected = "SELECT _data FROM users"
         assert sql_query == expected
 
@@ -69,12 +90,15 @@ class TestSQLSelection:
             ]
         }
         select_query = SelectQuery(self._collection, indexed_fields, query)
-        sql_query = select_query._sql_query()
+        sql_query, params = select_query._sql_query()
         expected = (
             'SELECT _data FROM users WHERE '
-            '"name" = "Mario" AND "age" > 18 AND "age" < 42'
+            '"name" = ? AND '
+            '"age" > ? AND typeof("age") IN (\'integer\', \'real\') AND '
+            '"age" < ? AND typeof("age") IN (\'integer\', \'real\')'
         )
         assert sql_query == expected
+        assert params == ['Mario', 18, 42]
 
     def test_select_and(self):
         indexed_fields = set(['age'])
@@ -82,9 +106,14 @@ class TestSQLSelection:
             '$and': [{'age': {'$gt': 18}}, {'age': {'$lt': 42}}]
         }
         select_query = SelectQuery(self._collection, indexed_fields, query)
-        sql_query = select_query._sql_query()
-        expected = 'SELECT _data FROM users WHERE "age" > 18 AND "age" < 42'
+        sql_query, params = select_query._sql_query()
+        expected = (
+            'SELECT _data FROM users WHERE '
+            '"age" > ? AND typeof("age") IN (\'integer\', \'real\') AND '
+            '"age" < ? AND typeof("age") IN (\'integer\', \'real\')'
+        )
         assert sql_query == expected
+        assert params == [18, 42]
 
     def test_select_and_with_implicit_and(self):
         indexed_fields = set(['age', 'size'])
@@ -95,13 +124,16 @@ class TestSQLSelection:
             ]
         }
         select_query = SelectQuery(self._collection, indexed_fields, query)
-        sql_query = select_query._sql_query()
-        assert sql_query.startswith('SELECT _data FROM users WHERE ')
-        assert '"age" > 18' in sql_query
-        assert '"age" < 42' in sql_query
-        assert '"size" > 1.6' in sql_query
-        assert '"size" < 1.9' in sql_query
-        assert sql_query.count('AND') == 3
+        sql_query, params = select_query._sql_query()
+        expected = (
+            'SELECT _data FROM users WHERE '
+            '"age" > ? AND typeof("age") IN (\'integer\', \'real\') AND '
+            '"age" < ? AND typeof("age") IN (\'integer\', \'real\') AND '
+            '"size" > ? AND typeof("size") IN (\'integer\', \'real\') AND '
+            '"size" < ? AND typeof("size") IN (\'integer\', \'real\')'
+        )
+        assert sql_query == expected
+        assert params == [18, 42, 1.60, 1.90]
 
     def test_select_or_on_same_indexed_field(self):
         indexed_fields = set(['name'])
@@ -112,12 +144,13 @@ class TestSQLSelection:
             ]
         }
         select_query = SelectQuery(self._collection, indexed_fields, query)
-        sql_query = select_query._sql_query()
+        sql_query, params = select_query._sql_query()
         expected = (
             'SELECT _data FROM users WHERE '
-            '(("name" = "Mario") OR ("name" = "Luigi"))'
+            '(("name" = ?) OR ("name" = ?))'
         )
         assert sql_query == expected
+        assert params == ['Mario', 'Luigi']
 
     def test_select_or_in_implicit_and(self):
         indexed_fields = set(['age', 'name'])
@@ -129,16 +162,13 @@ class TestSQLSelection:
             ]
         }
         select_query = SelectQuery(self._collection, indexed_fields, query)
-        sql_query = select_query._sql_query()
-        expected_1 = (
-            'SELECT _data FROM users WHERE '
-            '"age" = 42 AND (("name" = "Mario") OR ("name" = "Luigi"))'
-        )
-        expected_2 = (
+        sql_query, params = select_query._sql_query()
+        expected = (
             'SELECT _data FROM users WHERE '
-            '(("name" = "Mario") OR ("name" = "Luigi")) AND "age" = 42'
+            '"age" = ? AND (("name" = ?) OR ("name" = ?))'
         )
-        assert sql_query == expected_1 or sql_query == expected_2
+        assert sql_query == expected
+        assert params == [42, 'Mario', 'Luigi']
 
     def test_select_or_with_nested_and_clause(self):
         indexed_fields = set(['age', 'name'])
@@ -155,13 +185,15 @@ class TestSQLSelection:
             ]
         }
         select_query = SelectQuery(self._collection, indexed_fields, query)
-        sql_query = select_query._sql_query()
+        sql_query, params = select_query._sql_query()
         expected = (
             'SELECT _data FROM users WHERE '
-            '(("name" = "Mario") OR ("name" = "Luigi")'
-            ' OR ("age" > 18 AND "age" < 42))'
+            '(("name" = ?) OR ("name" = ?)'
+            ' OR ("age" > ? AND typeof("age") IN (\'integer\', \'real\')'
+            ' AND "age" < ? AND typeof("age") IN (\'integer\', \'real\')))'
         )
         assert sql_query == expected
+        assert params == ['Mario', 'Luigi', 18, 42]
 
     def test_select_or_with_nested_with_clause_not_indexed(self):
         indexed_fields = set(['name'])
@@ -178,7 +210,7 @@ class TestSQLSelection:
             ]
         }
         select_query = SelectQuery(self._collection, indexed_fields, query)
-        sql_query = select_query._sql_query()
+        sql_query, params = select_query._sql_query()
         expected = 'SELECT _data FROM users'
         assert sql_query == expected
 
@@ -190,9 +222,10 @@ class TestSQLSelection:
             self._collection, indexed_fields, query, projection
         )
 
-        sql_query = select_query._sql_query()
-        expected = 'SELECT "name" FROM users WHERE "name" = "John"'
+        sql_query, params = select_query._sql_query()
+        expected = 'SELECT "name" FROM users WHERE "name" = ?'
         assert sql_query == expected
+        assert params == ['John']
 
     def test_projection_include_non_indexed_field(self):
         indexed_fields = set(['age'])
@@ -202,7 +235,7 @@ class TestSQLSelection:
             self._collection, indexed_fields, query, projection
         )
 
-        sql_query = select_query._sql_query()
+        sql_query, params = select_query._sql_query()
         expected = 'SELECT _data FROM users'
         assert sql_query == expected
 
@@ -214,9 +247,10 @@ class TestSQLSelection:
             self._collection, indexed_fields, query, projection
         )
 
-        sql_query = select_query._sql_query()
-        expected = 'SELECT _data FROM users WHERE "name" = "John"'
+        sql_query, params = select_query._sql_query()
+        expected = 'SELECT _data FROM users WHERE "name" = ?'
         assert sql_query == expected
+        assert params == ['John']
 
     def test_projection_exclude_non_indexed_field(self):
         indexed_fields = set(['age'])
@@ -226,6 +260,226 @@ class TestSQLSelection:
             self._collection, indexed_fields, query, projection
         )
 
-        sql_query = select_query._sql_query()
+        sql_query, params = select_query._sql_query()
         expected = 'SELECT _data FROM users'
         assert sql_query == expected
+
+
+class TestSQLSelectionWithPushdown:
+
+    def setup_class(cls):
+        cls._collection = Collection(None, 'users')
+
+    def test_select_non_indexed_field(self):
+        select_query = SelectQuery(self._collection, set([]), {
+            'name': {'$eq': 'John'}
+        }, pushdown=True)
+
+        sql_query, params = select_query._sql_query()
+        expected = (
+            'SELECT _data FROM users WHERE '
+            'json_extract(_data, \'$."name"\') = ? AND '
+            'json_type(_data, \'$."name"\') NOT IN (\'array\', \'object\')'
+        )
+        assert sql_query == expected
+        assert params == ['John']
+        assert select_query._plan._query_tree.is_empty()
+
+    def test_select_non_indexed_nested_field(self):
+        select_query = SelectQuery(self._collection, set([]), {
+            'meta.followers': {'$gt': 42}
+        }, pushdown=True)
+
+        sql_query, params = select_query._sql_query()
+        expected = (
+            'SELECT _data FROM users WHERE '
+            'json_extract(_data, \'$."meta"."followers"\') > ? AND '
+            'json_type(_data, \'$."meta"."followers"\') '
+            'IN (\'integer\', \'real\', \'true\', \'false\')'
+        )
+        assert sql_query == expected
+        assert params == [42]
+
+    def test_select_indexed_field_does_not_use_json_extract(self):
+        select_query = SelectQuery(self._collection, set(['age']), {
+            'age': {'$lte': 42}
+        }, pushdown=True)
+
+        sql_query, params = select_query._sql_query()
+        expected = (
+            'SELECT _data FROM users WHERE '
+            '"age" <= ? AND typeof("age") IN (\'integer\', \'real\')'
+        )
+        assert sql_query == expected
+        assert params == [42]
+
+    def test_select_not_equal_keeps_missing_fields(self):
+        select_query = SelectQuery(self._collection, set([]), {
+            'age': {'$ne': 42}
+        }, pushdown=True)
+
+        sql_query, params = select_query._sql_query()
+        expected = (
+            'SELECT _data FROM users WHERE '
+            'json_extract(_data, \'$."age"\') IS NOT ?'
+        )
+        assert sql_query == expected
+        assert params == [42]
+
+    def test_select_equal_none(self):
+        select_query = SelectQuery(self._collection, set([]), {
+            'age': None
+        }, pushdown=True)
+
+        sql_query, params = select_query._sql_query()
+        expected = (
+            'SELECT _data FROM users WHERE '
+            'json_extract(_data, \'$."age"\') IS NULL'
+        )
+        assert sql_query == expected
+        assert params == []
+
+    def test_select_or_on_non_indexed_fields(self):
+        query = {
+            '$or': [
+                {'name': 'Mario'},
+                {'age': {'$gt': 18, '$lt': 42}},
+            ]
+        }
+        select_query = SelectQuery(
+            self._collection, set([]), query, pushdown=True
+        )
+        sql_query, params = select_query._sql_query()
+        expected = (
+            'SELECT _data FROM users WHERE '
+            '((json_extract(_data, \'$."name"\') = ? AND '
+            'json_type(_data, \'$."name"\') NOT IN (\'array\', \'object\')) '
+            'OR (json_extract(_data, \'$."age"\') > ? AND '
+            'json_type(_data, \'$."age"\') '
+            'IN (\'integer\', \'real\', \'true\', \'false\') AND '
+            'json_extract(_data, \'$."age"\') < ? AND '
+            'json_type(_data, \'$."age"\') '
+            'IN (\'integer\', \'real\', \'true\', \'false\')))'
+        )
+        assert sql_query == expected
+        assert params == ['Mario', 18, 42]
+
+    def test_non_scalar_value_is_matched_in_python(self):
+        query = {'name': 'John', 'friends': ['Mario', 'Luigi']}
+        select_query = SelectQuery(
+            self._collection, set([]), query, pushdown=True
+        )
+        sql_query, params = select_query._sql_query()
+        expected = (
+            'SELECT _data FROM users WHERE '
+            'json_extract(_data, \'$."name"\') = ? AND '
+            'json_type(_data, \'$."name"\') NOT IN (\'array\', \'object\')'
+        )
+        assert sql_query == expected
+        assert params == ['John']
+        assert len(select_query._plan._query_tree._selectors) == 1
+
+    def test_or_partially_applicable_is_matched_in_python(self):
+        indexed_fields = set(['name'])
+        query = {
+            '$or': [
+                {'name': 'Mario'},
+                {'$and': [{'name': 'Luigi'}, {'friends': ['Mario']}]},
+            ]
+        }
+        select_query = SelectQuery(
+            self._collection, indexed_fields, query, pushdown=True
+        )
+        sql_query, params = select_query._sql_query()
+        assert sql_query == 'SELECT _data FROM users'
+        assert len(select_query._plan._query_tree._selectors) == 1
+
+
+class TestSQLSelectionOnId:
+
+    def setup_class(cls):
+        cls._collection = Collection(None, 'users')
+
+    def test_select_id(self):
+        select_query = SelectQuery(self._collection, set([]), {'_id': 42})
+        sql_query, params = select_query._sql_query()
+        expected = 'SELECT _data FROM users WHERE id = ?'
+        assert sql_query == expected
+        assert params == [42]
+        assert select_query._plan._query_tree.is_empty()
+
+    def test_select_id_range(self):
+        select_query = SelectQuery(self._collection, set([]), {
+            '_id': {'$gte': 10, '$lt': 20}
+        })
+        sql_query, params = select_query._sql_query()
+        expected = 'SELECT _data FROM users WHERE id >= ? AND id < ?'
+        assert sql_query == expected
+        assert params == [10, 20]
+
+    def test_select_with_id(self):
+        select_query = SelectQuery(
+            self._collection, set([]), {}, with_id=True
+        )
+        sql_query, params = select_query._sql_query()
+        assert sql_query == 'SELECT id, _data FROM users'
+
+
+class TestSQLSelectionWithMembership:
+
+    def setup_class(cls):
+        cls._collection = Collection(None, 'users')
+
+    def test_select_in_on_indexed_field(self):
+        select_query = SelectQuery(self._collection, set(['name']), {
+            'name': {'$in': ['Mario', 'Luigi']}
+        }, pushdown=True)
+        sql_query, params = select_query._sql_query()
+        expected = (
+            'SELECT _data FROM users WHERE '
+            '"name" IN (SELECT value FROM json_each(?))'
+        )
+        assert sql_query == expected
+        assert sorted(json.loads(params[0])) == ['Luigi', 'Mario']
+
+    def test_select_in_on_id(self):
+        select_query = SelectQuery(self._collection, set([]), {
+            '_id': {'$in': [1, 2, 3]}
+        }, pushdown=True)
+        sql_query, params = select_query._sql_query()
+        expected = (
+            'SELECT _data FROM users WHERE '
+            'id IN (SELECT value FROM json_each(?))'
+        )
+        assert sql_query == expected
+        assert sorted(json.loads(params[0])) == [1, 2, 3]
+
+    def test_select_not_in_on_non_indexed_field(self):
+        select_query = SelectQuery(self._collection, set([]), {
+            'age': {'$nin': [18, 42]}
+        }, pushdown=True)
+        sql_query, params = select_query._sql_query()
+        column = 'json_extract(_data, \'$."age"\')'
+        expected = (
+            'SELECT _data FROM users WHERE ({0} IS NULL OR '
+            '{0} NOT IN (SELECT value FROM json_each(?)) OR '
+            'json_type(_data, \'$."age"\') IN (\'array\', \'object\'))'
+        ).format(column)
+        assert sql_query == expected
+        assert sorted(json.loads(params[0])) == [18, 42]
+
+    def test_lists_of_any_length_share_the_same_plan(self):
+        SelectQuery(self._collection, set(['age']), {
+            'age': {'$in': [1, 2]}
+        }, pushdown=True)
+        select_query = SelectQuery(self._collection, set(['age']), {
+            'age': {'$in': list(range(5000))}
+        }, pushdown=True)
+        assert select_query._cached is True
+
+    def test_select_in_without_pushdown(self):
+        select_query = SelectQuery(self._collection, set(['name']), {
+            'name': {'$in': ['Mario', 'Luigi']}
+        })
+        sql_query, params = select_query._sql_query()
+        assert sql_query == 'SELECT _data FROM users'
@@ -6,12 +6,19 @@ from plume import Database
 from factories import Persona
 
 
+def remove_database(name='test.db'):
+    """Removes a database file, along with its WAL files if any."""
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(name + suffix):
+            os.remove(name + suffix)
+
+
 class WritingBaseTest:
     def setup(self):
         self.db = Database('test.db')
 
     def teardown(self):
-        os.remove('test.db')
+        remove_database()
 
 
 class ReadingBaseTest:
@@ -19,7 +26,7 @@ class ReadingBaseTest:
         cls.db = Database('test.db')
 
     def teardown_class(self):
-        os.remove('test.db')
+        remove_database()
 
 
 def collection_is_registered(db, collection_name):